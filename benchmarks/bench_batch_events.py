@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compare per-batch internalization latency of the bulk internalizer
+against the original per-event loop for batches of 10, 100 and 1000
+events.
+
+Run from a buildout/virtualenv with the test extras installed::
+
+    python benchmarks/bench_batch_events.py
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import time
+import timeit
+
+from zope.configuration import xmlconfig
+
+from zope.schema.interfaces import ValidationError
+
+import nti.analytics
+
+from nti.analytics.model import ResourceEvent
+from nti.analytics.model import SkipVideoEvent
+from nti.analytics.model import CourseCatalogViewEvent
+
+from nti.app.analytics.ingest import internalize_events
+
+from nti.externalization import internalization
+
+from nti.externalization.externalization import to_external_object
+
+USERNAME = u'bench_user'
+COURSE = u'tag:nextthought.com,2011-10:NTI-CourseInfo-Bench.course_info'
+
+BATCH_SIZES = (10, 100, 1000)
+REPEAT = 5
+
+
+def _make_batch(size):
+    now = time.time()
+    result = []
+    for idx in range(size):
+        resource_id = u'tag:nextthought.com,2011-10:NTI-HTML-Bench.%s' % (idx % 50)
+        kind = idx % 3
+        if kind == 0:
+            event = ResourceEvent(user=USERNAME, timestamp=now,
+                                  RootContextID=COURSE,
+                                  ResourceId=resource_id,
+                                  Duration=30)
+        elif kind == 1:
+            event = SkipVideoEvent(user=USERNAME, timestamp=now,
+                                   RootContextID=COURSE,
+                                   ResourceId=resource_id,
+                                   Duration=30,
+                                   video_start_time=10,
+                                   video_end_time=40,
+                                   with_transcript=False)
+        else:
+            event = CourseCatalogViewEvent(user=USERNAME, timestamp=now,
+                                           RootContextID=COURSE,
+                                           Duration=30)
+        result.append(to_external_object(event))
+    return result
+
+
+def _per_event(events):
+    """
+    The original per-event internalization loop.
+    """
+    result = []
+    for event in events:
+        factory = internalization.find_factory_for(event)
+        if factory is None:
+            continue
+        new_event = factory()
+        try:
+            internalization.update_from_external_object(new_event, event)
+        except (ValidationError, ValueError):
+            continue
+        result.append(new_event)
+    return result
+
+
+def _bulk(events):
+    return internalize_events(events, USERNAME)[0]
+
+
+def main():
+    xmlconfig.file('configure.zcml', package=nti.analytics)
+    print('%8s %14s %14s %8s' % ('events', 'per-event ms', 'bulk ms', 'speedup'))
+    for size in BATCH_SIZES:
+        batch = _make_batch(size)
+        per_event = min(timeit.repeat(lambda: _per_event(batch),
+                                      number=1, repeat=REPEAT))
+        bulk = min(timeit.repeat(lambda: _bulk(batch),
+                                 number=1, repeat=REPEAT))
+        print('%8d %14.2f %14.2f %7.2fx' % (size, per_event * 1000,
+                                            bulk * 1000, per_event / bulk))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compare the time and peak memory of building course video usage stats
+with the object-per-group accumulator and the columnar accumulator, on
+synthetic course data.
+
+Run from a buildout/virtualenv with the test extras installed::
+
+    python benchmarks/bench_usage_stats.py
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import time
+import random
+
+try:
+    import tracemalloc
+except ImportError:  # pragma: no cover
+    tracemalloc = None
+
+from nti.app.analytics.columnar import ColumnarEventAccumulator
+
+from nti.app.analytics.usage_stats import ALL_USERS
+from nti.app.analytics.usage_stats import CourseVideoUsageStats
+from nti.app.analytics.usage_stats import ResourceEventAccumulator
+
+#: (users, videos, events) per synthetic course
+COURSE_SIZES = ((100, 50, 10000),
+                (500, 100, 100000),
+                (2000, 200, 400000))
+
+
+class _User(object):
+
+    def __init__(self, username):
+        self.username = username
+
+
+class _VideoEvent(object):
+
+    def __init__(self, user, resource_id, session_id, duration,
+                 start_time, end_time, max_duration, timestamp):
+        self.user = user
+        self.ResourceId = resource_id
+        self.SessionID = session_id
+        self.Duration = duration
+        self.VideoStartTime = start_time
+        self.VideoEndTime = end_time
+        self.MaxDuration = max_duration
+        self.timestamp = timestamp
+
+
+class _Course(object):
+    instructors = ()
+
+
+def _make_course(user_count, video_count, event_count, seed=42):
+    rnd = random.Random(seed)
+    users = [_User(u'student%s' % idx) for idx in range(user_count)]
+    durations = [rnd.randint(60, 3600) for _ in range(video_count)]
+    events = []
+    for _ in range(event_count):
+        user = rnd.choice(users)
+        video = rnd.randrange(video_count)
+        max_duration = durations[video]
+        start_time = rnd.randint(0, max_duration)
+        end_time = rnd.randint(start_time, max_duration)
+        events.append(_VideoEvent(user,
+                                  u'tag:nextthought.com,2011-10:NTI-NTIVideo-Bench.%s' % video,
+                                  rnd.randint(1, event_count // 10),
+                                  end_time - start_time,
+                                  start_time, end_time, max_duration,
+                                  1500000000 + rnd.randint(0, 10 ** 7)))
+    usernames = {x.username for x in users}
+    public = {x for x in usernames if hash(x) % 2}
+    scopes = {ALL_USERS: usernames,
+              u'Public': public,
+              u'ForCredit': usernames - public}
+    return events, scopes
+
+
+class _Titles(object):
+
+    def resolve(self, ntiids):
+        return {x: x for x in ntiids}
+
+
+class _BenchStats(CourseVideoUsageStats):
+
+    #: We only have our synthetic events
+    AGGREGATE_IN_DB = False
+
+    def __init__(self, events, scopes, accumulator_factory):
+        self.accumulator_factory = accumulator_factory
+        super(_BenchStats, self).__init__(_Course())
+        self.events = events
+        self.enrollment_scope_dict = scopes
+        self.title_resolver = _Titles()
+
+    def _get_title(self, ntiid):
+        return ntiid
+
+    def _exclude_user(self, unused_user, unused_username=None):
+        return False
+
+
+def _run(events, scopes, factory):
+    stats = _BenchStats(events, scopes, factory)
+    if tracemalloc is not None:
+        tracemalloc.start()
+    start = time.time()
+    result = [stats.get_stats(x) for x in (None, 'Public', 'ForCredit')]
+    elapsed = time.time() - start
+    peak = 0
+    if tracemalloc is not None:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def main():
+    print('%8s %10s %12s %12s %12s %12s %6s' % ('events', 'videos',
+                                                 'object ms', 'column ms',
+                                                 'object MB', 'column MB',
+                                                 'same'))
+    for user_count, video_count, event_count in COURSE_SIZES:
+        events, scopes = _make_course(user_count, video_count, event_count)
+        by_object, object_time, object_peak = _run(events, scopes,
+                                                   ResourceEventAccumulator)
+        by_column, column_time, column_peak = _run(events, scopes,
+                                                   ColumnarEventAccumulator)
+        print('%8d %10d %12.1f %12.1f %12.1f %12.1f %6s' % (
+              event_count, video_count,
+              object_time * 1000, column_time * 1000,
+              object_peak / 2 ** 20, column_peak / 2 ** 20,
+              by_object == by_column))
+
+
+if __name__ == '__main__':
+    main()
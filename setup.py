@@ -72,14 +72,18 @@ setup(
         'pyramid',
         'requests',
         'six',
+        'transaction',
         'z3c.autoinclude',
         'ZODB',
+        'zope.annotation',
         'zope.cachedescriptors',
         'zope.component',
+        'zope.container',
         'zope.event',
         'zope.i18nmessageid',
         'zope.interface',
         'zope.intid',
+        'zope.lifecycleevent',
         'zope.location',
         'zope.schema',
         'zope.security',
@@ -87,6 +91,9 @@ setup(
     ],
     extras_require={
         'test': TESTS_REQUIRE,
+        'numpy': [
+            'numpy',
+        ],
         'docs': [
             'Sphinx',
             'repoze.sphinx.autointerface',
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Usage stat aggregates computed by the analytics database.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+from collections import namedtuple
+
+from sqlalchemy import or_
+from sqlalchemy import and_
+from sqlalchemy import case
+from sqlalchemy import func
+from sqlalchemy import null
+from sqlalchemy import literal
+
+from nti.analytics.database import get_analytics_db
+
+from nti.analytics.database.resource_views import VideoEvents
+from nti.analytics.database.resource_views import ResourceViews
+
+from nti.analytics.database.root_context import get_root_context_id
+
+from nti.analytics_database.resources import Resources
+
+from nti.analytics_database.users import Users
+
+#: The stats of one user's views of one resource in one session.
+AggregateRow = namedtuple('AggregateRow',
+                          ('resource_id',
+                           'username',
+                           'session_id',
+                           'event_count',
+                           'total_view_time',
+                           'max_end_time',
+                           'max_duration',
+                           'last_view_time'))
+
+#: The count of video watch events over the same segment of a video.
+SegmentRow = namedtuple('SegmentRow',
+                        ('start',
+                         'end',
+                         'count',
+                         'max_row_id'))
+
+#: How long (in seconds) after its timestamp an event row may still be
+#: updated (e.g. by video heartbeats filling in its end time).
+EVENT_UPDATE_SECONDS = 24 * 60 * 60
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def _video_end_time(table):
+    """
+    The furthest point watched by an event. Partial events without an
+    end time (0) but with a (non-zero) duration use their start time
+    plus duration, as :class:`nti.app.analytics.usage_stats.BaseStats`
+    does.
+
+    Grouped rows take the greatest of these. `BaseStats` instead lets a
+    partial event replace a greater end time seen before it, so the two
+    differ for users or sessions with both complete and partial events,
+    in which case the greatest is the better answer.
+    """
+    return case([(table.video_end_time > 0, table.video_end_time),
+                 (and_(table.video_end_time == 0,
+                       table.time_length != 0,
+                       table.video_start_time.isnot(None)),
+                  table.video_start_time + table.time_length)],
+                else_=0)
+
+
+def get_row_id_column(table):
+    """
+    Return the (insert ordered) row id column of the event table.
+    """
+    return list(table.__table__.primary_key.columns)[0]
+
+
+def _get_aggregate_rows(table, root_context, end_time, max_duration,
+                        filters=()):
+    db = get_analytics_db()
+    root_context_id = get_root_context_id(db, root_context)
+    if root_context_id is None:
+        return None
+    query = db.session.query(Resources.resource_ds_id,
+                             Users.username,
+                             table.session_id,
+                             func.count(),
+                             func.sum(table.time_length),
+                             func.max(end_time),
+                             max_duration,
+                             func.max(table.timestamp))
+    query = query.join(Resources, Resources.resource_id == table.resource_id) \
+                 .join(Users, Users.user_id == table.user_id) \
+                 .filter(table.course_id == root_context_id, *filters) \
+                 .group_by(Resources.resource_ds_id,
+                           Users.username,
+                           table.session_id)
+    return [AggregateRow(*x) for x in query]
+
+
+def get_video_view_aggregates(course):
+    """
+    Return the :class:`AggregateRow` of video watch events in the given
+    course, grouped by resource, user and session, or None if the course
+    is unknown to the analytics database.
+
+    Each row's `max_duration` is the greatest reported by its events;
+    accumulated events take the first reported. Videos report one
+    duration, so these only differ for bad data.
+    """
+    return _get_aggregate_rows(VideoEvents, course,
+                               _video_end_time(VideoEvents),
+                               func.max(VideoEvents.max_time_length),
+                               (VideoEvents.video_event_type == u'WATCH',))
+
+
+def get_resource_view_aggregates(course):
+    """
+    Return the :class:`AggregateRow` of resource view events in the
+    given course, grouped by resource, user and session, or None if the
+    course is unknown to the analytics database.
+    """
+    return _get_aggregate_rows(ResourceViews, course,
+                               literal(0),
+                               null())
+
+
+def get_video_segment_aggregates(course, ntiid, before=None, since=None,
+                                 after=None):
+    """
+    Return the :class:`SegmentRow` of watch events of the given video in
+    the given course, grouped by start and end time, or None if the
+    course is unknown to the analytics database. Events that did not
+    get past their start are skipped. Only events from before `before`
+    (a datetime) are included, if given, and only those from `since`
+    on, or whose row id is greater than `after`, if `since` is given.
+    """
+    db = get_analytics_db()
+    root_context_id = get_root_context_id(db, course)
+    if root_context_id is None:
+        return None
+    start_time = VideoEvents.video_start_time
+    end_time = _video_end_time(VideoEvents)
+    row_id = get_row_id_column(VideoEvents)
+    filters = []
+    if before is not None:
+        filters.append(VideoEvents.timestamp < before)
+    if since is not None:
+        recent = VideoEvents.timestamp >= since
+        if after is not None:
+            recent = or_(recent, row_id > after)
+        filters.append(recent)
+    query = db.session.query(start_time,
+                             end_time,
+                             func.count(),
+                             func.max(row_id))
+    query = query.join(Resources, Resources.resource_id == VideoEvents.resource_id) \
+                 .filter(VideoEvents.course_id == root_context_id,
+                         Resources.resource_ds_id == ntiid,
+                         VideoEvents.video_event_type == u'WATCH',
+                         start_time.isnot(None),
+                         end_time > start_time,
+                         *filters) \
+                 .group_by(start_time, end_time)
+    return [SegmentRow(*x) for x in query]
+
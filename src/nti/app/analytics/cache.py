@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Small in-process caching helpers.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import time
+import threading
+
+from collections import OrderedDict
+
+logger = __import__('logging').getLogger(__name__)
+
+#: Marker for missing cache entries
+_MISSING = object()
+
+
+class LRUCache(object):
+    """
+    A thread-safe, bounded mapping that evicts its least recently used
+    entries. If a `ttl` (in seconds) is given, entries also expire that
+    long after being set.
+
+    The `maxsize` bounds the total weight of the entries, each weighing
+    1 unless set with another `weight` (e.g. the number of items a value
+    holds). Values weighing more than `maxsize` are not kept.
+
+    Since these caches are shared across requests (and thus ZODB
+    connections), they should only hold plain values (intids, strings,
+    numbers), never persistent objects.
+    """
+
+    def __init__(self, maxsize=1000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.size = 0
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+
+    def _expired(self, expires):
+        return expires is not None and expires < time.time()
+
+    def _pop(self, key):
+        entry = self._data.pop(key, _MISSING)
+        if entry is not _MISSING:
+            self.size -= entry[2]
+        return entry
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, _MISSING)
+            if entry is _MISSING:
+                return default
+            value, expires, weight = entry
+            if self._expired(expires):
+                self.size -= weight
+                return default
+            # Re-insert as most recently used
+            self._data[key] = entry
+            return value
+
+    def set(self, key, value, ttl=None, weight=1):
+        ttl = ttl if ttl is not None else self.ttl
+        expires = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._pop(key)
+            self._data[key] = (value, expires, weight)
+            self.size += weight
+            while self.size > self.maxsize:
+                unused_key, entry = self._data.popitem(last=False)
+                self.size -= entry[2]
+
+    def invalidate(self, key):
+        with self._lock:
+            self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+A compact, columnar accumulator for usage stats.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+from array import array
+
+import six
+
+logger = __import__('logging').getLogger(__name__)
+
+#: Stand-in for missing numeric values in our float columns.
+_NAN = float('nan')
+
+#: The numeric event fields we store, in column order.
+_NUMERIC_FIELDS = ('Duration', 'VideoStartTime', 'VideoEndTime', 'MaxDuration')
+
+
+class _Interner(object):
+    """
+    Maps (hashable) values to small integer codes, and back.
+    """
+
+    def __init__(self):
+        self.codes = {}
+        self.values = []
+
+    def code(self, value):
+        try:
+            return self.codes[value]
+        except KeyError:
+            result = self.codes[value] = len(self.values)
+            self.values.append(value)
+            return result
+
+
+class EventColumns(object):
+    """
+    The fields usage stats read from each event, stored column-wise.
+    Strings (and session ids) are interned, numeric fields are stored as
+    doubles and decoded back to ints unless a column has seen a float.
+    Timestamps are kept as given, since they may not be numbers.
+
+    Rows may also hold the events of a resource, user and session
+    already aggregated by the analytics database, with their count.
+    """
+
+    def __init__(self):
+        self.resources = _Interner()
+        self.usernames = _Interner()
+        self.sessions = _Interner()
+        self.resource_col = array('l')
+        self.user_col = array('l')
+        self.session_col = array('l')
+        self.count_col = array('l')
+        self.numeric_cols = tuple(array('d') for _ in _NUMERIC_FIELDS)
+        self.timestamps = []
+        self._float_cols = set()
+        self._last_event = None
+
+    def __len__(self):
+        return len(self.resource_col)
+
+    def _append(self, resource, username, session_id, count, values,
+                timestamp):
+        self.resource_col.append(self.resources.code(resource))
+        self.user_col.append(self.usernames.code(username))
+        self.session_col.append(self.sessions.code(session_id))
+        self.count_col.append(count)
+        for idx, value in enumerate(values):
+            if value is None:
+                value = _NAN
+            elif not isinstance(value, six.integer_types):
+                self._float_cols.add(idx)
+            self.numeric_cols[idx].append(value)
+        self.timestamps.append(timestamp)
+        return len(self.resource_col) - 1
+
+    def append(self, event):
+        """
+        Append the event, returning its row. Appending the same event
+        consecutively (e.g. for several scopes) stores it once.
+        """
+        if event is self._last_event:
+            return len(self.resource_col) - 1
+        self._last_event = event
+        return self._append(event.ResourceId,
+                            event.user.username,
+                            event.SessionID,
+                            1,
+                            [getattr(event, name, None)
+                             for name in _NUMERIC_FIELDS],
+                            event.timestamp)
+
+    def append_row(self, row, username):
+        """
+        Append the :class:`~nti.app.analytics.aggregation.AggregateRow`
+        of the given user, returning its row. As with events, appending
+        the same row consecutively stores it once.
+
+        The row's end time is already the furthest watched, so it has no
+        start time to fall back on.
+        """
+        if row is self._last_event:
+            return len(self.resource_col) - 1
+        self._last_event = row
+        total_view_time = row.total_view_time
+        if      total_view_time is not None \
+            and not isinstance(total_view_time, six.integer_types) \
+            and total_view_time == int(total_view_time):
+            # SUM() of integers may come back as a Decimal
+            total_view_time = int(total_view_time)
+        return self._append(row.resource_id,
+                            username,
+                            row.session_id,
+                            row.event_count,
+                            (total_view_time, None, row.max_end_time,
+                             row.max_duration),
+                            row.last_view_time)
+
+    def decoders(self):
+        """
+        Return a function per numeric column that decodes a stored value.
+        """
+        def _decode_int(value):
+            return None if value != value else int(value)
+
+        def _decode_float(value):
+            return None if value != value else value
+
+        return tuple(_decode_float if idx in self._float_cols else _decode_int
+                     for idx in range(len(_NUMERIC_FIELDS)))
+
+
+class ColumnarBaseStats(object):
+    """
+    The per-user or per-session stats of a resource; mirrors
+    :class:`nti.app.analytics.usage_stats.BaseStats`.
+    """
+
+    __slots__ = ('total_view_time', 'max_end_time', 'last_view_time')
+
+    def __init__(self):
+        self.total_view_time = 0
+        self.max_end_time = 0
+        self.last_view_time = None
+
+    def incr(self, duration, start_time, end_time, timestamp):
+        if duration:
+            self.total_view_time += duration
+        if end_time and end_time > self.max_end_time:
+            self.max_end_time = end_time
+        elif    end_time == 0 \
+            and duration \
+            and start_time is not None:
+            self.max_end_time = start_time + duration
+
+        if self.last_view_time is None:
+            self.last_view_time = timestamp
+        elif timestamp and timestamp > self.last_view_time:
+            self.last_view_time = timestamp
+
+
+class ColumnarResourceStats(object):
+    """
+    Stats reduced from a group of rows; mirrors
+    :class:`nti.app.analytics.usage_stats.ResourceStats`.
+    """
+
+    __slots__ = ('total_view_time', 'user_stats', 'session_stats',
+                 'event_count', 'max_duration', 'last_view_time')
+
+    def __init__(self):
+        self.total_view_time = 0
+        self.user_stats = {}
+        self.session_stats = {}
+        self.event_count = 0
+        self.max_duration = None
+        self.last_view_time = None
+
+    @property
+    def session_count(self):
+        return len(self.session_stats)
+
+
+def _reduce_rows(columns, rows):
+    """
+    Reduce the given (ordered) rows to a :class:`ColumnarResourceStats`.
+    """
+    result = ColumnarResourceStats()
+    user_stats = result.user_stats
+    session_stats = result.session_stats
+    usernames = columns.usernames.values
+    sessions = columns.sessions.values
+    user_col = columns.user_col
+    session_col = columns.session_col
+    count_col = columns.count_col
+    timestamps = columns.timestamps
+    durations, start_times, end_times, max_durations = columns.numeric_cols
+    decode_duration, decode_start, decode_end, decode_max = columns.decoders()
+
+    for row in rows:
+        duration = decode_duration(durations[row])
+        start_time = decode_start(start_times[row])
+        end_time = decode_end(end_times[row])
+        timestamp = timestamps[row]
+
+        result.event_count += count_col[row]
+        if duration:
+            result.total_view_time += duration
+
+        username = usernames[user_col[row]]
+        try:
+            stats = user_stats[username]
+        except KeyError:
+            stats = user_stats[username] = ColumnarBaseStats()
+        stats.incr(duration, start_time, end_time, timestamp)
+
+        session_id = sessions[session_col[row]]
+        try:
+            stats = session_stats[session_id]
+        except KeyError:
+            stats = session_stats[session_id] = ColumnarBaseStats()
+        stats.incr(duration, start_time, end_time, timestamp)
+
+        if result.max_duration is None:
+            result.max_duration = decode_max(max_durations[row])
+        if result.last_view_time is None:
+            result.last_view_time = timestamp
+        elif timestamp and timestamp > result.last_view_time:
+            result.last_view_time = timestamp
+    return result
+
+
+class _ReducedStatsMap(object):
+    """
+    A read-only mapping of key to the stats of its rows, reduced on
+    access, so that only one group's stats are alive at a time while
+    iterating.
+    """
+
+    def __init__(self, columns, interner, index):
+        self._columns = columns
+        self._interner = interner
+        self._index = index
+
+    def _key(self, key):
+        return self._interner.codes.get(key)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __iter__(self):
+        values = self._interner.values
+        return (values[code] for code in self._index)
+
+    keys = __iter__
+
+    def __contains__(self, key):
+        return self._key(key) in self._index
+
+    def __getitem__(self, key):
+        code = self._key(key)
+        if code not in self._index:
+            raise KeyError(key)
+        return _reduce_rows(self._columns, self._index[code])
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def items(self):
+        values = self._interner.values
+        for code, rows in self._index.items():
+            yield values[code], _reduce_rows(self._columns, rows)
+
+    def values(self):
+        for _, stats in self.items():
+            yield stats
+
+
+class ColumnarEventAccumulator(object):
+    """
+    An event accumulator with the interface of
+    :class:`nti.app.analytics.usage_stats.ResourceEventAccumulator`,
+    storing events column-wise instead of as stats objects per resource,
+    user and session. Stats are reduced when read.
+    """
+
+    def __init__(self, columns=None):
+        self.columns = EventColumns() if columns is None else columns
+        self._resource_rows = {}
+        self._user_rows = {}
+
+    @classmethod
+    def for_scopes(cls, scope_names):
+        """
+        Return a map of scope name to accumulator, all sharing a single
+        set of columns.
+        """
+        columns = EventColumns()
+        return {x: cls(columns) for x in scope_names}
+
+    def _index(self, row):
+        columns = self.columns
+        for index, code in ((self._resource_rows, columns.resource_col[row]),
+                            (self._user_rows, columns.user_col[row])):
+            try:
+                index[code].append(row)
+            except KeyError:
+                index[code] = array('l', (row,))
+
+    def accum(self, event):
+        self._index(self.columns.append(event))
+
+    def accum_row(self, row, username):
+        """
+        Accumulate the events of an
+        :class:`~nti.app.analytics.aggregation.AggregateRow` of the given
+        user, aggregated by the analytics database.
+        """
+        self._index(self.columns.append_row(row, username))
+
+    def session_counts(self):
+        """
+        Return a map of ntiid to its session count, without reducing
+        any stats.
+        """
+        values = self.columns.resources.values
+        session_col = self.columns.session_col
+        return {values[code]: len({session_col[row] for row in rows})
+                for code, rows in self._resource_rows.items()}
+
+    @property
+    def ntiid_stats_map(self):
+        return _ReducedStatsMap(self.columns,
+                                self.columns.resources,
+                                self._resource_rows)
+
+    @property
+    def user_stats_map(self):
+        return _ReducedStatsMap(self.columns,
+                                self.columns.usernames,
+                                self._user_rows)
@@ -72,6 +72,23 @@ class _CourseVideoProgressLinkDecorator(_AnalyticsEnabledDecorator):
         link.__parent__ = context
         links.append(link)
 
+
+@component.adapter(ICourseInstance)
+@interface.implementer(IExternalMappingDecorator)
+class _CourseVideoResumeInfoLinkDecorator(_AnalyticsEnabledDecorator):
+    """
+    Return a link on the course in which the client can retrieve
+    resume information for all videos a user has watched.
+    """
+
+    def _do_decorate_external(self, context, result):
+        links = result.setdefault(LINKS, [])
+        link = Link(context, rel="VideoResumeInfo", elements=('VideoResumeInfo',))
+        interface.alsoProvides(link, ILocation)
+        link.__name__ = ''
+        link.__parent__ = context
+        links.append(link)
+
 @component.adapter(INTIVideo)
 @interface.implementer(IExternalMappingDecorator)
 class _CourseVideoWatchInfo(_AnalyticsEnabledDecorator):
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Dropping resent analytics batches and events.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+try:
+    from collections.abc import Mapping
+except ImportError:  # pragma: no cover
+    from collections import Mapping
+
+import six
+
+import transaction
+
+from zope import component
+from zope import interface
+
+from nti.app.analytics.cache import LRUCache
+
+from nti.app.analytics.interfaces import IEventDedupeStore
+
+from nti.dataserver.interfaces import IRedisClient
+
+#: The body field carrying the client's batch id.
+BATCH_ID = 'BatchId'
+
+#: The request header that may carry the client's batch id, so that a
+#: resent batch is dropped before its body is read.
+BATCH_ID_HEADER = 'X-NTI-Batch-Id'
+
+#: The query param that may carry the client's batch id, as the header.
+BATCH_ID_PARAM = 'batchId'
+
+#: The event field carrying the client's event id.
+CLIENT_EVENT_ID = 'ClientEventId'
+
+#: How long (in seconds) we remember batch and event ids.
+DEFAULT_DEDUPE_WINDOW = 24 * 60 * 60
+
+logger = __import__('logging').getLogger(__name__)
+
+
+@interface.implementer(IEventDedupeStore)
+class InMemoryDedupeStore(object):
+    """
+    A dedupe store local to this process, bounded in both size and time.
+    """
+
+    def __init__(self, maxsize=100000, ttl=DEFAULT_DEDUPE_WINDOW):
+        self._seen = LRUCache(maxsize=maxsize, ttl=ttl)
+
+    def seen(self, keys):
+        return {x for x in keys if x in self._seen}
+
+    def mark(self, keys):
+        for key in keys:
+            self._seen.set(key, True)
+
+
+@interface.implementer(IEventDedupeStore)
+class RedisDedupeStore(object):
+    """
+    A dedupe store shared, through redis, by every process in the
+    cluster. Keys expire after `ttl` seconds.
+    """
+
+    prefix = 'nti.app.analytics.dedupe/'
+
+    def __init__(self, ttl=DEFAULT_DEDUPE_WINDOW, redis=None):
+        self.ttl = ttl
+        self._redis = redis
+
+    @property
+    def redis(self):
+        if self._redis is None:
+            return component.getUtility(IRedisClient)
+        return self._redis
+
+    def seen(self, keys):
+        keys = list(keys)
+        if not keys:
+            return set()
+        pipe = self.redis.pipeline()
+        for key in keys:
+            pipe.exists(self.prefix + key)
+        return {key for key, found in zip(keys, pipe.execute()) if found}
+
+    def mark(self, keys):
+        pipe = self.redis.pipeline()
+        for key in keys:
+            pipe.setex(self.prefix + key, self.ttl, 1)
+        pipe.execute()
+
+
+class BatchDeduplicator(object):
+    """
+    Filters a user's (streamed) externalized events, dropping those with
+    a client batch or event id we have already ingested. Lookups are made
+    in chunks, so a shared store costs a round-trip per chunk rather than
+    per event.
+
+    A batch id sent with the request (rather than the body) can be
+    checked (:meth:`batch_seen`) before the body is read. One in the body
+    may follow the events, so whether the batch was already ingested is
+    then only asked (:meth:`is_resent`) once the events have been read,
+    before any is handled. The ids of accepted events are only recorded
+    once the transaction commits, so a failed batch may be resent in
+    full.
+    """
+
+    chunk_size = 100
+
+    #: Whether our batch was found to be resent.
+    resent = False
+
+    def __init__(self, username, get_batch_id, store=None):
+        self.username = username
+        self.get_batch_id = get_batch_id
+        self.duplicate_count = 0
+        self._store = store
+        self._pending = set()
+
+    @property
+    def store(self):
+        if self._store is None:
+            self._store = component.queryUtility(IEventDedupeStore)
+        return self._store
+
+    def _key(self, kind, ident):
+        return u'%s/%s/%s' % (self.username, kind, six.text_type(ident))
+
+    def _batch_key(self):
+        batch_id = self.get_batch_id()
+        return self._key(u'batch', batch_id) if batch_id else None
+
+    def _filter_chunk(self, chunk):
+        keys = {}
+        for event in chunk:
+            if not isinstance(event, Mapping):
+                # Malformed; left for the internalizer to count
+                continue
+            event_id = event.pop(CLIENT_EVENT_ID, None)
+            if event_id is not None:
+                keys[id(event)] = self._key(u'event', event_id)
+        seen = self.store.seen(set(keys.values()) - self._pending)
+        for event in chunk:
+            key = keys.get(id(event))
+            if key is not None:
+                # Includes duplicates within the batch
+                if key in seen or key in self._pending:
+                    self.duplicate_count += 1
+                    continue
+                self._pending.add(key)
+            yield event
+
+    def _iter_chunks(self, events):
+        chunk = []
+        for event in events:
+            chunk.append(event)
+            if len(chunk) >= self.chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def filter(self, events):
+        if self.store is None:
+            for event in events:
+                yield event
+            return
+
+        for chunk in self._iter_chunks(events):
+            for event in self._filter_chunk(chunk):
+                yield event
+
+    def batch_seen(self):
+        """
+        Return whether our batch id, if any, was already ingested.
+        """
+        if self.store is None:
+            return False
+        batch_key = self._batch_key()
+        return batch_key is not None and bool(self.store.seen((batch_key,)))
+
+    def is_resent(self, count):
+        """
+        Return whether the batch, whose body must have been read, was
+        already ingested. If so, its `count` (filtered) events are
+        counted as duplicates.
+        """
+        if not self.batch_seen():
+            return False
+        logger.info('Dropping resent analytics batch (%s)', self._batch_key())
+        self.resent = True
+        self.duplicate_count += count
+        self._pending.clear()
+        return True
+
+    def _mark(self, success):
+        if not success:
+            return
+        keys = list(self._pending)
+        batch_key = self._batch_key()
+        if batch_key is not None:
+            keys.append(batch_key)
+        try:
+            self.store.mark(keys)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Could not record ingested analytics ids')
+
+    def mark_after_commit(self):
+        """
+        Record our batch and accepted event ids once the current
+        transaction commits.
+        """
+        if self.store is not None:
+            transaction.get().addAfterCommitHook(self._mark)
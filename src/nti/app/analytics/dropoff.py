@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Video drop-off and completion computations, vectorized with NumPy when
+it is installed (the ``numpy`` extra), else in pure Python with the same
+results.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+from bisect import bisect_left
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def _bucket_bounds(video_duration, bucket_count):
+    # The upper bounds of all but the last bucket
+    return [video_duration * (idx / bucket_count)
+            for idx in range(1, bucket_count)]
+
+
+def drop_off_counts(video_duration, session_end_times, bucket_count=4):
+    """
+    Return the count of sessions whose furthest point watched falls in
+    each of `bucket_count` equal parts of the video. A point on the
+    boundary of two parts falls in the first.
+    """
+    bounds = _bucket_bounds(video_duration, bucket_count)
+    if numpy is not None:
+        end_times = numpy.asarray(session_end_times, dtype=float)
+        buckets = numpy.searchsorted(bounds, end_times, side='left')
+        return numpy.bincount(buckets, minlength=bucket_count).tolist()
+
+    result = [0] * bucket_count
+    for end_time in session_end_times:
+        result[bisect_left(bounds, end_time)] += 1
+    return result
+
+
+def completed_count(threshold, user_view_times, user_end_times):
+    """
+    Return the count of users whose total view time, and furthest point
+    watched, both reach the threshold.
+    """
+    if numpy is not None:
+        view_times = numpy.asarray(user_view_times, dtype=float)
+        end_times = numpy.asarray(user_end_times, dtype=float)
+        return int(numpy.count_nonzero((view_times >= threshold)
+                                       & (end_times >= threshold)))
+
+    return sum(1 for view_time, end_time in zip(user_view_times, user_end_times)
+               if view_time >= threshold and end_time >= threshold)
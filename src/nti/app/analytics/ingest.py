@@ -0,0 +1,482 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Helpers for ingesting batches of externalized analytics events.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import zlib
+
+from collections import OrderedDict
+
+from perfmetrics import statsd_client
+
+from zope import component
+from zope import interface
+
+from zope.component.hooks import site as current_site
+from zope.component.hooks import getSite
+
+from zope.event import notify
+
+from zope.intid.interfaces import IIntIds
+
+from zope.schema.interfaces import ValidationError
+
+from nti.analytics import QUEUE_NAMES
+
+from nti.analytics import get_factory
+
+from nti.analytics.interfaces import IAnalyticsProgressEvent
+
+from nti.app.analytics.cache import LRUCache
+
+from nti.app.analytics.interfaces import IProgressUpdateDispatcher
+
+from nti.app.analytics.rollup import rewind_activity_rollups
+
+from nti.app.analytics.stats_cache import mark_activity_stored
+
+from nti.asynchronous.job import create_job
+
+from nti.contenttypes.completion.interfaces import UserProgressUpdatedEvent
+from nti.contenttypes.completion.interfaces import ICompletionContextProvider
+
+from nti.contenttypes.courses.interfaces import ICourseInstance
+
+from nti.externalization import internalization
+
+from nti.externalization.interfaces import StandardExternalFields
+
+from nti.dataserver.users.users import User
+
+from nti.ntiids.ntiids import find_object_with_ntiid
+
+from nti.site.hostpolicy import get_host_site
+
+CLASS = StandardExternalFields.CLASS
+MIMETYPE = StandardExternalFields.MIMETYPE
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def _get_group_key(event):
+    return event.get(MIMETYPE) or event.get(CLASS)
+
+
+class BulkEventInternalizer(object):
+    """
+    Internalizes a batch of externalized analytics events.
+
+    Events are keyed by MimeType so that the factory (and what we learn
+    about the objects it creates) is resolved once per MimeType instead of
+    once per event. Events are consumed lazily, so they may be streamed in
+    from the request body. Malformed events are logged and counted, but
+    never abort the batch.
+    """
+
+    def __init__(self, remote_username):
+        self.remote_username = remote_username
+        self.total_count = 0
+        self.malformed_count = 0
+        self.resource_to_root_context = set()
+        self._factories = {}
+        self._progress_types = {}
+
+    def _malformed_factory(self, event):
+        logger.warning('Malformed events received (mime_type=%s) (event=%s)',
+                       event.get(MIMETYPE), event)
+        self.malformed_count += 1
+
+    def _get_factory(self, key, event):
+        """
+        Resolve the factory for the event, once per key. Events we
+        cannot key have their factory resolved one-by-one.
+        """
+        if key is None:
+            return internalization.find_factory_for(event)
+        try:
+            return self._factories[key]
+        except KeyError:
+            result = self._factories[key] = internalization.find_factory_for(event)
+            return result
+
+    def _is_progress_event(self, key, new_event):
+        # Every object built by a factory provides the same interfaces,
+        # so we only need to check once per key.
+        try:
+            return self._progress_types[key]
+        except KeyError:
+            result = IAnalyticsProgressEvent.providedBy(new_event)
+            if key is not None:
+                self._progress_types[key] = result
+            return result
+
+    def _internalize(self, factory, event):
+        """
+        Build and validate a single event, returning None if malformed.
+        """
+        new_event = factory()
+        try:
+            internalization.update_from_external_object(new_event, event)
+        except (ValidationError, ValueError) as e:
+            # The app may resend events if we err; so we should just log.
+            # String values in int fields throw ValueErrors instead of validation
+            # errors.
+            logger.warning('Malformed events received (event=%s) (%s)', event, e)
+            self.malformed_count += 1
+            return None
+
+        if new_event.user != self.remote_username:
+            # This shouldn't happen.
+            logger.warning(
+                'Analytics event username does not match remote user (event=%s) (%s)',
+                new_event.user, self.remote_username
+            )
+            new_event.user = self.remote_username
+        duration = getattr(new_event, 'Duration', None)
+        if duration is not None and duration < 0:
+            logger.warn('Negative duration on event (%s) (%s)',
+                        duration, event)
+        return new_event
+
+    def iter_events(self, events):
+        """
+        Lazily internalize the given externalized events, yielding the valid
+        event objects in the order they were received.
+        """
+        for event in events:
+            self.total_count += 1
+            key = _get_group_key(event)
+            factory = self._get_factory(key, event)
+            if factory is None:
+                self._malformed_factory(event)
+                continue
+
+            new_event = self._internalize(factory, event)
+            if new_event is None:
+                continue
+            if self._is_progress_event(key, new_event):
+                self.resource_to_root_context.add((new_event.ResourceId,
+                                                   new_event.RootContextID))
+            yield new_event
+
+    def __call__(self, events):
+        """
+        Internalize the given externalized events, returning the list of
+        valid event objects.
+        """
+        return list(self.iter_events(events))
+
+
+def internalize_events(events, remote_username):
+    """
+    Internalize the externalized `events` for the given user.
+
+    Returns a tuple of the valid internalized events, the malformed
+    event count and the set of (ResourceId, RootContextID) pairs for
+    which progress may have changed.
+    """
+    internalizer = BulkEventInternalizer(remote_username)
+    batch_events = internalizer(events)
+    return (batch_events,
+            internalizer.malformed_count,
+            internalizer.resource_to_root_context)
+
+
+#: Root context NTIID (by site) to intid, shared across requests. A handful
+#: of courses account for nearly every event we receive.
+_ROOT_CONTEXT_INTIDS = LRUCache(maxsize=1000, ttl=60 * 60)
+
+
+class ProgressNTIIDResolver(object):
+    """
+    Resolves the NTIIDs referenced by a single batch of events, so that
+    each resource and root context is looked up once per batch. Root
+    contexts are also remembered across requests by intid, which is much
+    cheaper to resolve than an NTIID.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._objects = {}
+        self._completion_contexts = {}
+
+    @property
+    def _intids(self):
+        return component.getUtility(IIntIds)
+
+    def _find_object(self, ntiid):
+        try:
+            result = self._objects[ntiid]
+            self.hits += 1
+        except KeyError:
+            self.misses += 1
+            result = self._objects[ntiid] = find_object_with_ntiid(ntiid)
+        return result
+
+    def resource(self, ntiid):
+        return self._find_object(ntiid) if ntiid else None
+
+    def root_context(self, ntiid):
+        if not ntiid:
+            return None
+        if ntiid in self._objects:
+            return self._find_object(ntiid)
+        site = getSite()
+        key = (getattr(site, '__name__', None), ntiid)
+        intid = _ROOT_CONTEXT_INTIDS.get(key)
+        if intid is not None:
+            result = self._intids.queryObject(intid)
+            if result is not None:
+                self.hits += 1
+                self._objects[ntiid] = result
+                return result
+        result = self._find_object(ntiid)
+        intid = self._intids.queryId(result) if result is not None else None
+        if intid is not None:
+            _ROOT_CONTEXT_INTIDS.set(key, intid)
+        return result
+
+    def completion_context(self, root_context_ntiid):
+        """
+        Return the completion context for the given root context NTIID,
+        or None (e.g. for books, which do not have completion).
+        """
+        try:
+            return self._completion_contexts[root_context_ntiid]
+        except KeyError:
+            pass
+        root_context = self.root_context(root_context_ntiid)
+        context_provider = ICompletionContextProvider(root_context, None)
+        result = context_provider() if context_provider else None
+        self._completion_contexts[root_context_ntiid] = result
+        return result
+
+    def record_stats(self):
+        statsd = statsd_client()
+        if statsd is not None:
+            if self.hits:
+                statsd.incr('nti.analytics.ingest.resolver.hit', self.hits)
+            if self.misses:
+                statsd.incr('nti.analytics.ingest.resolver.miss', self.misses)
+
+
+def coalesce_progress_updates(resource_to_root_context, resolver=None):
+    """
+    Resolve the (ResourceId, RootContextID) pairs, returning an ordered
+    mapping of completion context to the distinct resource objects that
+    may have progress updates in that context. Several root contexts (e.g.
+    a course and its catalog entry) may map to the same completion
+    context; each resource is only returned once per context.
+    """
+    resolver = ProgressNTIIDResolver() if resolver is None else resolver
+    result = OrderedDict()
+    contexts = {}
+    for resource_ntiid, root_context_ntiid in sorted(resource_to_root_context,
+                                                     key=lambda x: (x[1] or '', x[0] or '')):
+        completion_context = resolver.completion_context(root_context_ntiid)
+        resource_obj = resolver.resource(resource_ntiid) \
+                       if completion_context is not None else None
+        if resource_obj is None:
+            logger.info("Could not find course from (%s) (%s)",
+                        resource_ntiid, root_context_ntiid)
+            continue
+        context_key = id(completion_context)
+        if context_key not in result:
+            contexts[context_key] = completion_context
+            result[context_key] = OrderedDict()
+        result[context_key].setdefault(id(resource_obj), resource_obj)
+    return OrderedDict((contexts[key], tuple(resources.values()))
+                       for key, resources in result.items())
+
+
+def notify_progress_updates(user, resource_to_root_context):
+    """
+    Broadcast to interested parties that progress may have updated for
+    certain objects within certain contexts.
+    """
+    resolver = ProgressNTIIDResolver()
+    updates = coalesce_progress_updates(resource_to_root_context, resolver)
+    for completion_context, resources in updates.items():
+        for resource_obj in resources:
+            notify(UserProgressUpdatedEvent(resource_obj,
+                                            user,
+                                            completion_context))
+    resolver.record_stats()
+
+
+@interface.implementer(IProgressUpdateDispatcher)
+class SynchronousProgressDispatcher(object):
+    """
+    Notifies progress updates in-line, before the request returns.
+    """
+
+    def dispatch(self, user, resource_to_root_context):
+        notify_progress_updates(user, resource_to_root_context)
+
+
+def _process_queued_progress_updates(username, site_name, resource_to_root_context):
+    """
+    The job that notifies queued progress updates, run by the analytics
+    queue processor.
+    """
+    user = User.get_user(username)
+    if user is None:
+        logger.info('User no longer exists for progress updates (%s)', username)
+        return
+
+    site = None
+    if site_name:
+        try:
+            site = get_host_site(site_name)
+        except LookupError:
+            logger.warning('Cannot find site for progress updates (%s)', site_name)
+            return
+    if site is None:
+        notify_progress_updates(user, resource_to_root_context)
+    else:
+        with current_site(site):
+            notify_progress_updates(user, resource_to_root_context)
+
+
+@interface.implementer(IProgressUpdateDispatcher)
+class QueuedProgressDispatcher(object):
+    """
+    Pushes the de-duplicated progress updates onto the analytics job
+    queues, to be notified by the queue processor, so that the request
+    does not wait on (potentially expensive) completion subscribers.
+
+    This is opt-in; register this utility in place of the
+    :class:`SynchronousProgressDispatcher`.
+    """
+
+    def _get_queue_name(self, username):
+        # Keep a user's updates on the same queue so they run in order.
+        idx = zlib.crc32(username.encode('utf-8')) % len(QUEUE_NAMES)
+        return QUEUE_NAMES[idx]
+
+    def dispatch(self, user, resource_to_root_context):
+        if not resource_to_root_context:
+            return
+        username = user.username
+        site_name = getattr(getSite(), '__name__', None)
+        updates = tuple(sorted(resource_to_root_context,
+                               key=lambda x: (x[1] or '', x[0] or '')))
+        job = create_job(_process_queued_progress_updates,
+                         username,
+                         site_name,
+                         updates)
+        queue = get_factory().get_queue(self._get_queue_name(username))
+        queue.put(job)
+        logger.debug('Queued progress updates (user=%s) (count=%s)',
+                     username, len(updates))
+
+
+def dispatch_progress_updates(user, resource_to_root_context):
+    """
+    Dispatch progress updates through the registered
+    :class:`IProgressUpdateDispatcher`, notifying in-line by default.
+    """
+    dispatcher = component.queryUtility(IProgressUpdateDispatcher)
+    if dispatcher is None:
+        dispatcher = SynchronousProgressDispatcher()
+    dispatcher.dispatch(user, resource_to_root_context)
+
+
+def record_events_stored(user, events):
+    """
+    Record that the user's events, the given (root context NTIID,
+    timestamp) pairs, were stored: the version of the stats of the user
+    and of those root contexts changes, and their activity rollups (and
+    the site's) fold in the days of late events again.
+    """
+    timestamps = []
+    by_ntiid = {}
+    for ntiid, timestamp in events:
+        if ntiid:
+            by_ntiid.setdefault(ntiid, [])
+        if timestamp:
+            timestamps.append(timestamp)
+            if ntiid:
+                by_ntiid[ntiid].append(timestamp)
+
+    contexts = [user]
+    for ntiid in sorted(by_ntiid):
+        context = find_object_with_ntiid(ntiid)
+        context = ICourseInstance(context, context)
+        if context is not None:
+            contexts.append(context)
+    mark_activity_stored(contexts)
+
+    rewinds = [(user, timestamps), (None, timestamps)]
+    rewinds.extend(sorted(by_ntiid.items()))
+    rewind_activity_rollups(rewinds)
+
+
+def _process_stored_events(queue_names, username, site_name, events):
+    """
+    The job run once the events of a batch are stored, hopping through
+    the given analytics queues first. Each queue is processed in order,
+    so the job runs on each one behind the jobs storing the batch's
+    events there.
+    """
+    if queue_names:
+        _queue_stored_events(queue_names, username, site_name, events)
+        return
+
+    user = User.get_user(username)
+    if user is None:
+        logger.info('User no longer exists for stored events (%s)', username)
+        return
+
+    site = None
+    if site_name:
+        try:
+            site = get_host_site(site_name)
+        except LookupError:
+            logger.warning('Cannot find site for stored events (%s)', site_name)
+            return
+    if site is None:
+        record_events_stored(user, events)
+    else:
+        with current_site(site):
+            record_events_stored(user, events)
+
+
+def _queue_stored_events(queue_names, username, site_name, events):
+    job = create_job(_process_stored_events,
+                     tuple(queue_names[1:]),
+                     username,
+                     site_name,
+                     events)
+    get_factory().get_queue(queue_names[0]).put(job)
+
+
+def queue_stored_events(user, events):
+    """
+    Queue a job for when the given (handled) events of the user are
+    stored by the analytics queue processor. The events are stored by
+    jobs on any of the analytics queues, so the job goes through all of
+    them in turn.
+    """
+    if not events:
+        return
+    site_name = getattr(getSite(), '__name__', None)
+    events = {
+        (getattr(x, 'RootContextID', None) or u'', getattr(x, 'timestamp', None))
+        for x in events
+    }
+    events = tuple(sorted(events, key=lambda x: (x[0], x[1] or 0)))
+    try:
+        _queue_stored_events(QUEUE_NAMES, user.username, site_name, events)
+    except Exception as e:  # pylint: disable=broad-except
+        # The events are stored regardless; their stats change later
+        logger.warning('Could not queue stored events job (%s) (%s)',
+                       user.username, e)
@@ -57,3 +57,64 @@ class IAnalyticsContextACLProvider(interface.Interface):
         """
         A set of aces that should be added to the workspaces acl
         """
+
+
+class IProgressUpdateDispatcher(interface.Interface):
+    """
+    A utility that broadcasts that a user's progress may have changed on
+    resources within root contexts, once a batch of events has been
+    processed.
+    """
+
+    def dispatch(user, resource_to_root_context):
+        """
+        Dispatch progress updates for the `user` and the iterable of
+        (resource ntiid, root context ntiid) pairs.
+        """
+
+
+class IIngestRateLimiter(interface.Interface):
+    """
+    A utility that limits how often each user may send analytics.
+    """
+
+    rate = interface.Attribute(u"The sustained requests per second allowed.")
+
+    capacity = interface.Attribute(u"The requests a user may burst above the rate.")
+
+    def consume(key, cost=1):
+        """
+        Take `cost` tokens from the bucket for `key`, returning zero if
+        allowed, or else the seconds to wait before trying again.
+        """
+
+
+class IEventDedupeStore(interface.Interface):
+    """
+    A utility that remembers, for a bounded window of time, the batch and
+    event ids of analytics we have already ingested.
+    """
+
+    def seen(keys):
+        """
+        Return the set of the given keys we have already recorded.
+        """
+
+    def mark(keys):
+        """
+        Record the given keys.
+        """
+
+
+class IStatsResultCache(interface.Interface):
+    """
+    A utility that caches the (JSON-able) results of stats queries, so
+    concurrent computations of the same result run once.
+    """
+
+    def get_or_compute(scope, key, compute, expires):
+        """
+        Return the result cached for `key` in `scope`, or else the result
+        of calling `compute`, cached until `expires` (in seconds since the
+        epoch).
+        """
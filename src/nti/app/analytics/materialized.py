@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Course usage stat aggregates, read from the analytics database and held
+in memory for a short while.
+
+Aggregates are not persisted: doing so from reads would have every
+dashboard load write (and conflict) in the object database, and folding
+rows up to a row id watermark misses the updates (e.g. video heartbeats
+filling in end times) and deletions of rows already folded. Each process
+instead holds the results of its most recently read courses for
+`REFRESH_SECONDS`, dropping them sooner when it processes a batch of
+events for the course. Other processes may serve their results for up
+to `REFRESH_SECONDS` after. This is a short-lived cache, not a
+materialization: every miss reads all of the course's events.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+from nti.app.analytics.aggregation import get_video_view_aggregates
+from nti.app.analytics.aggregation import get_resource_view_aggregates
+
+from nti.app.analytics.cache import LRUCache
+
+#: Aggregate kind for video watch events.
+VIDEO_VIEWS = u'video_views'
+
+#: Aggregate kind for resource view events.
+RESOURCE_VIEWS = u'resource_views'
+
+#: The aggregate query of each kind.
+AGGREGATE_QUERIES = {
+    VIDEO_VIEWS: get_video_view_aggregates,
+    RESOURCE_VIEWS: get_resource_view_aggregates,
+}
+
+#: Seconds we serve a course's aggregates from memory, absent new events.
+REFRESH_SECONDS = 60
+
+#: Aggregates, by course ntiid and kind.
+_aggregate_cache = LRUCache(maxsize=20, ttl=REFRESH_SECONDS)
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def get_course_aggregates(course, kind):
+    """
+    Return the :class:`~nti.app.analytics.aggregation.AggregateRow` of
+    every event of the given kind in the course, or None if the course
+    is unknown to the analytics database.
+    """
+    ntiid = getattr(course, 'ntiid', None)
+    cache_key = (ntiid, kind) if ntiid else None
+    result = _aggregate_cache.get(cache_key) if cache_key else None
+    if result is None:
+        result = AGGREGATE_QUERIES[kind](course)
+        if result is not None and cache_key:
+            _aggregate_cache.set(cache_key, result)
+    return result
+
+
+def invalidate_course_aggregates(ntiids):
+    """
+    Drop the in-memory aggregates of the given course ntiids, so that
+    their next read picks up new events.
+    """
+    for ntiid in ntiids:
+        for kind in AGGREGATE_QUERIES:
+            _aggregate_cache.invalidate((ntiid, kind))
@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Resolving user progress in bulk, with as few analytics database queries
+as we can.
+
+The bulk functions remember the user's views, and the progress they
+compute, on the current request; the per-item progress adapters of
+:mod:`nti.app.analytics.completion` then read from there.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import time
+
+from datetime import datetime
+
+from collections import defaultdict
+
+from six.moves.urllib_parse import urldefrag
+
+from pyramid.threadlocal import get_current_request
+
+from sqlalchemy import or_
+from sqlalchemy import func
+
+from nti.analytics.database import get_analytics_db
+
+from nti.analytics.database.resource_views import VideoEvents
+from nti.analytics.database.resource_views import ResourceViews
+
+from nti.analytics.database.root_context import get_root_context_id
+
+from nti.analytics.progress import get_progress_for_video_views
+from nti.analytics.progress import get_video_progress_for_course
+from nti.analytics.progress import get_progress_for_resource_views
+from nti.analytics.progress import get_progress_for_resource_container
+
+from nti.analytics.resource_views import get_resource_views
+
+from nti.analytics_database.resources import Resources
+
+from nti.analytics_database.users import Users
+
+from nti.app.analytics.aggregation import get_row_id_column
+from nti.app.analytics.aggregation import EVENT_UPDATE_SECONDS
+
+from nti.contentlibrary.interfaces import IContentUnit
+
+from nti.contenttypes.courses.utils import get_course_packages
+
+from nti.contenttypes.presentation.interfaces import INTIRelatedWorkRef
+from nti.contenttypes.presentation.interfaces import IPresentationAssetContainer
+
+from nti.ntiids.ntiids import find_object_with_ntiid
+
+#: The request environ key of the progress computed in bulk
+REQUEST_CACHE_KEY = 'nti.app.analytics.progress'
+
+#: Past this many changed videos, the progress of every video in the
+#: course is read at once instead of one video at a time
+MAX_VIDEOS_READ_SEPARATELY = 10
+
+#: Marker for unresolved ref targets
+_MISSING = object()
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def get_video_ntiids_viewed_after(user, course, event_id=0, now=None):
+    """
+    Return a tuple of the NTIIDs of the videos the user has events for in
+    the course stored after the given event (row) id, and the id of the
+    last of the events read (or `event_id` if there are none). The NTIIDs
+    are None if the course is unknown to the analytics database.
+
+    Event ids follow the order events are stored in, not their (client)
+    timestamps, so events uploaded late (e.g. by offline clients) are
+    still found. Events keep their id when updated (e.g. by heartbeats),
+    which they may be for `EVENT_UPDATE_SECONDS`; the videos with events
+    that recent are always returned. Ids are not committed in order
+    either: an event whose id precedes the returned one, committed only
+    after this read, is found if it is that recent, and otherwise only
+    by reading from 0 again.
+    """
+    db = get_analytics_db()
+    root_context_id = get_root_context_id(db, course)
+    if root_context_id is None:
+        return None, event_id
+    now = time.time() if now is None else now
+    updated = datetime.utcfromtimestamp(now - EVENT_UPDATE_SECONDS)
+    row_id = get_row_id_column(VideoEvents)
+    query = db.session.query(Resources.resource_ds_id, func.max(row_id)) \
+                      .join(VideoEvents, VideoEvents.resource_id == Resources.resource_id) \
+                      .join(Users, Users.user_id == VideoEvents.user_id) \
+                      .filter(VideoEvents.course_id == root_context_id,
+                              Users.username == user.username,
+                              or_(row_id > event_id,
+                                  VideoEvents.timestamp >= updated)) \
+                      .group_by(Resources.resource_ds_id)
+    ntiids = []
+    for ntiid, max_row_id in query:
+        ntiids.append(ntiid)
+        event_id = max(event_id, max_row_id)
+    return ntiids, event_id
+
+
+def get_video_progress_after(user, course, event_id=0):
+    """
+    Return a tuple of the progress of the user on each video in the
+    course with events stored (or updated) after the given event id, and
+    the id of the last event read. Only those videos' progress is
+    computed: one video at a time, or, past
+    `MAX_VIDEOS_READ_SEPARATELY` videos, from one read of the user's
+    video views in the course.
+    """
+    result = []
+    ntiids, event_id = get_video_ntiids_viewed_after(user, course, event_id)
+    if not ntiids:
+        return result, event_id
+    if len(ntiids) > MAX_VIDEOS_READ_SEPARATELY:
+        ntiids = set(ntiids)
+        result = [x for x in get_video_progress_for_course(user, course) or ()
+                  if x.NTIID in ntiids]
+        return result, event_id
+    container = IPresentationAssetContainer(course, None)
+    for ntiid in ntiids:
+        video = container.get(ntiid) if container is not None else None
+        if video is None:
+            video = find_object_with_ntiid(ntiid)
+        progress = get_progress_for_video_views(ntiid, video, user, course)
+        if progress is not None:
+            result.append(progress)
+    return result, event_id
+
+
+def _has_href_fragment(node, children):
+    def _has_frag(node):
+        return urldefrag(node.href)[1]
+
+    # A fragment if we have a frag or if any of our children do
+    return bool(_has_frag(node)
+                or _has_frag(next(iter(children))))
+
+
+def is_page_container(node):
+    """
+    Whether the content unit is a container of pages (progress is
+    then the pages viewed).
+    """
+    # Node is only page container if it has children and
+    # does not have a fragment in its href.
+    children = getattr(node, 'children', None)
+    return bool(children and not _has_href_fragment(node, children))
+
+
+def get_resource_views_by_ntiid(user, course):
+    """
+    Return a map of resource NTIID to the user's views of it in the
+    course, read in one query.
+    """
+    result = defaultdict(list)
+    for view in get_resource_views(root_context=course, user=user) or ():
+        result[view.ResourceId].append(view)
+    return result
+
+
+def get_resource_views_for_ntiids(user, course, ntiids):
+    """
+    Return a map of each of the given resource NTIIDs to the user's
+    views of it in the course, read in one query (e.g. for a page
+    container and its pages).
+    """
+    result = defaultdict(list)
+    if not ntiids:
+        return result
+    db = get_analytics_db()
+    resource_ids = db.session.query(Resources.resource_id) \
+                             .filter(Resources.resource_ds_id.in_(tuple(ntiids))) \
+                             .subquery()
+    views = get_resource_views(root_context=course, user=user,
+                               filters=(ResourceViews.resource_id.in_(resource_ids),))
+    for view in views or ():
+        result[view.ResourceId].append(view)
+    return result
+
+
+class ProgressCache(object):
+    """
+    The resource views of a user in a course, and the progress computed
+    from them, for the rest of a request.
+    """
+
+    def __init__(self, views_by_ntiid):
+        self.views_by_ntiid = views_by_ntiid
+        self.progress = {}
+
+
+def _cache_key(user, course):
+    return (user.username, getattr(course, 'ntiid', None) or id(course))
+
+
+def get_request_progress_cache(user, course, create=False):
+    """
+    Return the :class:`ProgressCache` of the user in the course on the
+    current request, creating it (reading the user's views) if asked.
+    Returns None if there is no request, or no cache and we are not
+    asked to create it.
+    """
+    request = get_current_request()
+    if request is None:
+        return None
+    caches = request.environ.get(REQUEST_CACHE_KEY)
+    if caches is None:
+        if not create:
+            return None
+        caches = request.environ[REQUEST_CACHE_KEY] = {}
+    key = _cache_key(user, course)
+    result = caches.get(key)
+    if result is None and create:
+        result = caches[key] = ProgressCache(get_resource_views_by_ntiid(user, course))
+    return result
+
+
+def get_progress_cache(user, course):
+    """
+    Return the :class:`ProgressCache` of the user in the course on the
+    current request, reading the user's views once per request (or per
+    call, outside of a request).
+    """
+    result = get_request_progress_cache(user, course, create=True)
+    if result is None:
+        # Outside of a request, only for this call
+        result = ProgressCache(get_resource_views_by_ntiid(user, course))
+    return result
+
+
+def get_content_progress(user, content_unit, course, views_by_ntiid):
+    """
+    Return the :class:`IProgress` of the user on the content unit, given
+    a map of (at least) the unit's and its pages' NTIIDs to the user's
+    views of them.
+    """
+    content_ntiid = content_unit.ntiid
+    if is_page_container(content_unit):
+        # TODO: Some clients might be sending in view events for the container
+        # itself instead of the first page.  We add that in, even through it
+        # might disturb the accuracy of our results.
+        child_views_dict = {}
+        child_views_dict[content_ntiid] = views_by_ntiid.get(content_ntiid) or []
+        for child in content_unit.children:
+            child_views_dict[child.ntiid] = views_by_ntiid.get(child.ntiid) or []
+        result = get_progress_for_resource_container(content_ntiid,
+                                                     child_views_dict,
+                                                     content_unit,
+                                                     user,
+                                                     course)
+    else:
+        result = get_progress_for_resource_views(content_ntiid,
+                                                 views_by_ntiid.get(content_ntiid) or [],
+                                                 content_unit,
+                                                 user,
+                                                 course)
+    return result
+
+
+def _iter_content_units(units):
+    for unit in units:
+        yield unit
+        for child in _iter_content_units(getattr(unit, 'children', None) or ()):
+            yield child
+
+
+def get_course_content_progress(user, course, content_units=None):
+    """
+    Return a map of content unit NTIID to the :class:`IProgress` of the
+    user, for each of the given content units (by default, every unit in
+    the course's packages) the user has viewed, or viewed a page of.
+    The user's views are read once, in one query.
+    """
+    result = {}
+    views_by_ntiid = get_progress_cache(user, course).views_by_ntiid
+    if not views_by_ntiid:
+        return result
+    if content_units is None:
+        content_units = _iter_content_units(get_course_packages(course))
+    for unit in content_units:
+        ntiids = [unit.ntiid]
+        if is_page_container(unit):
+            ntiids.extend(x.ntiid for x in unit.children)
+        if not any(x in views_by_ntiid for x in ntiids):
+            continue
+        progress = get_content_progress(user, unit, course, views_by_ntiid)
+        if progress is not None:
+            result[unit.ntiid] = progress
+    return result
+
+
+def _related_work_ref_progress(user, ref, course, views_by_ntiid, targets):
+    target = None
+    target_ntiid = getattr(ref, 'target', '')
+    if target_ntiid:
+        target = targets.get(target_ntiid, _MISSING)
+        if target is _MISSING:
+            target = targets[target_ntiid] = find_object_with_ntiid(target_ntiid)
+    if IContentUnit.providedBy(target):
+        # We want to handle readings particularly
+        return get_content_progress(user, target, course, views_by_ntiid)
+    return get_progress_for_resource_views(ref.ntiid,
+                                           views_by_ntiid.get(ref.ntiid) or [],
+                                           ref,
+                                           user,
+                                           course)
+
+
+def get_related_work_refs_progress(user, refs, course):
+    """
+    Return a map of related work ref NTIID to the :class:`IProgress` of
+    the user on it (or its target reading). The user's views are read
+    once, in one query, and each target is resolved once.
+    """
+    result = {}
+    cache = get_progress_cache(user, course)
+    targets = {}
+    for ref in refs:
+        ntiid = ref.ntiid
+        progress = cache.progress.get(ntiid, _MISSING)
+        if progress is _MISSING:
+            progress = cache.progress[ntiid] = \
+                _related_work_ref_progress(user, ref, course,
+                                           cache.views_by_ntiid, targets)
+        result[ntiid] = progress
+    return result
+
+
+def _iter_lesson_refs(lesson):
+    for group in getattr(lesson, 'Items', None) or ():
+        for item in getattr(group, 'Items', None) or ():
+            if INTIRelatedWorkRef.providedBy(item):
+                yield item
+
+
+def get_lesson_related_work_progress(user, lesson, course):
+    """
+    Return a map of related work ref NTIID to the :class:`IProgress` of
+    the user, for each related work ref in the lesson overview.
+    """
+    return get_related_work_refs_progress(user, _iter_lesson_refs(lesson), course)
+
+
+def get_course_related_work_progress(user, course):
+    """
+    Return a map of related work ref NTIID to the :class:`IProgress` of
+    the user, for each related work ref in the course.
+    """
+    container = IPresentationAssetContainer(course, None)
+    refs = [x for x in container.values() if INTIRelatedWorkRef.providedBy(x)] \
+        if container is not None else ()
+    return get_related_work_refs_progress(user, refs, course)
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Rate limiting and backpressure for analytics ingestion.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import math
+import time
+import threading
+
+from zope import component
+from zope import interface
+
+from nti.analytics import QUEUE_NAMES
+
+from nti.analytics import get_factory
+
+from nti.app.analytics.cache import LRUCache
+
+from nti.app.analytics.interfaces import IIngestRateLimiter
+
+from nti.dataserver.interfaces import IRedisClient
+
+#: Sustained requests per second allowed for a single user.
+DEFAULT_RATE = 20
+
+#: The number of requests a single user may burst above the rate.
+DEFAULT_CAPACITY = 120
+
+#: Total queued analytics jobs beyond which we ask clients to back off.
+DEFAULT_QUEUE_THRESHOLD = 100000
+
+#: Seconds clients should wait when the queues are backed up.
+DEFAULT_QUEUE_RETRY_AFTER = 60
+
+#: Seconds we trust a sampled queue length.
+QUEUE_SAMPLE_INTERVAL = 5
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def _take(tokens, updated, now, rate, capacity, cost):
+    """
+    Refill a token bucket last `updated` with `tokens` and try to take
+    `cost` tokens from it, returning the new token count and the number
+    of seconds to wait (zero if the tokens were taken).
+    """
+    tokens = min(capacity, tokens + max(0, now - updated) * rate)
+    if tokens >= cost:
+        return tokens - cost, 0
+    return tokens, (cost - tokens) / rate
+
+
+class AbstractRateLimiter(object):
+    """
+    A token bucket rate limiter, keyed by (user) name.
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, capacity=DEFAULT_CAPACITY):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+
+    def consume(self, key, cost=1):
+        raise NotImplementedError()
+
+
+@interface.implementer(IIngestRateLimiter)
+class InMemoryRateLimiter(AbstractRateLimiter):
+    """
+    A rate limiter whose buckets live in this process. Buckets that have
+    not been touched in long enough to refill are dropped.
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, capacity=DEFAULT_CAPACITY, maxsize=10000):
+        super(InMemoryRateLimiter, self).__init__(rate, capacity)
+        self._lock = threading.Lock()
+        self._buckets = LRUCache(maxsize=maxsize,
+                                 ttl=self.capacity / self.rate)
+
+    def consume(self, key, cost=1):
+        now = time.time()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (self.capacity, now))
+            tokens, wait = _take(tokens, updated, now,
+                                 self.rate, self.capacity, cost)
+            self._buckets.set(key, (tokens, now))
+        return wait
+
+
+#: Refill and take from the bucket atomically; mirrors `_take`.
+_REDIS_TAKE = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local cost = tonumber(ARGV[4])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or capacity
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= cost then
+    tokens = tokens - cost
+else
+    wait = (cost - tokens) / rate
+end
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return tostring(wait)
+"""
+
+
+@interface.implementer(IIngestRateLimiter)
+class RedisRateLimiter(AbstractRateLimiter):
+    """
+    A rate limiter whose buckets are shared, through redis, by every
+    process in the cluster.
+    """
+
+    prefix = 'nti.app.analytics.ratelimit/'
+
+    def __init__(self, rate=DEFAULT_RATE, capacity=DEFAULT_CAPACITY, redis=None):
+        super(RedisRateLimiter, self).__init__(rate, capacity)
+        self._redis = redis
+
+    @property
+    def redis(self):
+        if self._redis is None:
+            return component.getUtility(IRedisClient)
+        return self._redis
+
+    def consume(self, key, cost=1):
+        wait = self.redis.eval(_REDIS_TAKE, 1, self.prefix + key,
+                               self.rate, self.capacity, time.time(), cost)
+        return float(wait)
+
+
+class QueueBackpressure(object):
+    """
+    Asks clients to back off while the analytics job queues are backed
+    up. Queue lengths are sampled at most every `interval` seconds.
+    """
+
+    def __init__(self,
+                 threshold=DEFAULT_QUEUE_THRESHOLD,
+                 retry_after=DEFAULT_QUEUE_RETRY_AFTER,
+                 interval=QUEUE_SAMPLE_INTERVAL):
+        self.threshold = threshold
+        self.retry_after = retry_after
+        self.interval = interval
+        self._sampled = None
+        self._queue_length = 0
+
+    def queue_length(self):
+        """
+        Return the (sampled) total length of the analytics queues, or
+        None if it is unknown because the queues cannot be reached.
+        """
+        now = time.time()
+        if self._sampled is None or now - self._sampled > self.interval:
+            try:
+                factory = get_factory()
+                self._queue_length = sum(len(factory.get_queue(name))
+                                         for name in QUEUE_NAMES)
+            except Exception as e:  # pylint: disable=broad-except
+                # Ingestion must not fail because redis is down; the
+                # next sample is tried after our interval.
+                logger.warning('Could not read analytics queue lengths (%s)', e)
+                self._queue_length = None
+            self._sampled = now
+        return self._queue_length
+
+    def check(self):
+        """
+        Return the seconds clients should wait before sending more
+        events, or zero.
+        """
+        if self.threshold is None:
+            return 0
+        queue_length = self.queue_length()
+        if queue_length is not None and queue_length > self.threshold:
+            logger.warning('Analytics queues backed up (length=%s) (threshold=%s)',
+                           queue_length, self.threshold)
+            return self.retry_after
+        return 0
+
+
+_BACKPRESSURE = QueueBackpressure()
+
+
+def get_retry_after(username, cost=1):
+    """
+    Return the whole seconds the given user should wait before sending
+    analytics again, or zero if the request may proceed. Tokens are only
+    taken from the user's bucket while the queues have capacity.
+    """
+    result = _BACKPRESSURE.check()
+    if not result:
+        limiter = component.queryUtility(IIngestRateLimiter)
+        if limiter is not None:
+            result = limiter.consume(username, cost)
+    return int(math.ceil(result))
+
+
+def get_queue_retry_after():
+    """
+    Return the seconds clients should currently wait because of queue
+    backpressure alone, or zero.
+    """
+    return _BACKPRESSURE.check()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Video resume information, for a single video or every video a user has
+watched in a course.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+from collections import namedtuple
+
+from sqlalchemy import func
+
+from nti.analytics.database import get_analytics_db
+
+from nti.analytics.database.resource_views import VideoEvents
+
+from nti.analytics.database.root_context import get_root_context_id
+
+from nti.analytics_database.resources import Resources
+
+from nti.analytics_database.users import Users
+
+#: The latest watch event of one video by a user.
+ResumeRow = namedtuple('ResumeRow',
+                       ('resource_id',
+                        'video_start_time',
+                        'video_end_time',
+                        'time_length',
+                        'max_duration',
+                        'timestamp'))
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def get_resume_seconds(video_start_time, video_end_time, time_length):
+    """
+    Return where to resume a video, given the latest watch event.
+
+    When a user starts watching a video we get an initial watch event
+    with a video_start_time, but no duration, and no video_end_time. If
+    they close the window or we don't get any updates for that event
+    the resume point is that starting point.
+
+    Then we start getting heartbeats. We still don't have an end_time
+    but we do get a Duration (time_length) that is the offset from the
+    start time to the playhead.
+    """
+    playhead = video_end_time
+    if not playhead:
+        playhead = video_start_time + (time_length or 0)
+    return playhead
+
+
+def get_video_resume_rows(user, course):
+    """
+    Return the :class:`ResumeRow` of the latest watch event of each
+    video the user has watched in the course, in a single (windowed)
+    query, or None if the course is unknown to the analytics database.
+    """
+    db = get_analytics_db()
+    root_context_id = get_root_context_id(db, course)
+    if root_context_id is None:
+        return None
+    row_id = list(VideoEvents.__table__.primary_key.columns)[0]
+    # Ties (e.g. heartbeats sharing a timestamp) go to the latest row
+    rank = func.row_number().over(partition_by=VideoEvents.resource_id,
+                                  order_by=(VideoEvents.timestamp.desc(),
+                                            row_id.desc()))
+    latest = db.session.query(VideoEvents.resource_id.label('resource_id'),
+                              VideoEvents.video_start_time.label('video_start_time'),
+                              VideoEvents.video_end_time.label('video_end_time'),
+                              VideoEvents.time_length.label('time_length'),
+                              VideoEvents.max_time_length.label('max_duration'),
+                              VideoEvents.timestamp.label('timestamp'),
+                              rank.label('rank')) \
+                       .join(Users, Users.user_id == VideoEvents.user_id) \
+                       .filter(VideoEvents.course_id == root_context_id,
+                               VideoEvents.video_event_type == u'WATCH',
+                               Users.username == user.username) \
+                       .subquery()
+    query = db.session.query(Resources.resource_ds_id,
+                             latest.c.video_start_time,
+                             latest.c.video_end_time,
+                             latest.c.time_length,
+                             latest.c.max_duration,
+                             latest.c.timestamp) \
+                      .join(latest, Resources.resource_id == latest.c.resource_id) \
+                      .filter(latest.c.rank == 1)
+    return [ResumeRow(*x) for x in query]
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Course audience retention curves: how many views of a video covered
+each second of it, across all users.
+
+The watched segments of every watch event are merged into a difference
+array (one entry per second of the video), held in memory per course
+and video. Events are only updated (e.g. by video heartbeats filling in
+their end time) for `EVENT_UPDATE_SECONDS` after their timestamp, so
+the segments of events from before the (UTC) day that ended then are
+folded in once, and read again only when that day moves on, also
+dropping deleted events. The other events, and any stored since the
+fold, are read on every refresh; reads within `REFRESH_SECONDS` are
+served as is.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import math
+import time
+import datetime
+
+from array import array
+
+from collections import namedtuple
+
+from zope.component.hooks import getSite
+
+from nti.app.analytics.aggregation import EVENT_UPDATE_SECONDS
+
+from nti.app.analytics.aggregation import get_video_segment_aggregates
+
+from nti.app.analytics.cache import LRUCache
+
+from nti.app.analytics.materialized import REFRESH_SECONDS
+
+#: The retention state of a video in a course. `deltas` holds the
+#: difference array of the segments of events from before `closed` (in
+#: seconds since the epoch), the greatest row id of which is
+#: `max_row_id`; `counts` the views covering each second, including
+#: every other event.
+_Retention = namedtuple('_Retention',
+                        ('deltas',
+                         'closed',
+                         'max_row_id',
+                         'counts',
+                         'checked'))
+
+_EMPTY_RETENTION = _Retention(array('l'), None, None, (), None)
+
+DAY_SECONDS = 24 * 60 * 60
+
+#: Segments are cut off past this many seconds, guarding against bad
+#: end times.
+MAX_SECONDS = 24 * 60 * 60
+
+#: Retention states, by site name, course ntiid and video ntiid.
+_RETENTION = LRUCache(maxsize=500)
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def add_segments(deltas, segments):
+    """
+    Add the given (start, end, count) segments to the difference array
+    `deltas`, growing it as needed, and return it. A segment covers
+    every second it overlaps, up to `MAX_SECONDS`.
+    """
+    for start, end, count in segments:
+        if start is None or end is None:
+            continue
+        end = min(end, MAX_SECONDS)
+        if end <= start:
+            continue
+        first = int(start)
+        last = int(math.ceil(end))
+        if len(deltas) <= last:
+            deltas.extend([0] * (last + 1 - len(deltas)))
+        deltas[first] += count
+        deltas[last] -= count
+    return deltas
+
+
+def viewer_counts(deltas):
+    """
+    Return the count of views covering each second, given a difference
+    array. The last entry only closes segments, so is dropped.
+    """
+    result = []
+    current = 0
+    for delta in deltas[:-1]:
+        current += delta
+        result.append(current)
+    return result
+
+
+def bucket_counts(counts, bucket_seconds=1):
+    """
+    Return the most views covering any second in each `bucket_seconds`
+    long part of the video.
+    """
+    if bucket_seconds <= 1:
+        return list(counts)
+    return [max(counts[idx:idx + bucket_seconds])
+            for idx in range(0, len(counts), bucket_seconds)]
+
+
+def _segments(rows):
+    return ((x.start, x.end, x.count) for x in rows)
+
+
+def _datetime(seconds):
+    return datetime.datetime.utcfromtimestamp(seconds)
+
+
+def refresh_retention(state, course, ntiid, now=None):
+    """
+    Return the given :class:`_Retention` state, updated with the events
+    of the video in the course, or None if the course is unknown to the
+    analytics database.
+    """
+    now = time.time() if now is None else now
+    closed = int((now - EVENT_UPDATE_SECONDS) // DAY_SECONDS) * DAY_SECONDS
+    deltas = state.deltas
+    max_row_id = state.max_row_id
+    if state.closed != closed:
+        rows = get_video_segment_aggregates(course, ntiid,
+                                            before=_datetime(closed))
+        if rows is None:
+            return None
+        deltas = add_segments(array('l'), _segments(rows))
+        max_row_id = max([x.max_row_id for x in rows] or [0])
+
+    # Events that may still be updated, and any stored since the fold
+    # (e.g. from offline clients)
+    rows = get_video_segment_aggregates(course, ntiid,
+                                        since=_datetime(closed),
+                                        after=max_row_id)
+    if rows is None:
+        return None
+    # States are shared; never change them in place
+    combined = add_segments(array('l', deltas), _segments(rows))
+    return _Retention(deltas, closed, max_row_id,
+                      viewer_counts(combined), now)
+
+
+def _cache_key(course_ntiid, ntiid):
+    return (getattr(getSite(), '__name__', None), course_ntiid, ntiid)
+
+
+def get_video_retention(course, video, bucket_seconds=1):
+    """
+    Return the count of views of the video in the course covering each
+    `bucket_seconds` long part of it (the most views of any second in
+    the part), or None if the course is unknown to the analytics
+    database.
+    """
+    ntiid = getattr(video, 'ntiid', video)
+    key = _cache_key(course.ntiid, ntiid)
+    state = _RETENTION.get(key, _EMPTY_RETENTION)
+    if      state.checked is None \
+        or state.checked + REFRESH_SECONDS <= time.time():
+        state = refresh_retention(state, course, ntiid)
+        if state is None:
+            return None
+        _RETENTION.set(key, state)
+    return bucket_counts(state.counts, bucket_seconds)
+
+
+def invalidate_video_retention():
+    """
+    Drop all retention states.
+    """
+    _RETENTION.clear()
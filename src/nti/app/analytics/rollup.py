@@ -0,0 +1,498 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Rolled up activity counts, answering the active times (heat map) and
+activity by date stats of an analytics context (a user, a course, or the
+site) without reading every event of the window.
+
+Each context keeps a persistent rollup per kind of stat, holding the
+count of each hour (or day) of the (UTC) days it covers. The covered
+days are kept as separate segments, so a window far from the others
+never fills the gap between them.
+
+Rollups are only read by requests. Reads sum the covered days of the
+window, asking the stats source for the rest (the partial days at the
+edges, and the days not covered yet) in a query per uncovered range.
+The settled days a read found missing (those that ended
+`SETTLE_SECONDS` ago) are folded in by a job on the analytics queues;
+each rollup is always written from the same queue, so its writes never
+conflict. Once the queue processor has stored late events (e.g. from
+clients that were offline) for covered days, a job drops those days, so
+they are folded in again.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import math
+import time
+import zlib
+import calendar
+import datetime
+
+import six
+
+from BTrees.LLBTree import LLBTree
+
+from persistent import Persistent
+
+from zope import component
+
+from zope.annotation.interfaces import IAnnotations
+
+from zope.component.hooks import site as current_site
+from zope.component.hooks import getSite
+
+from zope.container.contained import Contained
+
+from nti.analytics import QUEUE_NAMES
+
+from nti.analytics import get_factory
+
+from nti.analytics.stats.interfaces import IActiveTimesStatsSource
+from nti.analytics.stats.interfaces import IDailyActivityStatsSource
+
+from nti.app.analytics.cache import LRUCache
+
+from nti.asynchronous.job import create_job
+
+from nti.contenttypes.courses.interfaces import ICourseInstance
+
+from nti.ntiids.ntiids import find_object_with_ntiid
+
+from nti.ntiids.oids import to_external_ntiid_oid
+
+from nti.site.hostpolicy import get_host_site
+
+#: Rollup kind for the active times (hour of the week) stats.
+ACTIVE_TIMES = u'active_times'
+
+#: Rollup kind for the activity by date stats.
+DAILY_ACTIVITY = u'daily_activity'
+
+HOUR_SECONDS = 60 * 60
+
+DAY_SECONDS = 24 * HOUR_SECONDS
+
+#: Seconds after the end of a day we fold it in; until then, most of
+#: its events are still coming in.
+SETTLE_SECONDS = 10 * 60
+
+#: The annotation key prefix of our rollups.
+ANNOTATION_KEY = u'nti.app.analytics.rollup.ActivityRollup'
+
+#: The folds queued by this process, by site, context, kind and range,
+#: so repeated reads queue them once.
+_QUEUED_FOLDS = LRUCache(maxsize=1000, ttl=SETTLE_SECONDS)
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def _epoch(value):
+    if isinstance(value, datetime.datetime):
+        return calendar.timegm(value.utctimetuple()) + value.microsecond / 1e6
+    return value
+
+
+def _datetime(seconds):
+    return datetime.datetime.utcfromtimestamp(seconds)
+
+
+def _floor_day(seconds):
+    return int(seconds // DAY_SECONDS) * DAY_SECONDS
+
+
+def _ceil_day(seconds):
+    return int(math.ceil(seconds / DAY_SECONDS)) * DAY_SECONDS
+
+
+def _fetch_active_times(source, start, end):
+    """
+    Return the count of each hour (by its start, in seconds since the
+    epoch) of the window, of at most a week, from an active times
+    source. Each hour of the week then falls on a single day.
+    """
+    stats = source.active_times_for_window(_datetime(start), _datetime(end))
+    result = {}
+    hour = int(start // HOUR_SECONDS) * HOUR_SECONDS
+    while hour < end:
+        when = _datetime(hour)
+        count = stats[when.weekday()][when.hour].Count
+        if count:
+            result[hour] = count
+        hour += HOUR_SECONDS
+    return result
+
+
+def _fetch_daily_activity(source, start, end):
+    """
+    Return the count of each day (by its start, in seconds since the
+    epoch) of the window, from an activity by date source.
+    """
+    stats = source.stats_for_window(_datetime(start), _datetime(end))
+    return {
+        calendar.timegm((day.year, day.month, day.day, 0, 0, 0)): stat.Count
+        for day, stat in stats.items()
+    }
+
+
+#: The fetch of each rollup kind, and the most days a fetch may cover
+#: (or None). Active times sources count by hour of the week, so each
+#: fetch of those covers a week at most.
+ROLLUP_FETCHES = {
+    ACTIVE_TIMES: (_fetch_active_times, 7),
+    DAILY_ACTIVITY: (_fetch_daily_activity, None),
+}
+
+#: The stats source interface of each rollup kind.
+ROLLUP_SOURCES = {
+    ACTIVE_TIMES: IActiveTimesStatsSource,
+    DAILY_ACTIVITY: IDailyActivityStatsSource,
+}
+
+
+def _chunked_fetch(kind, source):
+    """
+    Return a function fetching the counts of a window from the source,
+    in as many queries as the kind needs.
+    """
+    fetch, chunk_days = ROLLUP_FETCHES[kind]
+    if chunk_days is None:
+        return lambda lo, hi: fetch(source, lo, hi)
+
+    def _fetch(lo, hi):
+        result = {}
+        while lo < hi:
+            upto = min(hi, lo + chunk_days * DAY_SECONDS)
+            result.update(fetch(source, lo, upto))
+            lo = upto
+        return result
+    return _fetch
+
+
+class ActivityRollup(Persistent, Contained):
+    """
+    The counts of each hour (or day) of the days we cover (in seconds
+    since the epoch). `segments` maps the start of each (disjoint,
+    non-adjacent) range of covered days to its end.
+    """
+
+    def __init__(self):
+        self.counts = LLBTree()
+        self.segments = LLBTree()
+
+    def _overlapping(self, start, end, adjacent=False):
+        """
+        Return the (start, end) segments overlapping (or, if asked,
+        adjacent to) the given range.
+        """
+        segments = self.segments
+        try:
+            first = segments.maxKey(start)
+        except ValueError:
+            first = start
+        return [(lo, hi) for lo, hi in segments.items(first, end, excludemax=not adjacent)
+                if hi > start or (adjacent and hi == start)]
+
+    def covered(self, start, end):
+        """
+        Return the (start, end) ranges of the given range we cover.
+        """
+        return [(max(lo, start), min(hi, end))
+                for lo, hi in self._overlapping(start, end)]
+
+    def gaps(self, start, end):
+        """
+        Return the (start, end) ranges of the given range we do not
+        cover.
+        """
+        result = []
+        for lo, hi in self.covered(start, end):
+            if start < lo:
+                result.append((start, lo))
+            start = hi
+        if start < end:
+            result.append((start, end))
+        return result
+
+    def fold(self, start, end, counts):
+        """
+        Replace the counts of the days from `start` up to `end` with the
+        given counts, covering those days.
+        """
+        for key in list(self.counts.keys(start, end, excludemax=True)):
+            del self.counts[key]
+        self.counts.update(counts)
+        for lo, hi in self._overlapping(start, end, adjacent=True):
+            del self.segments[lo]
+            start, end = min(start, lo), max(end, hi)
+        self.segments[start] = end
+
+    def uncover(self, start, end):
+        """
+        Stop covering the days from `start` up to `end`, returning
+        whether we covered any.
+        """
+        overlapping = self._overlapping(start, end)
+        for lo, hi in overlapping:
+            del self.segments[lo]
+            if lo < start:
+                self.segments[lo] = start
+            if hi > end:
+                self.segments[end] = hi
+        if overlapping:
+            for key in list(self.counts.keys(start, end, excludemax=True)):
+                del self.counts[key]
+        return bool(overlapping)
+
+    def rewind(self, timestamp):
+        """
+        Have the day of `timestamp` (in seconds since the epoch) be
+        folded in again, returning whether we covered it.
+        """
+        day = _floor_day(timestamp)
+        return self.uncover(day, day + DAY_SECONDS)
+
+
+def get_activity_rollup(context, kind, create=True):
+    """
+    Return the :class:`ActivityRollup` of the given kind for the context,
+    creating it if asked, or None if the context cannot hold one (or has
+    none).
+    """
+    annotations = IAnnotations(context, None)
+    if annotations is None:
+        return None
+    key = u'%s.%s' % (ANNOTATION_KEY, kind)
+    result = annotations.get(key)
+    if result is None and create:
+        result = annotations[key] = ActivityRollup()
+        result.__parent__ = context
+        result.__name__ = key
+    return result
+
+
+def rollup_counts(rollup, start, end, now=None):
+    """
+    Return a tuple of the counts the rollup holds for the window, by the
+    start of each hour (or day) in seconds since the epoch; of the
+    (start, end) ranges of the window it does not cover, to be read from
+    the stats source; and of the ranges of the settled days of the
+    window it lacks. The rollup is only read.
+    """
+    now = time.time() if now is None else now
+    start, end = _epoch(start), _epoch(end)
+
+    inner_start, inner_end = _ceil_day(start), _floor_day(end)
+    counts = {}
+    uncovered = []
+    lo = start
+    for seg_lo, seg_hi in rollup.covered(inner_start, inner_end):
+        if lo < seg_lo:
+            uncovered.append((lo, seg_lo))
+        counts.update(rollup.counts.items(seg_lo, seg_hi, excludemax=True))
+        lo = seg_hi
+    if lo < end:
+        uncovered.append((lo, end))
+
+    settled = min(inner_end, _floor_day(now - SETTLE_SECONDS))
+    missing = rollup.gaps(inner_start, settled) if inner_start < settled else []
+    return counts, uncovered, missing
+
+
+def read_active_times(rollup, source, start, end, now=None):
+    """
+    Return a tuple of the activity counts of each hour (0-23) of each
+    weekday (Monday first) of the window, and of the ranges of settled
+    days the rollup lacks. The ranges the rollup does not cover are read
+    from the active times source, a query each.
+    """
+    counts, uncovered, missing = rollup_counts(rollup, start, end, now)
+    result = [[0] * 24 for _ in range(7)]
+    for hour, count in counts.items():
+        when = _datetime(hour)
+        result[when.weekday()][when.hour] += count
+    for lo, hi in uncovered:
+        stats = source.active_times_for_window(_datetime(lo), _datetime(hi))
+        for weekday, hours in enumerate(result):
+            for hour in range(24):
+                hours[hour] += stats[weekday][hour].Count
+    return result, missing
+
+
+def read_daily_activity(rollup, source, start, end, now=None):
+    """
+    Return a tuple of a map of date to the activity count of that day
+    of the window, and of the ranges of settled days the rollup lacks.
+    The ranges the rollup does not cover are read from the activity by
+    date source, a query each.
+    """
+    counts, uncovered, missing = rollup_counts(rollup, start, end, now)
+    result = {_datetime(k).date(): v for k, v in counts.items()}
+    for lo, hi in uncovered:
+        stats = source.stats_for_window(_datetime(lo), _datetime(hi))
+        for day, stat in stats.items():
+            day = datetime.date(day.year, day.month, day.day)
+            result[day] = result.get(day, 0) + stat.Count
+    return result, missing
+
+
+#: The read of each rollup kind.
+ROLLUP_READS = {
+    ACTIVE_TIMES: read_active_times,
+    DAILY_ACTIVITY: read_daily_activity,
+}
+
+
+def fold_rollup(rollup, kind, source, ranges):
+    """
+    Fold the days of the given (start, end) ranges the rollup does not
+    cover into it, from the source.
+    """
+    fetch = _chunked_fetch(kind, source)
+    for start, end in ranges:
+        for lo, hi in rollup.gaps(start, end):
+            rollup.fold(lo, hi, fetch(lo, hi))
+
+
+def _rollup_context(context):
+    return context if context is not None else getSite()
+
+
+def _context_ref(context):
+    """
+    The reference of an analytics context in queued jobs: its NTIID, or
+    None for the site.
+    """
+    if context is None or context is getSite():
+        return None
+    return getattr(context, 'ntiid', None) or to_external_ntiid_oid(context)
+
+
+def _process_rollup_job(site_name, ref, folds=(), rewinds=()):
+    """
+    The job that rewinds the days of the given timestamps in the
+    rollups of the context (its NTIID, or None for the site), then folds
+    the given (kind, start, end) ranges in, run by the analytics queue
+    processor.
+    """
+    site = None
+    if site_name:
+        try:
+            site = get_host_site(site_name)
+        except LookupError:
+            logger.warning('Cannot find site for activity rollups (%s)', site_name)
+            return
+    if site is None:
+        _update_rollups(ref, folds, rewinds)
+    else:
+        with current_site(site):
+            _update_rollups(ref, folds, rewinds)
+
+
+def _update_rollups(ref, folds, rewinds):
+    context = find_object_with_ntiid(ref) if ref else getSite()
+    context = ICourseInstance(context, context)
+    if context is None:
+        logger.info('Analytics context no longer exists for rollups (%s)', ref)
+        return
+    for kind in ROLLUP_FETCHES:
+        rollup = get_activity_rollup(context, kind, create=False)
+        if rollup is not None:
+            for timestamp in rewinds:
+                rollup.rewind(timestamp)
+    for kind, start, end in folds:
+        iface = ROLLUP_SOURCES[kind]
+        source = component.queryAdapter(context, iface) if ref \
+            else component.queryUtility(iface)
+        rollup = get_activity_rollup(context, kind)
+        if source is not None and rollup is not None:
+            fold_rollup(rollup, kind, source, ((start, end),))
+
+
+def _queue_rollup_job(ref, folds=(), rewinds=()):
+    """
+    Queue a rollup job for the context. The jobs of a context always go
+    to the same queue, so they run (and write) one at a time.
+    """
+    site_name = getattr(getSite(), '__name__', None)
+    key = u'%s/%s' % (site_name, ref)
+    queue_name = QUEUE_NAMES[zlib.crc32(key.encode('utf-8')) % len(QUEUE_NAMES)]
+    job = create_job(_process_rollup_job, site_name, ref,
+                     tuple(folds), tuple(rewinds))
+    try:
+        get_factory().get_queue(queue_name).put(job)
+    except Exception as e:  # pylint: disable=broad-except
+        # Reads still answer from the sources
+        logger.warning('Could not queue activity rollup job (%s) (%s)', key, e)
+        return False
+    return True
+
+
+def _queue_folds(context, kind, ranges):
+    ref = _context_ref(context)
+    site_name = getattr(getSite(), '__name__', None)
+    keys = [(site_name, ref, kind, start, end) for start, end in ranges]
+    keys = [x for x in keys if x not in _QUEUED_FOLDS]
+    if keys and _queue_rollup_job(ref, folds=[x[2:] for x in keys]):
+        for key in keys:
+            _QUEUED_FOLDS.set(key, True)
+
+
+def _read(context, kind, source, start, end):
+    """
+    Return the stats of the window for the context (as the read of the
+    kind does), queuing the folds of the days its rollup lacks.
+    """
+    context = _rollup_context(context)
+    annotations = IAnnotations(context, None)
+    rollup = None
+    if annotations is not None:
+        rollup = get_activity_rollup(context, kind, create=False)
+    # Nothing is covered yet
+    rollup = ActivityRollup() if rollup is None else rollup
+    result, missing = ROLLUP_READS[kind](rollup, source, start, end)
+    if missing and annotations is not None:
+        _queue_folds(context, kind, missing)
+    return result
+
+
+def get_active_times(context, source, start, end):
+    """
+    Return the activity counts of each hour (0-23) of each weekday
+    (Monday first) of the window, for the analytics context (None for
+    the site) through its active times source.
+    """
+    return _read(context, ACTIVE_TIMES, source, start, end)
+
+
+def get_daily_activity(context, source, start, end):
+    """
+    Return a map of date to the activity count of that day of the
+    window, for the analytics context (None for the site) through its
+    activity by date source.
+    """
+    return _read(context, DAILY_ACTIVITY, source, start, end)
+
+
+def rewind_activity_rollups(contexts, now=None):
+    """
+    Queue jobs to have the rollups of the given (context, timestamps)
+    pairs, where a context is an analytics context, its NTIID, or None
+    for the site, fold the days of those timestamps in again. Only
+    timestamps of days that may have been folded are rewound.
+    """
+    now = time.time() if now is None else now
+    settled = _floor_day(now - SETTLE_SECONDS)
+    for context, timestamps in contexts:
+        timestamps = sorted({
+            _floor_day(_epoch(x)) for x in timestamps if _epoch(x) < settled
+        })
+        if timestamps:
+            ref = context
+            if not isinstance(context, six.string_types):
+                ref = _context_ref(context)
+            _queue_rollup_job(ref, rewinds=timestamps)
@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Caching the results of windowed analytics stats queries (activity by
+date, active times) on the server, so repeated and concurrent dashboard
+loads run each query once.
+
+Results are cached by analytics context (the scope), stats source
+interface, window and version, until the same boundaries our
+``Cache-Control`` headers give clients: the end of the (UTC) day for
+results that update daily, and a day for historical results.
+
+The version of a context's stats is when events were last stored for
+it, recorded (as its activity marker) by the analytics queue processor
+once it has stored a batch of events. Newer events then miss the results
+cached by every process. Contexts that cannot be marked, and the site,
+whose marker every batch would contend for, change version every
+`UNMARKED_SECONDS` instead. Activity that does not come in batches of
+events (e.g. notes) is only seen once results expire.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import json
+import time
+import datetime
+import threading
+
+import six
+
+from persistent import Persistent
+
+from zope import component
+from zope import interface
+
+from zope.annotation.interfaces import IAnnotations
+
+from zope.container.contained import Contained
+
+from nti.app.analytics.cache import LRUCache
+
+from nti.app.analytics.interfaces import IStatsResultCache
+
+from nti.app.products.courseware.interfaces import ICourseInstanceEnrollment
+
+from nti.dataserver.interfaces import IRedisClient
+
+from nti.dataserver.users.users import User
+
+from nti.ntiids.oids import to_external_ntiid_oid
+
+#: How long (in seconds) historical results are cached.
+HISTORICAL_SECONDS = 24 * 60 * 60
+
+#: How long (in seconds) the version of the stats of contexts without an
+#: activity marker (e.g. the site) holds.
+UNMARKED_SECONDS = 60
+
+#: The annotation key of activity markers.
+MARKER_KEY = u'nti.app.analytics.stats_cache.ActivityMarker'
+
+#: Marker for missing cache entries
+_MISSING = object()
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def get_daily_expiration(now=None):
+    """
+    Return the (naive, UTC) datetime results that update daily expire
+    at: the end of the current day.
+    """
+    now = datetime.datetime.utcnow() if now is None else now
+    today = datetime.datetime(now.year, now.month, now.day)
+    return today + datetime.timedelta(days=1)
+
+
+def daily_expires(now=None):
+    """
+    Return the time (in seconds since the epoch) results that update
+    daily expire at.
+    """
+    now = time.time() if now is None else now
+    expires = get_daily_expiration(datetime.datetime.utcfromtimestamp(now))
+    return now + (expires - datetime.datetime.utcfromtimestamp(now)).total_seconds()
+
+
+def historical_expires(now=None):
+    """
+    Return the time (in seconds since the epoch) historical results
+    expire at.
+    """
+    now = time.time() if now is None else now
+    return now + HISTORICAL_SECONDS
+
+
+def _key_part(part):
+    if part is None:
+        return u''
+    if isinstance(part, datetime.datetime):
+        return part.replace(microsecond=0).isoformat()
+    if isinstance(part, datetime.date):
+        return part.isoformat()
+    if isinstance(part, interface.interface.InterfaceClass):
+        return part.__identifier__
+    return six.text_type(part)
+
+
+def _context_key(context):
+    if context is None:
+        return u''
+    if isinstance(context, six.string_types):
+        return context
+    return getattr(context, 'ntiid', None) or to_external_ntiid_oid(context)
+
+
+def stats_cache_scope(site_name, context):
+    """
+    Return the cache scope of the results for the analytics context
+    (None for the site), or the context with the given NTIID.
+    """
+    return u'/'.join((_key_part(site_name), _context_key(context)))
+
+
+def stats_cache_key(source_iface, *window):
+    """
+    Return the cache key of the results of the given stats source
+    interface over the given window parts (datetimes are to the second).
+    """
+    return u'/'.join(_key_part(x) for x in (source_iface,) + window)
+
+
+class ActivityMarker(Persistent, Contained):
+    """
+    When (in seconds since the epoch) events were last stored for an
+    analytics context. Concurrent marks keep the latest.
+    """
+
+    stored = 0
+
+    def mark(self, now):
+        if now > self.stored:
+            self.stored = now
+
+    def _p_resolveConflict(self, unused_old_state, committed_state, new_state):
+        if committed_state.get('stored', 0) >= new_state.get('stored', 0):
+            return committed_state
+        return new_state
+
+
+def _marker_annotations(context):
+    if ICourseInstanceEnrollment.providedBy(context):
+        # Enrollments change with the stats of their user
+        context = User.get_user(context.Username)
+    return IAnnotations(context, None) if context is not None else None
+
+
+def get_activity_marker(context, create=False):
+    """
+    Return the :class:`ActivityMarker` of the analytics context, creating
+    it if asked, or None if the context cannot hold one (or has none).
+    """
+    annotations = _marker_annotations(context)
+    if annotations is None:
+        return None
+    result = annotations.get(MARKER_KEY)
+    if result is None and create:
+        result = annotations[MARKER_KEY] = ActivityMarker()
+        result.__parent__ = context
+        result.__name__ = MARKER_KEY
+    return result
+
+
+def mark_activity_stored(contexts, now=None):
+    """
+    Record that events were stored (at `now`) for the given analytics
+    contexts, changing the version of their stats.
+    """
+    now = time.time() if now is None else now
+    for context in contexts:
+        marker = get_activity_marker(context, create=True)
+        if marker is not None:
+            marker.mark(now)
+
+
+def get_stats_version(context, now=None):
+    """
+    Return a tuple of the version of the stats of the analytics context
+    (None for the site), in seconds since the epoch, and of when that
+    version lapses, or None if it holds until events are stored.
+    """
+    annotations = _marker_annotations(context) if context is not None else None
+    if annotations is None:
+        now = time.time() if now is None else now
+        version = now - now % UNMARKED_SECONDS
+        return version, version + UNMARKED_SECONDS
+    marker = annotations.get(MARKER_KEY)
+    return getattr(marker, 'stored', 0), None
+
+
+class _Flight(object):
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = _MISSING
+
+
+@interface.implementer(IStatsResultCache)
+class InMemoryStatsResultCache(object):
+    """
+    A stats result cache local to this process. Concurrent computations
+    of the same key in this process wait for the first one.
+    """
+
+    #: How long (in seconds) we wait for another computation of a key.
+    wait_timeout = 60
+
+    def __init__(self, maxsize=1000):
+        self._results = LRUCache(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def get_or_compute(self, scope, key, compute, expires):
+        key = (scope, key)
+        result = self._results.get(key, _MISSING)
+        if result is not _MISSING:
+            return result
+
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            flight.event.wait(self.wait_timeout)
+            if flight.value is not _MISSING:
+                return flight.value
+            # The first computation failed (or is too slow)
+            return compute()
+
+        try:
+            result = flight.value = compute()
+            ttl = expires - time.time()
+            if ttl > 0:
+                self._results.set(key, result, ttl=ttl)
+            return result
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.event.set()
+
+    def clear(self):
+        self._results.clear()
+
+
+@interface.implementer(IStatsResultCache)
+class RedisStatsResultCache(object):
+    """
+    A stats result cache shared, through redis, by every process in the
+    cluster. Results are stored as JSON. Concurrent computations of the
+    same key, in any process, wait (polling) for the one holding its
+    lock.
+    """
+
+    prefix = 'nti.app.analytics.stats/'
+
+    #: How long (in seconds) a computation may hold a key's lock.
+    lock_timeout = 60
+
+    #: How often (in seconds) waiting computations check for a result.
+    poll_interval = 0.1
+
+    def __init__(self, redis=None):
+        self._redis = redis
+
+    @property
+    def redis(self):
+        if self._redis is None:
+            return component.getUtility(IRedisClient)
+        return self._redis
+
+    def _get(self, key):
+        value = self.redis.get(key)
+        return json.loads(value) if value is not None else _MISSING
+
+    def get_or_compute(self, scope, key, compute, expires):
+        key = u'%s%s/%s' % (self.prefix, scope, key)
+        result = self._get(key)
+        if result is not _MISSING:
+            return result
+
+        lock_key = key + '/lock'
+        if self.redis.set(lock_key, 1, nx=True, ex=self.lock_timeout):
+            try:
+                result = compute()
+                ttl = int(expires - time.time())
+                if ttl > 0:
+                    self.redis.setex(key, ttl, json.dumps(result))
+                return result
+            finally:
+                self.redis.delete(lock_key)
+
+        deadline = time.time() + self.lock_timeout
+        while time.time() < deadline:
+            time.sleep(self.poll_interval)
+            result = self._get(key)
+            if result is not _MISSING:
+                return result
+            if not self.redis.exists(lock_key):
+                # The computation holding the lock failed
+                break
+        return compute()
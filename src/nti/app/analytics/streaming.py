@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Incremental parsing of large JSON request bodies.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import re
+import json
+import codecs
+
+from six import string_types
+
+#: The default number of bytes read from the stream at a time.
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+#: The default largest (encoded) size, in characters, of any one value
+#: we decode, e.g. an event of a streamed array.
+DEFAULT_MAX_VALUE_SIZE = 1024 * 1024
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+#: Characters that may continue a JSON number
+_NUMBER_CHARS = frozenset(u'0123456789.eE+-')
+
+_DECODER = json.JSONDecoder()
+
+logger = __import__('logging').getLogger(__name__)
+
+
+class MalformedJSONError(ValueError):
+    """
+    Raised when the streamed body is not valid JSON (or does not have the
+    expected structure).
+    """
+
+
+class JSONValueTooLargeError(MalformedJSONError):
+    """
+    Raised when a value of the streamed body is larger than we accept.
+    """
+
+
+class StreamingJSONReader(object):
+    """
+    Reads a JSON object from a (byte) stream, yielding the items of a
+    nested array one at a time instead of decoding the whole document
+    up-front.
+
+    Only the array found at the given path is streamed; all other values
+    are decoded whole, with top-level values available in :attr:`values`
+    once iteration is complete. Keys are matched case-insensitively.
+
+    We buffer a chunk and the value being decoded, so values (including
+    each item of the array) larger than `max_value_size` characters are
+    rejected with a :class:`JSONValueTooLargeError`, bounding our buffer
+    however the body is laid out.
+    """
+
+    def __init__(self, stream, chunk_size=DEFAULT_CHUNK_SIZE, encoding='utf-8',
+                 max_value_size=DEFAULT_MAX_VALUE_SIZE):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.max_value_size = max_value_size
+        self.values = {}
+        self._decoder = codecs.getincrementaldecoder(encoding)()
+        self._text = u''
+        self._pos = 0
+        self._eof = False
+        self._found = False
+
+    def _fill(self):
+        """
+        Read another chunk into our buffer, discarding what we have already
+        consumed. Returns False if there is nothing left to read.
+        """
+        if self._eof:
+            return False
+        chunk = self.stream.read(self.chunk_size)
+        if not chunk:
+            self._eof = True
+            text = self._decoder.decode(b'', final=True)
+        else:
+            text = self._decoder.decode(chunk)
+        self._text = self._text[self._pos:] + text
+        self._pos = 0
+        return bool(chunk) or bool(text)
+
+    def _peek(self):
+        """
+        Skip whitespace, returning the next character (or None at EOF).
+        """
+        while True:
+            self._pos = _WHITESPACE.match(self._text, self._pos).end()
+            if self._pos < len(self._text):
+                return self._text[self._pos]
+            if not self._fill():
+                return None
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise MalformedJSONError('Expected %r at offset %s' % (char, self._pos))
+        self._pos += 1
+
+    def _fill_value(self):
+        """
+        Read another chunk of the value being decoded, unless it is
+        already too large.
+        """
+        if      self.max_value_size is not None \
+            and len(self._text) - self._pos > self.max_value_size:
+            raise JSONValueTooLargeError('JSON value at offset %s is larger than %s'
+                                         % (self._pos, self.max_value_size))
+        return self._fill()
+
+    def _decode(self):
+        """
+        Decode the next complete JSON value.
+        """
+        if self._peek() is None:
+            raise MalformedJSONError('Unexpected end of JSON input')
+        while True:
+            try:
+                value, end = _DECODER.raw_decode(self._text, self._pos)
+            except ValueError:
+                if self._fill_value():
+                    continue
+                raise MalformedJSONError('Invalid JSON value at offset %s' % self._pos)
+            # Numbers and literals may continue into the next chunk.
+            if      (   end >= len(self._text) \
+                     or self._text[end] in _NUMBER_CHARS) \
+                and self._fill_value():
+                continue
+            if      self.max_value_size is not None \
+                and end - self._pos > self.max_value_size:
+                raise JSONValueTooLargeError('JSON value at offset %s is larger than %s'
+                                             % (self._pos, self.max_value_size))
+            self._pos = end
+            return value
+
+    def _matches(self, key, path, depth):
+        return  not self._found \
+            and depth < len(path) \
+            and key.lower() == path[depth].lower()
+
+    def _iter_array(self):
+        self._expect('[')
+        if self._peek() == ']':
+            self._pos += 1
+            return
+        while True:
+            yield self._decode()
+            char = self._peek()
+            self._pos += 1
+            if char == ']':
+                return
+            if char != ',':
+                raise MalformedJSONError('Expected "," or "]" at offset %s' % self._pos)
+
+    def _iter_object(self, path, depth):
+        self._expect('{')
+        if self._peek() == '}':
+            self._pos += 1
+            return
+        while True:
+            key = self._decode()
+            if not isinstance(key, string_types):
+                raise MalformedJSONError('Expected an object key at offset %s' % self._pos)
+            self._expect(':')
+
+            char = self._peek()
+            if self._matches(key, path, depth) and depth + 1 == len(path) and char == '[':
+                self._found = True
+                for item in self._iter_array():
+                    yield item
+            elif self._matches(key, path, depth) and char == '{':
+                for item in self._iter_object(path, depth + 1):
+                    yield item
+            else:
+                value = self._decode()
+                if depth == 0:
+                    self.values[key] = value
+
+            char = self._peek()
+            self._pos += 1
+            if char == '}':
+                return
+            if char != ',':
+                raise MalformedJSONError('Expected "," or "}" at offset %s' % self._pos)
+
+    def iter_items(self, path):
+        """
+        Yield the items of the array found by following the sequence of
+        object keys in `path`. Yields nothing if there is no such array,
+        or if the body is empty.
+        """
+        if isinstance(path, string_types):
+            path = (path,)
+        char = self._peek()
+        if char is None:
+            return
+        if char != '{':
+            raise MalformedJSONError('Expected a JSON object')
+        for item in self._iter_object(tuple(path), 0):
+            yield item
+        if self._peek() is not None:
+            raise MalformedJSONError('Extra data at offset %s' % self._pos)
+
+
+def iter_json_array(stream, path, chunk_size=DEFAULT_CHUNK_SIZE,
+                    max_value_size=DEFAULT_MAX_VALUE_SIZE):
+    """
+    Yield the items of the array at `path` within the JSON object read
+    from `stream`.
+    """
+    reader = StreamingJSONReader(stream, chunk_size=chunk_size,
+                                 max_value_size=max_value_size)
+    return reader.iter_items(path)
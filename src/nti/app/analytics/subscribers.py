@@ -11,15 +11,34 @@ from zope import component
 
 from zope.event import notify
 
+from zope.interface.interfaces import IObjectEvent
+
+from zope.lifecycleevent.interfaces import IObjectModifiedEvent
+
+from nti.app.analytics.materialized import invalidate_course_aggregates
+
+from nti.app.analytics.titles import invalidate_titles
+
+from nti.app.analytics.usage_stats import invalidate_enrollment_scopes
+
 from nti.app.analytics.utils import get_session_id_from_request
 
 from nti.appserver.interfaces import IUserLogoutEvent
 
+from nti.analytics.interfaces import IVideoEvent
+from nti.analytics.interfaces import IResourceEvent
 from nti.analytics.interfaces import IRootContextEvent
 from nti.analytics.interfaces import IUserProcessedEventsEvent
 
 from nti.analytics.sessions import handle_end_session
 
+from nti.contentlibrary.interfaces import IContentPackageLibraryDidSyncEvent
+
+from nti.contenttypes.courses.interfaces import ICourseInstanceAvailableEvent
+from nti.contenttypes.courses.interfaces import ICourseInstanceEnrollmentRecord
+
+from nti.contenttypes.presentation.interfaces import IPresentationAsset
+
 from nti.coremetadata.interfaces import UserProcessedContextsEvent
 
 from nti.dataserver.interfaces import IUser
@@ -58,3 +77,45 @@ def _user_processed_events(user, event):
         if contexts:
             contexts = tuple(contexts)
             notify(UserProcessedContextsEvent(user, contexts, timestamp, request))
+
+
+@component.adapter(IUser, IUserProcessedEventsEvent)
+def _invalidate_course_aggregates(unused_user, event):
+    """
+    Drop the in-memory usage stat aggregates of the courses the user has
+    new resource or video events in.
+    """
+    contexts = {
+        x.RootContextID for x in event.events
+        if IVideoEvent.providedBy(x) or IResourceEvent.providedBy(x)
+    }
+    contexts.discard(None)
+    invalidate_course_aggregates(contexts)
+
+
+@component.adapter(IContentPackageLibraryDidSyncEvent)
+def _library_synced(unused_event):
+    invalidate_titles()
+
+
+@component.adapter(ICourseInstanceAvailableEvent)
+def _course_synced(unused_event):
+    invalidate_titles()
+
+
+@component.adapter(IPresentationAsset, IObjectModifiedEvent)
+def _asset_modified(asset, unused_event):
+    ntiid = getattr(asset, 'ntiid', None)
+    if ntiid:
+        invalidate_titles((ntiid,))
+
+
+@component.adapter(ICourseInstanceEnrollmentRecord, IObjectEvent)
+def _enrollment_changed(record, unused_event):
+    """
+    Enrollments added, removed or modified (e.g. changing scope) change
+    the scope membership of the course and its parent.
+    """
+    course = record.CourseInstance
+    if course is not None:
+        invalidate_enrollment_scopes(course)
@@ -10,7 +10,11 @@ from __future__ import absolute_import
 
 from hamcrest import is_
 from hamcrest import none
+from hamcrest import is_not
+from hamcrest import has_key
 from hamcrest import not_none
+from hamcrest import has_length
+from hamcrest import same_instance
 from hamcrest import assert_that
 
 import time
@@ -37,11 +41,18 @@ from nti.analytics_database.interfaces import IAnalyticsNTIIDIdentifier
 from nti.analytics_database.interfaces import IAnalyticsRootContextIdentifier
 
 from nti.app.analytics.completion import content_progress
+from nti.app.analytics.completion import related_work_ref_progress
+
+from nti.app.analytics.progress import REQUEST_CACHE_KEY
+from nti.app.analytics.progress import get_course_content_progress
+from nti.app.analytics.progress import get_lesson_related_work_progress
 
 from nti.contentlibrary.contentunit import ContentUnit
 
 from nti.contenttypes.courses.courses import CourseInstance
 
+from nti.contenttypes.presentation.relatedwork import NTIRelatedWorkRef
+
 from nti.dataserver.contenttypes.forums.forum import GeneralForum
 
 from nti.dataserver.contenttypes.forums.post import GeneralForumComment
@@ -57,6 +68,24 @@ from nti.dataserver.users.users import User
 from nti.testing.time import time_monotonically_increases
 
 
+class _Request(object):
+
+    def __init__(self):
+        self.environ = {}
+
+
+class _Lesson(object):
+
+    def __init__(self, *groups):
+        self.Items = groups
+
+
+class _Group(object):
+
+    def __init__(self, *items):
+        self.Items = items
+
+
 def _create_topic_view(user_id, topic):
     time_length = 30
     event_time = time.time()
@@ -342,3 +371,144 @@ class TestPagedProgress( NTIAnalyticsTestCase ):
         assert_that( result.AbsoluteProgress, is_( 2 ))
         assert_that( result.MaxPossibleProgress, is_( max_progress ))
         assert_that( result.HasProgress, is_( True ))
+
+    @WithMockDSTrans
+    @fudge.patch('nti.app.analytics.progress.get_current_request',
+                 'nti.app.analytics.progress.get_resource_views')
+    def test_paged_progress_request(self, mock_request, mock_views):
+        user = User.create_user( username='new_user1', dataserver=self.ds )
+        course = CourseInstance()
+        containers = []
+        for idx in range(3):
+            container = ContentUnit()
+            container.ntiid = u'tag:nextthought.com,2011:bleh%s' % idx
+            child = ContentUnit()
+            child.ntiid = u'%s.page_1' % container.ntiid
+            container.children = (child,)
+            containers.append(container)
+
+        reads = []
+        def _views(**kwargs):
+            reads.append(kwargs)
+            return ()
+        mock_views.is_callable().calls( _views )
+        mock_request.is_callable().returns( _Request() )
+
+        # Each page container reads only its own (and its pages') views
+        for container in containers:
+            assert_that( content_progress(user, container, course), none() )
+        assert_that( reads, has_length( 3 ))
+        assert_that( reads[0], has_key( 'filters' ))
+
+        # Unless the user's views were read in bulk for the request
+        del reads[:]
+        get_course_content_progress(user, course, containers)
+        for container in containers:
+            assert_that( content_progress(user, container, course), none() )
+        assert_that( reads, has_length( 1 ))
+        assert_that( reads[0], is_not( has_key( 'filters' )))
+
+    @WithMockDSTrans
+    @fudge.patch( 'nti.ntiids.ntiids.find_object_with_ntiid' )
+    def test_course_content_progress(self, mock_find_object):
+        user = User.create_user( username='new_user1', dataserver=self.ds )
+        course = CourseInstance()
+
+        container = ContentUnit()
+        container.NTIID = container.ntiid = u'tag:nextthought.com,2011:bleh'
+        child1 = ContentUnit()
+        child1.ntiid = u'tag:nextthought.com,2011:bleh.page_1'
+        child2 = ContentUnit()
+        child2.ntiid = u'tag:nextthought.com,2011:bleh.page_2'
+        container.children = (child1, child2)
+        other = ContentUnit()
+        other.ntiid = u'tag:nextthought.com,2011:other'
+        unviewed = ContentUnit()
+        unviewed.ntiid = u'tag:nextthought.com,2011:unviewed'
+        mock_find_object.is_callable().returns( container )
+
+        units = (container, child1, child2, other, unviewed)
+        result = get_course_content_progress(user, course, units)
+        assert_that( result, is_( {} ))
+
+        self._create_resource_view( user, child1.ntiid, course )
+        self._create_resource_view( user, other.ntiid, course )
+
+        # Only viewed units (or containers of viewed pages)
+        result = get_course_content_progress(user, course, units)
+        assert_that( result, has_length( 3 ))
+        progress = result[container.ntiid]
+        assert_that( progress.AbsoluteProgress, is_( 1 ))
+        assert_that( progress.MaxPossibleProgress, is_( 3 ))
+        assert_that( result[child1.ntiid].HasProgress, is_( True ))
+        assert_that( result[other.ntiid].HasProgress, is_( True ))
+
+        # The same as each unit's progress
+        expected = content_progress(user, container, course)
+        assert_that( progress.AbsoluteProgress, is_( expected.AbsoluteProgress ))
+        assert_that( progress.MaxPossibleProgress, is_( expected.MaxPossibleProgress ))
+
+    @WithMockDSTrans
+    @fudge.patch('nti.ntiids.ntiids.find_object_with_ntiid',
+                 'nti.app.analytics.progress.find_object_with_ntiid',
+                 'nti.app.analytics.completion.find_object_with_ntiid',
+                 'nti.app.analytics.progress.get_current_request')
+    def test_related_work_progress(self, mock_find_object, mock_find_target,
+                                   mock_find_ref_target, mock_request):
+        user = User.create_user( username='new_user1', dataserver=self.ds )
+        course = CourseInstance()
+
+        container = ContentUnit()
+        container.NTIID = container.ntiid = u'tag:nextthought.com,2011:bleh'
+        child1 = ContentUnit()
+        child1.ntiid = u'tag:nextthought.com,2011:bleh.page_1'
+        child2 = ContentUnit()
+        child2.ntiid = u'tag:nextthought.com,2011:bleh.page_2'
+        container.children = (child1, child2)
+        mock_find_object.is_callable().returns( container )
+
+        lookups = []
+        def _find(ntiid):
+            lookups.append(ntiid)
+            return container if ntiid == container.ntiid else None
+        mock_find_target.is_callable().calls( _find )
+        mock_find_ref_target.is_callable().calls( _find )
+        mock_request.is_callable().returns( None )
+
+        reading_ref = NTIRelatedWorkRef()
+        reading_ref.ntiid = u'tag:nextthought.com,2011:ref.reading'
+        reading_ref.target = container.ntiid
+        reading_ref2 = NTIRelatedWorkRef()
+        reading_ref2.ntiid = u'tag:nextthought.com,2011:ref.reading2'
+        reading_ref2.target = container.ntiid
+        link_ref = NTIRelatedWorkRef()
+        link_ref.ntiid = u'tag:nextthought.com,2011:ref.link'
+        link_ref.target = u'http://www.nextthought.com'
+        lesson = _Lesson(_Group(reading_ref, link_ref), _Group(reading_ref2))
+
+        self._create_resource_view( user, child1.ntiid, course )
+        self._create_resource_view( user, link_ref.ntiid, course )
+
+        result = get_lesson_related_work_progress(user, lesson, course)
+        assert_that( result, has_length( 3 ))
+        assert_that( result[reading_ref.ntiid].AbsoluteProgress, is_( 1 ))
+        assert_that( result[reading_ref.ntiid].MaxPossibleProgress, is_( 3 ))
+        assert_that( result[link_ref.ntiid].HasProgress, is_( True ))
+        # Each target is resolved once
+        assert_that( lookups, is_( [container.ntiid, link_ref.target] ))
+
+        # The same as each ref's progress
+        del lookups[:]
+        expected = related_work_ref_progress(user, reading_ref, course)
+        assert_that( result[reading_ref.ntiid].AbsoluteProgress,
+                     is_( expected.AbsoluteProgress ))
+        assert_that( lookups, is_( [container.ntiid] ))
+
+        # Within a request, the adapters read what was computed in bulk
+        request = _Request()
+        mock_request.is_callable().returns( request )
+        result = get_lesson_related_work_progress(user, lesson, course)
+        assert_that( request.environ, has_length( 1 ))
+        assert_that( request.environ[REQUEST_CACHE_KEY], has_length( 1 ))
+        assert_that( related_work_ref_progress(user, link_ref, course),
+                     same_instance( result[link_ref.ntiid] ))
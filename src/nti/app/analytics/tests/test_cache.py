@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import has_length
+from hamcrest import assert_that
+
+import unittest
+
+import fudge
+
+from nti.app.analytics.cache import LRUCache
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_eviction(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        # Touch 'a' so that 'b' is least recently used
+        assert_that(cache.get('a'), is_(1))
+        cache.set('c', 3)
+        assert_that(cache, has_length(2))
+        assert_that(cache.get('b'), none())
+        assert_that(cache.get('a'), is_(1))
+        assert_that(cache.get('c'), is_(3))
+
+        cache.invalidate('a')
+        assert_that('a' in cache, is_(False))
+        cache.clear()
+        assert_that(cache, has_length(0))
+
+    def test_weight(self):
+        cache = LRUCache(maxsize=10)
+        cache.set('a', 1, weight=4)
+        cache.set('b', 2, weight=5)
+        assert_that(cache.size, is_(9))
+        cache.set('c', 3, weight=2)
+        assert_that(cache.get('a'), none())
+        assert_that(cache.size, is_(7))
+
+        # Replacing a value replaces its weight
+        cache.set('b', 2)
+        assert_that(cache.size, is_(3))
+        cache.invalidate('c')
+        assert_that(cache.size, is_(1))
+
+        # Values heavier than the cache are not kept
+        cache.set('d', 4, weight=11)
+        assert_that(cache, has_length(0))
+        assert_that(cache.size, is_(0))
+
+    @fudge.patch('nti.app.analytics.cache.time.time')
+    def test_ttl(self, mock_time):
+        mock_time.is_callable().returns(100)
+        cache = LRUCache(ttl=10)
+        cache.set('a', 1)
+        cache.set('b', 2, ttl=100)
+        assert_that(cache.get('a'), is_(1))
+
+        mock_time.is_callable().returns(111)
+        assert_that(cache.get('a'), none())
+        assert_that(cache.get('a', 'default'), is_('default'))
+        assert_that(cache.get('b'), is_(2))
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import has_length
+from hamcrest import assert_that
+
+import random
+import unittest
+
+from decimal import Decimal
+
+from nti.app.analytics.aggregation import AggregateRow
+
+from nti.app.analytics.columnar import ColumnarEventAccumulator
+
+from nti.app.analytics.usage_stats import ResourceEventAccumulator
+
+
+class MockUser(object):
+
+    def __init__(self, username):
+        self.username = username
+
+
+class MockVideoEvent(object):
+
+    def __init__(self, rnd):
+        self.user = MockUser(u'user%s' % rnd.randint(0, 20))
+        self.ResourceId = u'ntiid%s' % rnd.randint(0, 5)
+        self.SessionID = rnd.choice((None, rnd.randint(0, 40)))
+        self.Duration = rnd.choice((None, 0, rnd.randint(1, 100)))
+        self.VideoStartTime = rnd.choice((None, rnd.randint(0, 50)))
+        self.VideoEndTime = rnd.choice((None, 0, rnd.randint(0, 300)))
+        self.MaxDuration = rnd.choice((None, rnd.randint(100, 300)))
+        self.timestamp = rnd.choice((None, rnd.random() * 1000))
+
+
+def _base_stats(stats):
+    return (stats.total_view_time, stats.max_end_time, stats.last_view_time)
+
+
+def _resource_stats(stats):
+    return (stats.total_view_time,
+            stats.event_count,
+            stats.session_count,
+            stats.max_duration,
+            stats.last_view_time,
+            {k: _base_stats(v) for k, v in stats.user_stats.items()},
+            {k: _base_stats(v) for k, v in stats.session_stats.items()})
+
+
+class TestColumnarAccumulator(unittest.TestCase):
+
+    def _accumulate(self, factory, events):
+        accums = factory.for_scopes(('AllUsers', 'Public'))
+        for event in events:
+            accums['AllUsers'].accum(event)
+            if event.user.username < u'user10':
+                accums['Public'].accum(event)
+        return accums
+
+    def _as_dict(self, stats_map):
+        return {k: _resource_stats(v) for k, v in stats_map.items()}
+
+    def test_matches_objects(self):
+        rnd = random.Random(42)
+        events = [MockVideoEvent(rnd) for _ in range(2000)]
+        expected = self._accumulate(ResourceEventAccumulator, events)
+        actual = self._accumulate(ColumnarEventAccumulator, events)
+        # Scopes share their columns
+        assert_that(actual['Public'].columns, is_(actual['AllUsers'].columns))
+        assert_that(actual['AllUsers'].columns, has_length(len(events)))
+
+        for scope in ('AllUsers', 'Public'):
+            assert_that(self._as_dict(actual[scope].ntiid_stats_map),
+                        is_(self._as_dict(expected[scope].ntiid_stats_map)))
+            assert_that(self._as_dict(actual[scope].user_stats_map),
+                        is_(self._as_dict(expected[scope].user_stats_map)))
+
+        user_stats = actual['Public'].user_stats_map
+        assert_that(user_stats.get(u'user15'), none())
+        assert_that(sorted(user_stats), is_(sorted(expected['Public'].user_stats_map)))
+
+    def test_types(self):
+        rnd = random.Random(1)
+        event = MockVideoEvent(rnd)
+        event.Duration = 10
+        event.MaxDuration = 12.5
+        accum = ColumnarEventAccumulator()
+        accum.accum(event)
+        stats = accum.ntiid_stats_map[event.ResourceId]
+        assert_that(type(stats.total_view_time), is_(int))
+        assert_that(stats.max_duration, is_(12.5))
+
+    def test_aggregate_rows(self):
+        rnd = random.Random(7)
+        rows = []
+        for _ in range(500):
+            event = MockVideoEvent(rnd)
+            rows.append(AggregateRow(event.ResourceId,
+                                     None,
+                                     event.SessionID,
+                                     rnd.randint(1, 5),
+                                     event.Duration,
+                                     event.VideoEndTime,
+                                     event.MaxDuration,
+                                     event.timestamp))
+        usernames = [u'user%s' % rnd.randint(0, 20) for _ in rows]
+        expected = ResourceEventAccumulator()
+        actual = ColumnarEventAccumulator()
+        for row, username in zip(rows, usernames):
+            expected.accum_row(row, username)
+            actual.accum_row(row, username)
+        assert_that(self._as_dict(actual.ntiid_stats_map),
+                    is_(self._as_dict(expected.ntiid_stats_map)))
+        assert_that(self._as_dict(actual.user_stats_map),
+                    is_(self._as_dict(expected.user_stats_map)))
+
+        # Summed durations may be decimals
+        row = rows[0]._replace(total_view_time=Decimal(30))
+        accum = ColumnarEventAccumulator()
+        accum.accum_row(row, u'user1')
+        stats = accum.ntiid_stats_map[row.resource_id]
+        assert_that(stats.total_view_time, is_(30))
+        assert_that(type(stats.total_view_time), is_(int))
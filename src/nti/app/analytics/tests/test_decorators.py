@@ -17,6 +17,7 @@ from hamcrest import has_property
 from nti.analytics.tests import NTIAnalyticsApplicationTestLayer
 
 from nti.app.analytics.decorators import _CourseVideoProgressLinkDecorator
+from nti.app.analytics.decorators import _CourseVideoResumeInfoLinkDecorator
 
 from nti.app.testing.application_webtest import ApplicationLayerTest
 
@@ -35,3 +36,9 @@ class TestDecorators(ApplicationLayerTest):
         assert_that(result, not_none())
         assert_that(result, has_entry('Links',
                                       contains(has_property('rel', 'VideoProgress'))))
+
+        result = {}
+        decorator = _CourseVideoResumeInfoLinkDecorator(object(), None)
+        decorator._do_decorate_external(inst, result)
+        assert_that(result, has_entry('Links',
+                                      contains(has_property('rel', 'VideoResumeInfo'))))
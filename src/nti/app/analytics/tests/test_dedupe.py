@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+from hamcrest import is_
+from hamcrest import has_length
+from hamcrest import assert_that
+
+import unittest
+
+from nti.app.analytics.dedupe import BatchDeduplicator
+from nti.app.analytics.dedupe import InMemoryDedupeStore
+
+
+class TestBatchDeduplicator(unittest.TestCase):
+
+    def _events(self, *event_ids):
+        result = []
+        for idx, event_id in enumerate(event_ids):
+            event = {'MimeType': 'a', 'idx': idx}
+            if event_id is not None:
+                event['ClientEventId'] = event_id
+            result.append(event)
+        return result
+
+    def test_event_ids(self):
+        store = InMemoryDedupeStore()
+        dedupe = BatchDeduplicator(u'user1', lambda: None, store)
+        dedupe.chunk_size = 2
+        events = list(dedupe.filter(self._events(u'a', u'b', None, u'a', 1)))
+        # Within-batch duplicates are dropped; ids are stripped
+        assert_that(events, has_length(4))
+        assert_that(dedupe.duplicate_count, is_(1))
+        assert_that([x.get('ClientEventId') for x in events],
+                    is_([None] * 4))
+
+        # Nothing is recorded until committed
+        dedupe = BatchDeduplicator(u'user1', lambda: None, store)
+        events = list(dedupe.filter(self._events(u'a', u'c')))
+        assert_that(events, has_length(2))
+        dedupe._mark(False)
+        dedupe._mark(True)
+
+        dedupe = BatchDeduplicator(u'user1', lambda: None, store)
+        events = list(dedupe.filter(self._events(u'a', u'c', u'd', None)))
+        assert_that(events, has_length(2))
+        assert_that(dedupe.duplicate_count, is_(2))
+
+        # Malformed events are passed through
+        dedupe = BatchDeduplicator(u'user1', lambda: None, store)
+        events = list(dedupe.filter([u'malformed', None] + self._events(u'a')))
+        assert_that(events, is_([u'malformed', None]))
+
+        # Ids are per-user
+        dedupe = BatchDeduplicator(u'user2', lambda: None, store)
+        events = list(dedupe.filter(self._events(u'a', u'c')))
+        assert_that(events, has_length(2))
+
+    def test_batch_id(self):
+        store = InMemoryDedupeStore()
+        dedupe = BatchDeduplicator(u'user1', lambda: u'batch1', store)
+        events = list(dedupe.filter(self._events(None, None, u'a')))
+        assert_that(events, has_length(3))
+        assert_that(dedupe.is_resent(len(events)), is_(False))
+        dedupe._mark(True)
+
+        # Events are read before the batch is checked
+        dedupe = BatchDeduplicator(u'user1', lambda: u'batch1', store)
+        dedupe.chunk_size = 2
+        events = list(dedupe.filter(self._events(None, None, u'a')))
+        assert_that(events, has_length(2))
+        assert_that(dedupe.duplicate_count, is_(1))
+        assert_that(dedupe.is_resent(len(events)), is_(True))
+        assert_that(dedupe.duplicate_count, is_(3))
+        assert_that(dedupe._pending, is_(set()))
+
+        dedupe = BatchDeduplicator(u'user1', lambda: u'batch2', store)
+        events = list(dedupe.filter(self._events(None)))
+        assert_that(events, has_length(1))
+        assert_that(dedupe.is_resent(len(events)), is_(False))
+
+    def test_batch_seen(self):
+        store = InMemoryDedupeStore()
+        dedupe = BatchDeduplicator(u'user1', lambda: u'batch1', store)
+        assert_that(dedupe.batch_seen(), is_(False))
+        dedupe._mark(True)
+        assert_that(dedupe.batch_seen(), is_(True))
+        assert_that(dedupe.resent, is_(False))
+        assert_that(dedupe.is_resent(2), is_(True))
+        assert_that(dedupe.resent, is_(True))
+
+        dedupe = BatchDeduplicator(u'user1', lambda: None, store)
+        assert_that(dedupe.batch_seen(), is_(False))
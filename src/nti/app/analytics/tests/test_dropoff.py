@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+from hamcrest import is_
+from hamcrest import assert_that
+
+import unittest
+
+from array import array
+
+from nti.app.analytics import dropoff
+
+from nti.app.analytics.dropoff import completed_count
+from nti.app.analytics.dropoff import drop_off_counts
+
+
+class TestDropOff(unittest.TestCase):
+
+    end_times = array('d', (0, 10, 25, 25.5, 50, 74, 75, 75.1, 99, 100, 120))
+
+    def _check(self):
+        # Points on a boundary fall in the earlier part
+        assert_that(drop_off_counts(100, self.end_times),
+                    is_([3, 2, 2, 4]))
+        assert_that(drop_off_counts(100, self.end_times, 20),
+                    is_([1, 1, 0, 0, 1, 1, 0, 0, 0, 1,
+                         0, 0, 0, 0, 2, 1, 0, 0, 0, 3]))
+        assert_that(drop_off_counts(100, array('d')), is_([0, 0, 0, 0]))
+
+        view_times = array('d', (10, 90, 90, 200))
+        end_times = array('d', (90, 10, 90, 89.9))
+        assert_that(completed_count(90, view_times, end_times), is_(1))
+        assert_that(completed_count(10, view_times, end_times), is_(4))
+        assert_that(completed_count(90, array('d'), array('d')), is_(0))
+
+    def test_drop_off(self):
+        self._check()
+
+    def test_drop_off_without_numpy(self):
+        numpy, dropoff.numpy = dropoff.numpy, None
+        try:
+            self._check()
+        finally:
+            dropoff.numpy = numpy
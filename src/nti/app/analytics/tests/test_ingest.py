@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import contains
+from hamcrest import has_length
+from hamcrest import assert_that
+from hamcrest import instance_of
+from hamcrest import contains_inanyorder
+
+import time
+
+import fudge
+
+from nti.analytics.model import ResourceEvent
+from nti.analytics.model import SkipVideoEvent
+from nti.analytics.model import CourseCatalogViewEvent
+
+from nti.analytics import QUEUE_NAMES
+
+from nti.app.analytics.ingest import _ROOT_CONTEXT_INTIDS
+
+from nti.app.analytics.ingest import _process_stored_events
+
+from nti.app.analytics.ingest import internalize_events
+from nti.app.analytics.ingest import queue_stored_events
+from nti.app.analytics.ingest import ProgressNTIIDResolver
+from nti.app.analytics.ingest import QueuedProgressDispatcher
+from nti.app.analytics.ingest import coalesce_progress_updates
+
+from nti.app.analytics.tests import NTIAnalyticsTestCase
+
+from nti.externalization.externalization import to_external_object
+
+course = u'tag:nextthought.com,2011-10:OU-HTML-CLC3403_LawAndJustice.course_info'
+resource_id = u'tag:nextthought.com,2011-10:OU-HTML-CLC3403_LawAndJustice.subsec:BOOK_Three_PART_11'
+video_id = u'tag:nextthought.com,2011-10:OU-NTIVideo-CLC3403_LawAndJustice.ntivideo.video_1'
+
+
+class TestBulkInternalization(NTIAnalyticsTestCase):
+
+    def _events(self, username):
+        timestamp = time.time()
+        resource_event = ResourceEvent(user=username,
+                                       timestamp=timestamp,
+                                       RootContextID=course,
+                                       ResourceId=resource_id,
+                                       Duration=30)
+        video_event = SkipVideoEvent(user=username,
+                                     timestamp=timestamp,
+                                     RootContextID=course,
+                                     ResourceId=video_id,
+                                     Duration=30,
+                                     video_start_time=13,
+                                     video_end_time=39,
+                                     with_transcript=True)
+        catalog_event = CourseCatalogViewEvent(user=username,
+                                               timestamp=timestamp,
+                                               RootContextID=course,
+                                               Duration=30)
+        return [to_external_object(x) for x in (resource_event,
+                                                video_event,
+                                                catalog_event)]
+
+    def test_internalize(self):
+        username = u'sjohnson@nextthought.com'
+        events = self._events(username)
+        # Interleave two events of the same type to exercise grouping
+        events.append(dict(events[0]))
+
+        batch, malformed_count, progress = internalize_events(events, username)
+        assert_that(malformed_count, is_(0))
+        assert_that(batch, has_length(4))
+        # Received order is preserved across groups
+        assert_that(batch, contains(instance_of(ResourceEvent),
+                                    instance_of(SkipVideoEvent),
+                                    instance_of(CourseCatalogViewEvent),
+                                    instance_of(ResourceEvent)))
+        assert_that(progress, contains_inanyorder((resource_id, course),
+                                                  (video_id, course)))
+
+    def test_malformed(self):
+        username = u'sjohnson@nextthought.com'
+        events = self._events(username)
+        # No factory
+        events.append({'Class': 'Unknown', 'MimeType': 'application/unknown'})
+        events.append({'user': username})
+        # Invalid field value
+        bad_duration = dict(events[0])
+        bad_duration['Duration'] = u'thirty'
+        events.append(bad_duration)
+
+        batch, malformed_count, _ = internalize_events(events, username)
+        assert_that(malformed_count, is_(3))
+        assert_that(batch, has_length(3))
+
+    def test_remote_user_enforced(self):
+        events = self._events(u'someone_else')
+        batch, malformed_count, _ = internalize_events(events, u'remote_user')
+        assert_that(malformed_count, is_(0))
+        assert_that({x.user for x in batch}, contains(u'remote_user'))
+
+
+class _MockResolver(object):
+
+    def __init__(self, contexts, resources):
+        self.contexts = contexts
+        self.resources = resources
+
+    def completion_context(self, ntiid):
+        return self.contexts.get(ntiid)
+
+    def resource(self, ntiid):
+        return self.resources.get(ntiid)
+
+
+class TestProgressCoalescing(NTIAnalyticsTestCase):
+
+    def test_coalesce(self):
+        course = object()
+        resource1 = object()
+        resource2 = object()
+        # The course and its catalog entry share a completion context
+        resolver = _MockResolver({u'course': course,
+                                  u'entry': course,
+                                  u'book': None},
+                                 {u'resource1': resource1,
+                                  u'resource2': resource2})
+        pairs = {(u'resource1', u'course'),
+                 (u'resource1', u'entry'),
+                 (u'resource2', u'entry'),
+                 (u'resource2', u'book'),
+                 (u'missing', u'course')}
+        result = coalesce_progress_updates(pairs, resolver)
+        assert_that(result, has_length(1))
+        assert_that(result[course], contains_inanyorder(resource1, resource2))
+
+
+class _MockIntIds(object):
+
+    def __init__(self):
+        self.objects = {}
+
+    def queryId(self, obj):
+        return next((k for k, v in self.objects.items() if v is obj), None)
+
+    def queryObject(self, intid):
+        return self.objects.get(intid)
+
+
+class TestProgressNTIIDResolver(NTIAnalyticsTestCase):
+
+    def setUp(self):
+        super(TestProgressNTIIDResolver, self).setUp()
+        _ROOT_CONTEXT_INTIDS.clear()
+
+    def tearDown(self):
+        _ROOT_CONTEXT_INTIDS.clear()
+        super(TestProgressNTIIDResolver, self).tearDown()
+
+    @fudge.patch('nti.app.analytics.ingest.find_object_with_ntiid',
+                 'nti.app.analytics.ingest.statsd_client')
+    def test_resolver(self, mock_find, mock_statsd):
+        course = object()
+        resource = object()
+        objects = {u'course': course, u'resource': resource}
+        found = []
+
+        def _find(ntiid):
+            found.append(ntiid)
+            return objects.get(ntiid)
+        mock_find.is_callable().calls(_find)
+
+        intids = _MockIntIds()
+        intids.objects[42] = course
+
+        class _Resolver(ProgressNTIIDResolver):
+            _intids = intids
+
+        # Each NTIID is looked up once per batch
+        resolver = _Resolver()
+        assert_that(resolver.root_context(u'course'), is_(course))
+        assert_that(resolver.root_context(u'course'), is_(course))
+        assert_that(resolver.resource(u'resource'), is_(resource))
+        assert_that(resolver.resource(u'resource'), is_(resource))
+        assert_that(resolver.resource(u'missing'), is_(none()))
+        assert_that(resolver.resource(u'missing'), is_(none()))
+        assert_that(resolver.root_context(None), is_(none()))
+        assert_that(found, is_([u'course', u'resource', u'missing']))
+        assert_that(resolver.hits, is_(3))
+        assert_that(resolver.misses, is_(3))
+
+        statsd = fudge.Fake('statsd')
+        statsd.expects('incr').with_args('nti.analytics.ingest.resolver.hit', 3)
+        statsd.next_call().with_args('nti.analytics.ingest.resolver.miss', 3)
+        mock_statsd.is_callable().returns(statsd)
+        resolver.record_stats()
+
+        # Later batches find root contexts by their intid
+        del found[:]
+        resolver = _Resolver()
+        assert_that(resolver.root_context(u'course'), is_(course))
+        assert_that(found, is_([]))
+        assert_that(resolver.hits, is_(1))
+        assert_that(resolver.misses, is_(0))
+
+        # Unless the object is gone
+        intids.objects.clear()
+        resolver = _Resolver()
+        assert_that(resolver.root_context(u'course'), is_(course))
+        assert_that(found, is_([u'course']))
+        assert_that(resolver.misses, is_(1))
+
+
+class _MockQueue(object):
+
+    def __init__(self):
+        self.jobs = []
+
+    def put(self, job):
+        self.jobs.append(job)
+
+
+class TestQueuedProgress(NTIAnalyticsTestCase):
+
+    @fudge.patch('nti.app.analytics.ingest.get_factory')
+    def test_queued_dispatch(self, mock_factory):
+        queue = _MockQueue()
+        mock_factory.is_callable().returns_fake().provides('get_queue').returns(queue)
+
+        user = fudge.Fake('User').has_attr(username=u'student1')
+        dispatcher = QueuedProgressDispatcher()
+        # Nothing to do
+        dispatcher.dispatch(user, set())
+        assert_that(queue.jobs, has_length(0))
+
+        pairs = {(u'resource2', u'course'), (u'resource1', u'course')}
+        dispatcher.dispatch(user, pairs)
+        assert_that(queue.jobs, has_length(1))
+        job = queue.jobs[0]
+        assert_that(job.args[0], is_(u'student1'))
+        assert_that(job.args[2], contains((u'resource1', u'course'),
+                                          (u'resource2', u'course')))
+
+
+class TestStoredEvents(NTIAnalyticsTestCase):
+
+    @fudge.patch('nti.app.analytics.ingest.get_factory',
+                 'nti.app.analytics.ingest.getSite',
+                 'nti.app.analytics.ingest.User',
+                 'nti.app.analytics.ingest.record_events_stored')
+    def test_stored_events(self, mock_factory, mock_site, mock_user, mock_record):
+        queues = {}
+
+        def _get_queue(name):
+            return queues.setdefault(name, _MockQueue())
+        mock_factory.is_callable().returns_fake().provides('get_queue').calls(_get_queue)
+        mock_site.is_callable().returns(None)
+        user = fudge.Fake('User').has_attr(username=u'student1')
+        mock_user.provides('get_user').with_args(u'student1').returns(user)
+
+        # Nothing to do
+        queue_stored_events(user, [])
+        assert_that(queues, has_length(0))
+
+        events = [ResourceEvent(user=u'student1',
+                                timestamp=20,
+                                RootContextID=course,
+                                ResourceId=resource_id),
+                  CourseCatalogViewEvent(user=u'student1',
+                                         timestamp=10,
+                                         RootContextID=course)]
+        queue_stored_events(user, events)
+
+        # The job runs on each queue in turn, behind the jobs already
+        # there, then records the events stored
+        for name in QUEUE_NAMES:
+            assert_that(queues[name].jobs, has_length(1))
+            job = queues[name].jobs.pop()
+            assert_that(job.args[1], is_(u'student1'))
+            assert_that(job.args[3], contains((course, 10), (course, 20)))
+            if name == QUEUE_NAMES[-1]:
+                mock_record.expects_call().with_args(user, job.args[3])
+            _process_stored_events(*job.args)
+        assert_that(queues[QUEUE_NAMES[0]].jobs, has_length(0))
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import has_length
+from hamcrest import assert_that
+
+import unittest
+
+from nti.app.analytics.aggregation import AggregateRow
+
+from nti.app.analytics.materialized import AGGREGATE_QUERIES
+
+from nti.app.analytics.materialized import _aggregate_cache
+from nti.app.analytics.materialized import get_course_aggregates
+from nti.app.analytics.materialized import invalidate_course_aggregates
+
+
+class _FakeQuery(object):
+    """
+    Aggregates (resource, username, session, duration) events the way
+    the analytics database would.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.calls = []
+
+    def add(self, *events):
+        self.events.extend(events)
+
+    def __call__(self, unused_course):
+        self.calls.append(unused_course)
+        result = {}
+        for resource, username, session, duration in self.events:
+            key = (resource, username, session)
+            count, total = result.get(key, (0, 0))
+            result[key] = (count + 1, total + duration)
+        return [AggregateRow(resource, username, session, count, total,
+                             0, None, None)
+                for (resource, username, session), (count, total)
+                in result.items()]
+
+
+class _Course(object):
+    ntiid = u'tag:nextthought.com,2011-10:course'
+
+
+def _totals(rows):
+    return sorted((x.resource_id, x.username, x.session_id,
+                   x.event_count, x.total_view_time) for x in rows)
+
+
+class TestMaterializedAggregates(unittest.TestCase):
+
+    def test_course_aggregates(self):
+        query = _FakeQuery()
+        query.add((u'r1', u'u1', 1, 10),
+                  (u'r1', u'u1', 1, 20),
+                  (u'r2', u'u2', None, 5))
+        course = _Course()
+        AGGREGATE_QUERIES[u'test'] = query
+        _aggregate_cache.clear()
+        try:
+            rows = get_course_aggregates(course, u'test')
+            assert_that(_totals(rows), is_([(u'r1', u'u1', 1, 2, 30),
+                                            (u'r2', u'u2', None, 1, 5)]))
+
+            # Served from memory until invalidated; every read is of
+            # all of the course's events.
+            query.add((u'r2', u'u2', None, 5))
+            assert_that(get_course_aggregates(course, u'test'), is_(rows))
+            assert_that(query.calls, is_([course]))
+            invalidate_course_aggregates((course.ntiid,))
+            rows = get_course_aggregates(course, u'test')
+            assert_that(_totals(rows), is_([(u'r1', u'u1', 1, 2, 30),
+                                            (u'r2', u'u2', None, 2, 10)]))
+            assert_that(query.calls, has_length(2))
+        finally:
+            del AGGREGATE_QUERIES[u'test']
+            _aggregate_cache.clear()
+
+    def test_unknown_course(self):
+        AGGREGATE_QUERIES[u'test'] = lambda *args, **kwargs: None
+        try:
+            result = get_course_aggregates(_Course(), u'test')
+            assert_that(result, none())
+        finally:
+            del AGGREGATE_QUERIES[u'test']
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import close_to
+from hamcrest import assert_that
+
+import unittest
+
+import fudge
+
+from nti.app.analytics.ratelimit import QueueBackpressure
+from nti.app.analytics.ratelimit import InMemoryRateLimiter
+
+
+class TestRateLimit(unittest.TestCase):
+
+    @fudge.patch('nti.app.analytics.ratelimit.time.time')
+    def test_token_bucket(self, mock_time):
+        mock_time.is_callable().returns(1000)
+        limiter = InMemoryRateLimiter(rate=2, capacity=3)
+        # Burst up to capacity
+        for _ in range(3):
+            assert_that(limiter.consume(u'user1'), is_(0))
+        assert_that(limiter.consume(u'user1'), close_to(0.5, 0.001))
+        # Other users have their own bucket
+        assert_that(limiter.consume(u'user2'), is_(0))
+
+        # Refilled at our rate
+        mock_time.is_callable().returns(1000.5)
+        assert_that(limiter.consume(u'user1'), is_(0))
+        assert_that(limiter.consume(u'user1'), close_to(0.5, 0.001))
+
+        # Never refilled beyond capacity
+        mock_time.is_callable().returns(2000)
+        for _ in range(3):
+            assert_that(limiter.consume(u'user1'), is_(0))
+        assert_that(limiter.consume(u'user1'), close_to(0.5, 0.001))
+
+
+class _MockQueue(object):
+
+    def __init__(self, length):
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+
+class _UnreachableQueue(object):
+
+    def __len__(self):
+        raise IOError('Connection refused')
+
+
+class TestQueueBackpressure(unittest.TestCase):
+
+    @fudge.patch('nti.app.analytics.ratelimit.get_factory')
+    def test_backpressure(self, mock_factory):
+        queue = _MockQueue(10)
+        mock_factory.is_callable().returns_fake().provides('get_queue').returns(queue)
+
+        backpressure = QueueBackpressure(threshold=20, retry_after=30)
+        assert_that(backpressure.check(), is_(0))
+
+        # Sampled lengths are reused within our interval
+        queue.length = 100
+        assert_that(backpressure.check(), is_(0))
+        backpressure._sampled = 0
+        assert_that(backpressure.check(), is_(30))
+
+        backpressure.threshold = None
+        assert_that(backpressure.check(), is_(0))
+
+    @fudge.patch('nti.app.analytics.ratelimit.get_factory')
+    def test_unreachable_queues(self, mock_factory):
+        queue = _UnreachableQueue()
+        mock_factory.is_callable().returns_fake().provides('get_queue').returns(queue)
+
+        # Unknown lengths apply no backpressure
+        backpressure = QueueBackpressure(threshold=20, retry_after=30)
+        assert_that(backpressure.queue_length(), is_(none()))
+        assert_that(backpressure.check(), is_(0))
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import has_length
+from hamcrest import assert_that
+
+import fudge
+
+import datetime
+import unittest
+
+from array import array
+
+from nti.app.analytics.aggregation import SegmentRow
+
+from nti.app.analytics.materialized import REFRESH_SECONDS
+
+from nti.app.analytics.retention import DAY_SECONDS
+from nti.app.analytics.retention import _EMPTY_RETENTION
+from nti.app.analytics.retention import add_segments
+from nti.app.analytics.retention import bucket_counts
+from nti.app.analytics.retention import viewer_counts
+from nti.app.analytics.retention import refresh_retention
+from nti.app.analytics.retention import get_video_retention
+from nti.app.analytics.retention import invalidate_video_retention
+
+
+class _FakeQuery(object):
+    """
+    Aggregates (row id, start, end, timestamp) watch events the way the
+    analytics database would.
+    """
+
+    def __init__(self, *events):
+        self.events = list(events)
+        self.calls = []
+
+    def __call__(self, unused_course, unused_ntiid, before=None, since=None,
+                 after=None):
+        self.calls.append((before, since, after))
+        result = {}
+        for row_id, start, end, timestamp in self.events:
+            timestamp = datetime.datetime.utcfromtimestamp(timestamp)
+            if before is not None and timestamp >= before:
+                continue
+            if      since is not None and timestamp < since \
+                and (after is None or row_id <= after):
+                continue
+            count, max_row_id = result.get((start, end), (0, row_id))
+            result[(start, end)] = (count + 1, max(row_id, max_row_id))
+        return [SegmentRow(start, end, count, max_row_id)
+                for (start, end), (count, max_row_id) in result.items()]
+
+
+class _Course(object):
+    ntiid = u'tag:nextthought.com,2011-10:course'
+
+
+class TestRetention(unittest.TestCase):
+
+    def setUp(self):
+        invalidate_video_retention()
+
+    def tearDown(self):
+        invalidate_video_retention()
+
+    def test_counts(self):
+        deltas = add_segments(array('l'), ((0, 10, 1),
+                                           (15, 35, 2),
+                                           (60, 90, 1),
+                                           # Skipped
+                                           (20, 20, 5),
+                                           (None, 30, 5)))
+        counts = viewer_counts(deltas)
+        assert_that(counts, has_length(90))
+        assert_that(counts, is_([1] * 10 + [0] * 5 + [2] * 20 +
+                                [0] * 25 + [1] * 30))
+        assert_that(bucket_counts(counts, 10),
+                    is_([1, 2, 2, 2, 0, 0, 1, 1, 1]))
+
+        # Segments cover every second they overlap
+        deltas = add_segments(array('l'), ((2.5, 4.2, 1),))
+        assert_that(viewer_counts(deltas), is_([0, 0, 1, 1, 1]))
+        assert_that(viewer_counts(array('l')), is_([]))
+
+    def test_refresh(self):
+        now = 10 * DAY_SECONDS + 100
+        old = 5 * DAY_SECONDS
+        recent = now - 200
+        query = _FakeQuery((1, 0, 10, old), (2, 0, 10, old), (4, 5, 15, recent))
+        with fudge.patch('nti.app.analytics.retention.get_video_segment_aggregates') as mock_query:
+            mock_query.is_callable().calls(query)
+
+            # Events that can no longer be updated are folded in
+            state = refresh_retention(_EMPTY_RETENTION, None, u'video', now=now)
+            assert_that(state.counts, is_([2] * 5 + [3] * 5 + [1] * 5))
+            assert_that(state.closed, is_(9 * DAY_SECONDS))
+            assert_that(state.max_row_id, is_(2))
+            assert_that(viewer_counts(state.deltas), is_([2] * 10))
+
+            # Updates to recent events (e.g. heartbeats) are read again,
+            # as are late events, whatever their timestamp
+            query.events[2] = (4, 5, 25, recent)
+            query.events.append((3, 0, 20, old))
+            query.events.append((5, 30, 35, old))
+            state = refresh_retention(state, None, u'video', now=now + 10)
+            assert_that(state.counts,
+                        is_([3] * 5 + [4] * 5 + [2] * 10 + [1] * 5 +
+                            [0] * 5 + [1] * 5))
+            assert_that(query.calls[-1],
+                        is_((None, datetime.datetime.utcfromtimestamp(9 * DAY_SECONDS), 2)))
+            assert_that(query.calls, has_length(3))
+
+            # The next day, deleted events are dropped
+            del query.events[0]
+            state = refresh_retention(state, None, u'video',
+                                      now=now + DAY_SECONDS)
+            assert_that(state.closed, is_(10 * DAY_SECONDS))
+            assert_that(state.max_row_id, is_(5))
+            assert_that(state.counts,
+                        is_([2] * 5 + [3] * 5 + [2] * 10 + [1] * 5 +
+                            [0] * 5 + [1] * 5))
+
+            # Unknown courses
+            mock_query.is_callable().returns(None)
+            assert_that(refresh_retention(_EMPTY_RETENTION, None, u'video'),
+                        is_(none()))
+
+    def test_get_video_retention(self):
+        course = _Course()
+        now = 10 * DAY_SECONDS + 100
+        query = _FakeQuery((1, 0, 10, now), (2, 5, 20, now))
+        with fudge.patch('nti.app.analytics.retention.get_video_segment_aggregates',
+                         'nti.app.analytics.retention.time') as (mock_query, mock_time):
+            mock_query.is_callable().calls(query)
+            mock_time.provides('time').returns(now)
+            result = get_video_retention(course, u'video', 5)
+            assert_that(result, is_([1, 2, 1, 1]))
+
+            # Served from memory
+            query.events.append((3, 0, 20, now))
+            assert_that(get_video_retention(course, u'video', 5),
+                        is_([1, 2, 1, 1]))
+            assert_that(query.calls, has_length(2))
+
+            # Until refreshed
+            mock_time.provides('time').returns(now + REFRESH_SECONDS)
+            assert_that(get_video_retention(course, u'video', 5),
+                        is_([2, 3, 2, 2]))
+            assert_that(query.calls, has_length(3))
+
+            mock_query.is_callable().returns(None)
+            assert_that(get_video_retention(course, u'other'),
+                        is_(none()))
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+from hamcrest import is_
+from hamcrest import has_length
+from hamcrest import assert_that
+
+import fudge
+import calendar
+import datetime
+import unittest
+
+from collections import namedtuple
+
+from nti.app.analytics.rollup import ACTIVE_TIMES
+from nti.app.analytics.rollup import DAY_SECONDS
+from nti.app.analytics.rollup import HOUR_SECONDS
+from nti.app.analytics.rollup import DAILY_ACTIVITY
+
+from nti.app.analytics.rollup import ActivityRollup
+from nti.app.analytics.rollup import fold_rollup
+from nti.app.analytics.rollup import read_active_times
+from nti.app.analytics.rollup import read_daily_activity
+from nti.app.analytics.rollup import rewind_activity_rollups
+
+_Stat = namedtuple('_Stat', ('Count',))
+
+#: A Monday
+_START = calendar.timegm((2018, 3, 5, 0, 0, 0))
+
+
+def _datetime(seconds):
+    return datetime.datetime.utcfromtimestamp(seconds)
+
+
+def _date(seconds):
+    return _datetime(seconds).date()
+
+
+class _Source(object):
+    """
+    Counts events (by timestamp) the way the stats sources would.
+    """
+
+    def __init__(self, *timestamps):
+        self.timestamps = list(timestamps)
+        self.calls = []
+
+    def _window(self, start, end):
+        self.calls.append((start, end))
+        start = calendar.timegm(start.utctimetuple())
+        end = calendar.timegm(end.utctimetuple())
+        return [_datetime(x) for x in self.timestamps if start <= x < end]
+
+    def active_times_for_window(self, start, end):
+        result = [[_Stat(0)] * 24 for _ in range(7)]
+        for when in self._window(start, end):
+            count = result[when.weekday()][when.hour].Count
+            result[when.weekday()][when.hour] = _Stat(count + 1)
+        return result
+
+    def stats_for_window(self, start, end):
+        result = {}
+        for when in self._window(start, end):
+            day = datetime.date(when.year, when.month, when.day)
+            result[day] = _Stat(result.get(day, _Stat(0)).Count + 1)
+        return result
+
+
+class TestRollup(unittest.TestCase):
+
+    def test_active_times(self):
+        # Two events in the first hour, one a week and a day later, one
+        # on the last (unsettled) day
+        source = _Source(_START + 10, _START + 20,
+                         _START + 8 * DAY_SECONDS + 3 * HOUR_SECONDS,
+                         _START + 13 * DAY_SECONDS + HOUR_SECONDS)
+        rollup = ActivityRollup()
+        now = _START + 13 * DAY_SECONDS + 2 * HOUR_SECONDS
+        expected = [[0] * 24 for _ in range(7)]
+        expected[0][0] = 2
+        expected[1][3] = 1
+        expected[6][1] = 1
+        counts, missing = read_active_times(rollup, source,
+                                            _datetime(_START), _datetime(now),
+                                            now=now)
+        # Reads never fold, asking the source once for the cold window
+        assert_that(counts, is_(expected))
+        assert_that(missing, is_([(_START, _START + 13 * DAY_SECONDS)]))
+        assert_that(list(rollup.segments), is_([]))
+        assert_that(source.calls, is_([(_datetime(_START), _datetime(now))]))
+
+        # Folds ask a week at a time
+        fold_rollup(rollup, ACTIVE_TIMES, source, missing)
+        assert_that(dict(rollup.segments),
+                    is_({_START: _START + 13 * DAY_SECONDS}))
+        assert_that(source.calls, has_length(3))
+
+        # Later reads only ask for the unsettled and partial days
+        del source.calls[:]
+        counts, missing = read_active_times(rollup, source,
+                                            _datetime(_START + 1), _datetime(now),
+                                            now=now)
+        assert_that(counts, is_(expected))
+        assert_that(missing, is_([]))
+        assert_that(source.calls,
+                    is_([(_datetime(_START + 1), _datetime(_START + DAY_SECONDS)),
+                         (_datetime(_START + 13 * DAY_SECONDS), _datetime(now))]))
+
+    def test_daily_activity(self):
+        source = _Source(_START + 10, _START + 2 * DAY_SECONDS)
+        rollup = ActivityRollup()
+        now = _START + 40 * DAY_SECONDS
+        end = _START + 35 * DAY_SECONDS
+        # Folds ask for the whole range at once
+        fold_rollup(rollup, DAILY_ACTIVITY, source, [(_START, end)])
+        assert_that(source.calls, has_length(1))
+
+        # Earlier windows are kept as a separate segment, folding only
+        # the requested days
+        source.timestamps.append(_START - 9 * DAY_SECONDS)
+        fold_rollup(rollup, DAILY_ACTIVITY, source,
+                    [(_START - 10 * DAY_SECONDS, _START - 8 * DAY_SECONDS)])
+        assert_that(dict(rollup.segments),
+                    is_({_START - 10 * DAY_SECONDS: _START - 8 * DAY_SECONDS,
+                         _START: end}))
+
+        del source.calls[:]
+        counts, missing = read_daily_activity(rollup, source,
+                                              _datetime(_START - 10 * DAY_SECONDS),
+                                              _datetime(end), now=now)
+        assert_that(counts, is_({_date(_START - 9 * DAY_SECONDS): 1,
+                                 _date(_START): 1,
+                                 _date(_START + 2 * DAY_SECONDS): 1}))
+        assert_that(missing, is_([(_START - 8 * DAY_SECONDS, _START)]))
+        assert_that(source.calls,
+                    is_([(_datetime(_START - 8 * DAY_SECONDS), _datetime(_START))]))
+
+        # Folding the gap joins the segments
+        fold_rollup(rollup, DAILY_ACTIVITY, source, missing)
+        assert_that(dict(rollup.segments),
+                    is_({_START - 10 * DAY_SECONDS: end}))
+
+        # Late events are read once their day is rewound
+        source.timestamps.append(_START + 2 * DAY_SECONDS + 5)
+        assert_that(rollup.rewind(_START + 2 * DAY_SECONDS + 5), is_(True))
+        assert_that(dict(rollup.segments),
+                    is_({_START - 10 * DAY_SECONDS: _START + 2 * DAY_SECONDS,
+                         _START + 3 * DAY_SECONDS: end}))
+        assert_that(rollup.rewind(now), is_(False))
+        counts, missing = read_daily_activity(rollup, source,
+                                              _datetime(_START), _datetime(end),
+                                              now=now)
+        assert_that(counts, is_({_date(_START): 1,
+                                 _date(_START + 2 * DAY_SECONDS): 2}))
+        assert_that(missing, is_([(_START + 2 * DAY_SECONDS,
+                                   _START + 3 * DAY_SECONDS)]))
+
+    @fudge.patch('nti.app.analytics.rollup._queue_rollup_job')
+    def test_rewind(self, mock_queue):
+        now = _START + 10 * DAY_SECONDS
+        late = _START + 2 * DAY_SECONDS + 5
+        ntiid = u'tag:nextthought.com,2011-10:course'
+        # Only the days of late events are rewound, one job per context
+        mock_queue.expects_call().with_args(None, rewinds=[_START + 2 * DAY_SECONDS])
+        mock_queue.next_call().with_args(ntiid, rewinds=[_START + 2 * DAY_SECONDS])
+        rewind_activity_rollups([(None, [late, now - 5]),
+                                 (ntiid, [_datetime(late), late + 10]),
+                                 (u'tag:other', [now - 5])],
+                                now=now)
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import has_length
+from hamcrest import assert_that
+
+import time
+import datetime
+import threading
+import unittest
+
+from zope import interface
+
+from zope.annotation.interfaces import IAnnotations
+
+from nti.app.analytics.stats_cache import UNMARKED_SECONDS
+from nti.app.analytics.stats_cache import HISTORICAL_SECONDS
+
+from nti.app.analytics.stats_cache import ActivityMarker
+
+from nti.app.analytics.stats_cache import daily_expires
+from nti.app.analytics.stats_cache import get_stats_version
+from nti.app.analytics.stats_cache import get_activity_marker
+from nti.app.analytics.stats_cache import mark_activity_stored
+from nti.app.analytics.stats_cache import stats_cache_key
+from nti.app.analytics.stats_cache import stats_cache_scope
+from nti.app.analytics.stats_cache import historical_expires
+from nti.app.analytics.stats_cache import get_daily_expiration
+from nti.app.analytics.stats_cache import RedisStatsResultCache
+from nti.app.analytics.stats_cache import InMemoryStatsResultCache
+
+from nti.analytics.stats.interfaces import IDailyActivityStatsSource
+
+
+class _Compute(object):
+
+    def __init__(self, value, delay=0):
+        self.value = value
+        self.delay = delay
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.delay:
+            time.sleep(self.delay)
+        return self.value
+
+
+class _Redis(object):
+    """
+    The few redis commands we use, in memory (ignoring expiry).
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, nx=False, ex=None): # pylint: disable=unused-argument
+        with self.lock:
+            if nx and key in self.values:
+                return None
+            self.values[key] = value
+            return True
+
+    def setex(self, key, unused_ttl, value):
+        self.values[key] = value
+
+    def delete(self, key):
+        self.values.pop(key, None)
+
+    def exists(self, key):
+        return key in self.values
+
+
+class _Course(object):
+    ntiid = u'tag:nextthought.com,2011-10:course'
+
+
+@interface.implementer(IAnnotations)
+class _Annotated(dict):
+    """
+    A context that is its own annotations.
+    """
+
+
+class TestStatsCache(unittest.TestCase):
+
+    def test_expiration(self):
+        now = datetime.datetime(2018, 3, 4, 22, 30, 15)
+        assert_that(get_daily_expiration(now),
+                    is_(datetime.datetime(2018, 3, 5)))
+        epoch = (now - datetime.datetime(1970, 1, 1)).total_seconds()
+        assert_that(daily_expires(epoch), is_(epoch + 5385))
+        assert_that(historical_expires(epoch),
+                    is_(epoch + HISTORICAL_SECONDS))
+
+    def test_key(self):
+        start = datetime.datetime(2018, 3, 4, 1, 2, 3, 456)
+        assert_that(stats_cache_scope(u'site', _Course()),
+                    is_(u'site/tag:nextthought.com,2011-10:course'))
+        assert_that(stats_cache_scope(u'site', _Course.ntiid),
+                    is_(u'site/tag:nextthought.com,2011-10:course'))
+        assert_that(stats_cache_scope(None, None), is_(u'/'))
+        key = stats_cache_key(IDailyActivityStatsSource,
+                              start, None, datetime.date(2018, 3, 5))
+        assert_that(key,
+                    is_(u'nti.analytics.stats.interfaces.IDailyActivityStatsSource/'
+                        u'2018-03-04T01:02:03//2018-03-05'))
+        key = stats_cache_key(IDailyActivityStatsSource, 'last', 90)
+        assert_that(key,
+                    is_(u'nti.analytics.stats.interfaces.IDailyActivityStatsSource/'
+                        u'last/90'))
+
+    def _check_cache(self, cache):
+        compute = _Compute({u'2018-03-04': 3})
+        expires = time.time() + 60
+        assert_that(cache.get_or_compute(u'scope', u'key', compute, expires),
+                    is_({u'2018-03-04': 3}))
+        assert_that(cache.get_or_compute(u'scope', u'key', compute, expires),
+                    is_({u'2018-03-04': 3}))
+        assert_that(compute.calls, is_(1))
+
+        # Expired results are never stored
+        other = _Compute([1, 2])
+        cache.get_or_compute(u'scope', u'other', other, time.time() - 1)
+        cache.get_or_compute(u'scope', u'other', other, time.time() - 1)
+        assert_that(other.calls, is_(2))
+
+        # Failures are not cached
+        def _fail():
+            raise ValueError()
+        self.assertRaises(ValueError, cache.get_or_compute,
+                          u'scope', u'failed', _fail, expires)
+        assert_that(cache.get_or_compute(u'scope', u'failed', other, expires),
+                    is_([1, 2]))
+
+        # Scopes are separate
+        cache.get_or_compute(u'other-scope', u'key', compute, expires)
+        assert_that(compute.calls, is_(2))
+
+    def _check_single_flight(self, cache):
+        compute = _Compute({u'a': 1}, delay=0.2)
+        results = []
+        expires = time.time() + 60
+
+        def _load():
+            results.append(cache.get_or_compute(u'scope', u'flight', compute, expires))
+        threads = [threading.Thread(target=_load) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert_that(results, has_length(5))
+        assert_that(results, is_([{u'a': 1}] * 5))
+        assert_that(compute.calls, is_(1))
+
+    def test_in_memory(self):
+        self._check_cache(InMemoryStatsResultCache())
+        self._check_single_flight(InMemoryStatsResultCache())
+
+    def test_redis(self):
+        self._check_cache(RedisStatsResultCache(_Redis()))
+        cache = RedisStatsResultCache(_Redis())
+        cache.poll_interval = 0.01
+        self._check_single_flight(cache)
+
+    def test_version(self):
+        # Contexts without markers, like the site, change version
+        # periodically
+        now = 1520202615.5
+        version, lapses = get_stats_version(None, now)
+        assert_that(version, is_(now - now % UNMARKED_SECONDS))
+        assert_that(lapses, is_(version + UNMARKED_SECONDS))
+        assert_that(get_stats_version(_Course(), now), is_((version, lapses)))
+
+        # Marked contexts change when events are stored for them
+        context = _Annotated()
+        assert_that(get_stats_version(context), is_((0, None)))
+        assert_that(get_activity_marker(context), is_(none()))
+        mark_activity_stored([context, _Course()], now=now)
+        assert_that(get_stats_version(context), is_((now, None)))
+        mark_activity_stored([context], now=now - 1)
+        assert_that(get_activity_marker(context).stored, is_(now))
+
+        # Concurrent marks keep the latest
+        marker = ActivityMarker()
+        assert_that(marker._p_resolveConflict({}, {'stored': 2}, {'stored': 1}),
+                    is_({'stored': 2}))
+        assert_that(marker._p_resolveConflict({}, {'stored': 1}, {'stored': 2}),
+                    is_({'stored': 2}))
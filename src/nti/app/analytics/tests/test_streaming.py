@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+from hamcrest import is_
+from hamcrest import calling
+from hamcrest import raises
+from hamcrest import has_entries
+from hamcrest import assert_that
+
+import json
+import unittest
+
+from io import BytesIO
+
+from nti.app.analytics.streaming import MalformedJSONError
+from nti.app.analytics.streaming import JSONValueTooLargeError
+from nti.app.analytics.streaming import StreamingJSONReader
+
+from nti.app.analytics.streaming import iter_json_array
+
+
+class TestStreamingJSONReader(unittest.TestCase):
+
+    doc = {
+        'MimeType': 'application/vnd.nextthought.analytics.batchevents',
+        'events': [
+            {'MimeType': 'a', 'Duration': 30, 'label': u'é€'},
+            {'MimeType': 'b', 'timestamp': 1234567890.123, 'Count': -1.5e-3},
+            None,
+            [1, 2, True],
+        ],
+        'timestamp': 1234,
+    }
+
+    def _stream(self, doc):
+        return BytesIO(json.dumps(doc, ensure_ascii=False).encode('utf-8'))
+
+    def test_chunk_boundaries(self):
+        # Small chunks split keys, numbers and multi-byte characters
+        for chunk_size in (1, 2, 3, 7, 1024):
+            reader = StreamingJSONReader(self._stream(self.doc),
+                                         chunk_size=chunk_size)
+            items = list(reader.iter_items('events'))
+            assert_that(items, is_(self.doc['events']))
+            assert_that(reader.values,
+                        has_entries('MimeType', self.doc['MimeType'],
+                                    'timestamp', 1234))
+
+    def test_nested_path(self):
+        doc = {'timestamp': 1,
+               'batch_events': {'MimeType': 'x', 'events': [{'a': 1}]}}
+        reader = StreamingJSONReader(self._stream(doc), chunk_size=2)
+        items = list(reader.iter_items(('Batch_Events', 'events')))
+        assert_that(items, is_([{'a': 1}]))
+        assert_that(reader.values, is_({'timestamp': 1}))
+
+    def test_missing(self):
+        for body in (b'', b' \n', b'{}', b'{"events": null}', b'{"events": []}',
+                     b'{"batch_events": null}'):
+            assert_that(list(iter_json_array(BytesIO(body), 'events')),
+                        is_([]))
+
+    def test_malformed(self):
+        for body in (b'[1]', b'{"events": [1,}', b'{"events": [1',
+                     b'{"events": [1]} x', b'{"events" [1]}', b'{"events": [1.]}'):
+            assert_that(calling(list).with_args(iter_json_array(BytesIO(body), 'events', chunk_size=1)),
+                        raises(MalformedJSONError))
+
+    def test_max_value_size(self):
+        doc = {'events': [{'a': u'x' * 10}, {'a': u'x' * 100}]}
+        for chunk_size in (1, 7, 1024):
+            items = iter_json_array(self._stream(doc), 'events',
+                                    chunk_size=chunk_size, max_value_size=50)
+            assert_that(next(items), is_(doc['events'][0]))
+            assert_that(calling(next).with_args(items),
+                        raises(JSONValueTooLargeError))
+
+        # Other values are bounded too
+        doc = {'MimeType': u'x' * 100, 'events': []}
+        assert_that(calling(list).with_args(iter_json_array(self._stream(doc), 'events',
+                                                            max_value_size=50)),
+                    raises(JSONValueTooLargeError))
+        assert_that(list(iter_json_array(self._stream(doc), 'events',
+                                         max_value_size=None)),
+                    is_([]))
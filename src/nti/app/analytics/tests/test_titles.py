@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+from hamcrest import is_
+from hamcrest import assert_that
+
+import fudge
+
+import unittest
+
+from nti.app.analytics.titles import TitleResolver
+from nti.app.analytics.titles import invalidate_titles
+
+
+class _Asset(object):
+
+    def __init__(self, title=None, label=None, path=None):
+        self.title = title
+        self.label = label
+        if path is not None:
+            self.path = path
+
+
+class _Target(object):
+
+    def __init__(self, ntiid):
+        self.ntiid = ntiid
+
+
+class TestTitleResolver(unittest.TestCase):
+
+    def setUp(self):
+        invalidate_titles()
+
+    def tearDown(self):
+        invalidate_titles()
+
+    @fudge.patch('nti.app.analytics.titles.find_object_with_ntiid')
+    def test_resolve(self, mock_find):
+        lookups = []
+
+        def _find(ntiid):
+            lookups.append(ntiid)
+            return {u'package': _Asset(title=u'Package'),
+                    u'unit': _Asset(label=u'Unit')}.get(ntiid)
+        mock_find.is_callable().calls(_find)
+
+        container = {u'video': _Asset(title=u'Video'),
+                     u'card': _Asset(path=[_Target(u'unit')]),
+                     u'empty': _Asset()}
+        resolver = TitleResolver(container)
+        result = resolver.resolve((u'video', u'card', u'package',
+                                   u'empty', u'missing'))
+        assert_that(result, is_({u'video': u'Video',
+                                 u'card': u'Unit',
+                                 u'package': u'Package',
+                                 u'empty': None,
+                                 u'missing': None}))
+        # Assets are found in the container first
+        assert_that(lookups, is_([u'unit', u'package', u'missing']))
+
+        # Titles (including missing ones) are cached across resolvers
+        del lookups[:]
+        resolver = TitleResolver()
+        assert_that(resolver.get_title(u'video'), is_(u'Video'))
+        assert_that(resolver.get_title(u'missing'), is_(None))
+        assert_that(lookups, is_([]))
+
+        invalidate_titles((u'video',))
+        assert_that(resolver.get_title(u'video'), is_(None))
+        assert_that(resolver.get_title(u'package'), is_(u'Package'))
+        assert_that(lookups, is_([u'video']))
+
+        invalidate_titles()
+        assert_that(resolver.get_title(u'package'), is_(u'Package'))
+        assert_that(lookups, is_([u'video', u'package']))
@@ -16,9 +16,25 @@ from hamcrest import assert_that
 from hamcrest import contains_string
 from hamcrest import contains_inanyorder
 
+import time
+
 import fudge
 
+from nti.analytics.database.resource_views import create_video_event
+from nti.analytics.database.resource_views import create_course_resource_view
+
+from nti.analytics.database.root_context import get_root_context_id
+
+from nti.analytics.database.users import create_user
+
+from nti.app.analytics.materialized import _aggregate_cache
+from nti.app.analytics.materialized import invalidate_course_aggregates
+
 from nti.app.analytics.usage_stats import ALL_USERS
+from nti.app.analytics.usage_stats import _ADMIN_USERNAMES
+from nti.app.analytics.usage_stats import _ENROLLMENT_SCOPES
+from nti.app.analytics.usage_stats import get_enrollment_scope_dict
+from nti.app.analytics.usage_stats import invalidate_enrollment_scopes
 from nti.app.analytics.usage_stats import CourseVideoUsageStats
 from nti.app.analytics.usage_stats import CourseResourceUsageStats
 from nti.app.analytics.usage_stats import UserCourseVideoUsageStats
@@ -26,10 +42,27 @@ from nti.app.analytics.usage_stats import UserCourseResourceUsageStats
 
 from nti.app.analytics.tests import NTIAnalyticsTestCase
 
+from nti.app.analytics.tests.test_views import course
+from nti.app.analytics.tests.test_views import resource_id
+from nti.app.analytics.tests.test_views import _AbstractTestViews
+
+from nti.app.testing.decorators import WithSharedApplicationMockDS
+
 from nti.contenttypes.courses.courses import ContentCourseInstance
 
+from nti.contenttypes.courses.interfaces import ICourseInstance
+
+from nti.dataserver.tests import mock_dataserver
+
 from nti.dataserver.tests.mock_dataserver import WithMockDSTrans
 
+from nti.dataserver.users.users import User
+
+from nti.ntiids.ntiids import find_object_with_ntiid
+
+video_id = u'tag:nextthought.com,2011-10:OU-NTIVideo-CLC3403_LawAndJustice.ntivideo.video_01'
+
+
 class MockUser(object):
 
     def __init__(self, username):
@@ -363,6 +396,14 @@ class TestUsageStats(NTIAnalyticsTestCase):
         assert_that(drop_off.drop100count, is_(4))
         assert_that(drop_off.drop100percentage, is_(50))
 
+        # Finer grained curves
+        curve = video_stats.get_drop_off_curve(single_resource_id, 4)
+        assert_that(curve, is_([0, 3, 1, 4]))
+        curve = video_stats.get_drop_off_curve(single_resource_id)
+        assert_that(curve, has_length(20))
+        assert_that(sum(curve), is_(8))
+        assert_that(video_stats.get_drop_off_curve(u'missing'), is_(none()))
+
         # User stats
         video_stats = self.get_user_video_stats('Public1')
         results = video_stats.get_stats()
@@ -386,3 +427,235 @@ class TestUsageStats(NTIAnalyticsTestCase):
         video_stats = self.get_user_video_stats('Public3')
         results = video_stats.get_stats()
         assert_that(results, has_length(0))
+
+    @WithMockDSTrans
+    @fudge.patch('nti.app.analytics.usage_stats.get_resource_views',
+                 'nti.app.analytics.usage_stats._AbstractUsageStats._get_title',
+                 'nti.app.analytics.usage_stats._get_enrollment_scope_dict')
+    def test_scoped_usage_stats(self, mock_events, mock_get_title,
+                                mock_enrollment):
+        mock_get_title.is_callable().returns('test title')
+        mock_enrollment.is_callable().returns(self.enrollment_dict)
+
+        class _Events(list):
+            iterations = 0
+
+            def __iter__(self):
+                _Events.iterations += 1
+                return super(_Events, self).__iter__()
+
+        events = _Events()
+        events.append(MockEvent('Public1', u'ntiid1', 10, 1, 3))
+        events.append(MockEvent('Public2', u'ntiid1', 10, 2, 3))
+        events.append(MockEvent('ForCredit1', u'ntiid1', 20, 3, 3))
+        events.append(MockEvent('ForCredit1', u'ntiid2', 20, 3, 3))
+        mock_events.is_callable().returns(events)
+
+        resource_stats = self.get_resource_stats()
+        all_results = resource_stats.get_stats()
+        # Only the requested scope is built
+        assert_that(resource_stats.scope_result_set_map, has_length(1))
+        public_results = resource_stats.get_stats('Public')
+        credit_results = resource_stats.get_stats('ForCredit')
+        # A single pass for all scopes
+        assert_that(_Events.iterations, is_(1))
+
+        assert_that(all_results, has_length(2))
+        assert_that(all_results[0].view_event_count, is_(3))
+        assert_that(all_results[0].total_view_time, is_(40))
+
+        assert_that(public_results, has_length(1))
+        assert_that(public_results[0].view_event_count, is_(2))
+        assert_that(public_results[0].total_view_time, is_(20))
+
+        assert_that(credit_results, has_length(2))
+        assert_that(credit_results[0].view_event_count, is_(1))
+        assert_that(credit_results[0].total_view_time, is_(20))
+
+        # Per-user stats are not double counted across scopes
+        user_stats = resource_stats.get_stats_for_user('ForCredit1')
+        assert_that(user_stats.event_count, is_(2))
+        assert_that(user_stats.total_view_time, is_(40))
+
+    @WithMockDSTrans
+    @fudge.patch('nti.app.analytics.usage_stats.get_resource_views',
+                 'nti.app.analytics.usage_stats._AbstractUsageStats._get_title',
+                 'nti.app.analytics.usage_stats._get_enrollment_scope_dict',
+                 'nti.app.analytics.usage_stats.is_admin_or_content_admin_or_site_admin')
+    def test_excluded_users(self, mock_events, mock_get_title,
+                            mock_enrollment, mock_is_admin):
+        mock_get_title.is_callable().returns('test title')
+        mock_enrollment.is_callable().returns(self.enrollment_dict)
+        _ADMIN_USERNAMES.clear()
+
+        checked = []
+
+        def _is_admin(user):
+            checked.append(user.username)
+            return user.username == 'ForCredit1'
+        mock_is_admin.is_callable().calls(_is_admin)
+
+        events = [MockEvent('Public1', u'ntiid1', 10, 1, 3),
+                  MockEvent('Public1', u'ntiid1', 10, 2, 3),
+                  MockEvent('ForCredit1', u'ntiid1', 20, 3, 3),
+                  MockEvent('ForCredit1', u'ntiid2', 20, 3, 3)]
+        mock_events.is_callable().returns(events)
+
+        resource_stats = self.get_resource_stats()
+        results = resource_stats.get_stats()
+        resource_stats.get_stats('Public')
+        assert_that(results, has_length(1))
+        assert_that(results[0].view_event_count, is_(2))
+        # Users are checked once, not per event or scope
+        assert_that(checked, contains_inanyorder('Public1', 'ForCredit1'))
+
+        # And remembered across builds
+        resource_stats = self.get_resource_stats()
+        assert_that(resource_stats.get_stats(), has_length(1))
+        assert_that(checked, has_length(2))
+        _ADMIN_USERNAMES.clear()
+
+    @WithMockDSTrans
+    @fudge.patch('nti.app.analytics.usage_stats.get_video_views',
+                 'nti.app.analytics.usage_stats._AbstractUsageStats._get_title',
+                 'nti.app.analytics.usage_stats._get_enrollment_scope_dict')
+    def test_top_stats(self, mock_events, mock_get_title, mock_enrollment):
+        mock_enrollment.is_callable().returns(self.enrollment_dict)
+        titles = []
+
+        def _get_title(ntiid):
+            titles.append(ntiid)
+            return None if ntiid == u'untitled' else u'title %s' % ntiid
+        mock_get_title.is_callable().calls(_get_title)
+
+        events = []
+        session_id = 0
+        for ntiid, session_count in ((u'ntiid1', 1), (u'ntiid2', 4),
+                                     (u'untitled', 5), (u'ntiid3', 2),
+                                     (u'ntiid4', 2), (u'ntiid5', 3)):
+            for _ in range(session_count):
+                session_id += 1
+                events.append(MockVideoEvent('Public1', ntiid, 10,
+                                             session_id, 100, 90, 3))
+        mock_events.is_callable().returns(events)
+
+        video_stats = self.get_video_stats()
+        results = video_stats.get_top_stats(3)
+        assert_that([x.ntiid for x in results],
+                    contains(u'ntiid2', u'ntiid5', u'ntiid3'))
+        # Only the top resources (and ties) are built
+        assert_that(titles, contains_inanyorder(u'untitled', u'ntiid2', u'ntiid5',
+                                                u'ntiid3', u'ntiid4'))
+        assert_that(video_stats.scope_result_set_map, has_length(0))
+
+        # Matches the top of the full build
+        del titles[:]
+        video_stats = self.get_video_stats()
+        video_stats.get_stats()
+        assert_that(video_stats.get_top_stats(3), is_(results))
+        assert_that(titles, has_length(6))
+
+    @WithMockDSTrans
+    @fudge.patch('nti.app.analytics.usage_stats._get_enrollment_scope_dict')
+    def test_enrollment_scope_cache(self, mock_enrollment):
+        mock_enrollment.is_callable().returns(self.enrollment_dict)
+
+        class _Course(object):
+            ntiid = u'tag:nextthought.com,2011-10:NTI-CourseInfo-ScopeCache'
+
+        course = _Course()
+        result = get_enrollment_scope_dict(course, {u'instructor'})
+        assert_that(result, is_(self.enrollment_dict))
+        assert_that(result['Public'], is_(frozenset))
+
+        # Cached until the instructors or enrollments change
+        mock_enrollment.is_callable().returns({ALL_USERS: set()})
+        result = get_enrollment_scope_dict(course, {u'instructor'})
+        assert_that(result, is_(self.enrollment_dict))
+        result = get_enrollment_scope_dict(course)
+        assert_that(result, is_({ALL_USERS: frozenset()}))
+
+        mock_enrollment.is_callable().returns(self.enrollment_dict)
+        assert_that(get_enrollment_scope_dict(course),
+                    is_({ALL_USERS: frozenset()}))
+        invalidate_enrollment_scopes(course)
+        size = _ENROLLMENT_SCOPES.size
+        assert_that(get_enrollment_scope_dict(course),
+                    is_(self.enrollment_dict))
+        # Courses weigh their memberships
+        assert_that(_ENROLLMENT_SCOPES.size - size,
+                    is_(sum(len(x) for x in self.enrollment_dict.values())))
+        invalidate_enrollment_scopes(course)
+        assert_that(_ENROLLMENT_SCOPES.size, is_(size))
+
+
+class TestAggregatedUsageStats(_AbstractTestViews):
+    """
+    Validate usage stats aggregated by the (SQLite) analytics database
+    against those accumulated in Python.
+    """
+
+    usernames = (u'aggregate_user1', u'aggregate_user2')
+
+    def _create_events(self, course_obj):
+        context_path = [u'Blah', u'Bleh']
+        now = time.time()
+        for idx, username in enumerate(self.usernames):
+            user = User.get_user(username)
+            create_user(user)
+            for session_id, video_end_time, time_length in ((1, 30, 30),
+                                                            (1, 60, 30),
+                                                            (2, 0, 20),
+                                                            (3, None, None)):
+                session_id = session_id + idx * 10
+                create_video_event(user, session_id, now + session_id,
+                                   course_obj, context_path,
+                                   video_id, time_length, 120,
+                                   'WATCH', 10, video_end_time,
+                                   True, None, None)
+                create_course_resource_view(user, session_id, now + session_id,
+                                            course_obj, context_path,
+                                            resource_id, time_length)
+
+    def _get_stats(self, factory, course_obj, aggregate):
+        stats = factory(course_obj)
+        stats.AGGREGATE_IN_DB = aggregate
+        stats.enrollment_scope_dict = {
+            ALL_USERS: set(self.usernames),
+            'Public': {self.usernames[0]},
+            'ForCredit': {self.usernames[1]},
+        }
+        stats._get_title = lambda unused_ntiid: u'title'
+        return stats
+
+    def _user_stats(self, stats):
+        result = stats.get_stats_for_user(self.usernames[0])
+        return (result.event_count, result.total_view_time,
+                result.session_count, result.last_view_time)
+
+    @WithSharedApplicationMockDS(users=usernames, testapp=True)
+    def test_aggregates(self):
+        with mock_dataserver.mock_db_trans(self.ds):
+            course_obj = ICourseInstance(find_object_with_ntiid(course))
+            get_root_context_id(self.analytics_db, course_obj, create=True)
+            self._create_events(course_obj)
+
+            _aggregate_cache.clear()
+            self._check_aggregates(course_obj)
+
+            # Newer events are read once the course's aggregates are
+            # dropped.
+            self._create_events(course_obj)
+            invalidate_course_aggregates((course_obj.ntiid,))
+            self._check_aggregates(course_obj)
+
+    def _check_aggregates(self, course_obj):
+        for factory in (CourseVideoUsageStats, CourseResourceUsageStats):
+            in_python = self._get_stats(factory, course_obj, False)
+            in_db = self._get_stats(factory, course_obj, True)
+            for scope in (None, 'Public', 'ForCredit'):
+                expected = in_python.get_stats(scope)
+                assert_that(expected, has_length(1))
+                assert_that(in_db.get_stats(scope), is_(expected))
+            assert_that(self._user_stats(in_db),
+                        is_(self._user_stats(in_python)))
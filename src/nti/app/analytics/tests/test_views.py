@@ -35,6 +35,8 @@ import six
 import time
 import calendar
 
+from collections import OrderedDict
+
 from datetime import datetime
 from datetime import timedelta
 
@@ -110,8 +112,11 @@ from nti.app.analytics import ANALYTICS_SESSION_HEADER
 from nti.app.products.courseware.tests import InstructedCourseApplicationTestLayer
 from nti.app.products.courseware.tests import LegacyInstructedCourseApplicationTestLayer
 
+from nti.app.analytics.retention import invalidate_video_retention
+
 from nti.app.analytics.utils import get_session_id_from_request
 
+from nti.app.analytics.views import BatchEvents
 from nti.app.analytics.views import GEO_LOCATION_VIEW
 from nti.app.analytics.views import UserLocationJsonView
 
@@ -539,6 +544,97 @@ class TestBatchEvents(_AbstractTestViews):
 
 
 
+    @WithSharedApplicationMockDS(users=True, testapp=True, default_authenticate=True)
+    def test_batch_too_large(self):
+        io = BatchResourceEvents(events=[resource_event, resource_event,
+                                         resource_event])
+        ext_obj = toExternalObject(io)
+        batch_url = '/dataserver2/analytics/batch_events'
+
+        old_max = BatchEvents.MAX_BATCH_SIZE
+        BatchEvents.MAX_BATCH_SIZE = 2
+        try:
+            res = self.testapp.post_json(batch_url, ext_obj, status=413)
+            assert_that(res.json_body, has_entries('code', 'BatchTooLargeError',
+                                                   'MaxBatchSize', 2))
+        finally:
+            BatchEvents.MAX_BATCH_SIZE = old_max
+
+        old_max = BatchEvents.MAX_EVENT_SIZE
+        BatchEvents.MAX_EVENT_SIZE = 10
+        try:
+            res = self.testapp.post_json(batch_url, ext_obj, status=400)
+            assert_that(res.json_body, has_entries('code', 'EventTooLargeError',
+                                                   'MaxEventSize', 10))
+        finally:
+            BatchEvents.MAX_EVENT_SIZE = old_max
+
+        with mock_dataserver.mock_db_trans(self.ds):
+            results = self.session.query(ResourceViews).all()
+            assert_that(results, has_length(0))
+
+        self.testapp.post(batch_url, b'{"events": [', status=400)
+
+    @WithSharedApplicationMockDS(users=True, testapp=True, default_authenticate=True)
+    def test_batch_resent(self):
+        batch_url = '/dataserver2/analytics/batch_events'
+        ext_events = [toExternalObject(x) for x in (resource_event, video_event)]
+        ext_events[0]['ClientEventId'] = u'resent-event-1'
+        io = BatchResourceEvents(events=[])
+        # The batch id may follow the events
+        ext_obj = OrderedDict(toExternalObject(io))
+        ext_obj['events'] = ext_events
+        ext_obj['BatchId'] = u'resent-batch-1'
+
+        res = self.testapp.post_json(batch_url, ext_obj)
+        assert_that(res.json_body, has_entries('EventCount', 2,
+                                               'DuplicateCount', 0))
+
+        # The whole batch is resent
+        res = self.testapp.post_json(batch_url, ext_obj)
+        assert_that(res.json_body, has_entries('EventCount', 0,
+                                               'DuplicateCount', 2))
+
+        # A single event is resent in a new batch
+        ext_obj['BatchId'] = u'resent-batch-2'
+        res = self.testapp.post_json(batch_url, ext_obj)
+        assert_that(res.json_body, has_entries('EventCount', 1,
+                                               'DuplicateCount', 1,
+                                               'DuplicateBatch', False))
+
+        # Batch ids sent with the request are checked before the body
+        # is read
+        del ext_obj['BatchId']
+        ext_events[0]['ClientEventId'] = u'resent-event-3'
+        headers = {'X-NTI-Batch-Id': 'resent-batch-3'}
+        res = self.testapp.post_json(batch_url, ext_obj, headers=headers)
+        assert_that(res.json_body, has_entries('EventCount', 2,
+                                               'DuplicateBatch', False))
+        res = self.testapp.post(batch_url, b'{"events": [',
+                                headers=headers)
+        assert_that(res.json_body, has_entries('EventCount', 0,
+                                               'DuplicateBatch', True))
+        res = self.testapp.post(batch_url + '?batchId=resent-batch-3',
+                                b'{"events": [')
+        assert_that(res.json_body, has_entries('DuplicateBatch', True))
+
+    @WithSharedApplicationMockDS(users=True, testapp=True, default_authenticate=True)
+    @fudge.patch('nti.app.analytics.views.get_retry_after')
+    def test_batch_throttled(self, mock_retry_after):
+        mock_retry_after.is_callable().returns(7)
+        io = BatchResourceEvents(events=[resource_event])
+        ext_obj = toExternalObject(io)
+        batch_url = '/dataserver2/analytics/batch_events'
+
+        res = self.testapp.post_json(batch_url, ext_obj, status=429)
+        assert_that(res.headers['Retry-After'], is_('7'))
+        assert_that(res.json_body, has_entries('code', 'TooManyRequestsError',
+                                               'RetryAfter', 7))
+
+        with mock_dataserver.mock_db_trans(self.ds):
+            results = self.session.query(ResourceViews).all()
+            assert_that(results, has_length(0))
+
     @WithSharedApplicationMockDS(users=True, testapp=True, default_authenticate=True)
     def test_batch_params(self):
         batch_url = '/dataserver2/analytics/@@' + SYNC_PARAMS
@@ -549,7 +645,10 @@ class TestBatchEvents(_AbstractTestViews):
                                 'RecommendedBatchEventsSendFrequency', DEFAULT_ANALYTICS_FREQUENCY,
                                 'RecommendedBatchEventsSize', DEFAULT_ANALYTICS_BATCH_SIZE,
                                 'RecommendedBatchSessionsSendFrequency', DEFAULT_ANALYTICS_FREQUENCY,
-                                'RecommendedBatchSessionsSize', DEFAULT_ANALYTICS_BATCH_SIZE))
+                                'RecommendedBatchSessionsSize', DEFAULT_ANALYTICS_BATCH_SIZE,
+                                'RateLimit', not_none(),
+                                'RateLimitBurst', not_none(),
+                                'RetryAfter', 0))
 
 
 class TestAnalyticsSession(_AbstractTestViews):
@@ -819,6 +918,14 @@ class TestProgressView(_AbstractTestViews):
         result = video_response.json_body['Items']
         assert_that(result, has_length(1))
         assert_that(result, contains(video1))
+        assert_that(video_response.json_body, is_not(has_key('LastEventId')))
+
+        # Clients start reading deltas from 0
+        progress_url = '/dataserver2/users/CLC3403.ou.nextthought.com/LegacyCourses/CLC3403/VideoProgress'
+        video_response = self.testapp.get(progress_url,
+                                          params={'afterEventId': 0})
+        assert_that(video_response.json_body['Items'], contains(video1))
+        video1_event_id = video_response.json_body['LastEventId']
 
         # New video doesn't affect old video
         with mock_dataserver.mock_db_trans(self.ds):
@@ -842,6 +949,36 @@ class TestProgressView(_AbstractTestViews):
         assert_that(result, has_length(2))
         assert_that(result, contains_inanyorder(video1, video2))
 
+        # Videos with events recent enough to still be updated are
+        # always read again
+        video_response = self.testapp.get(progress_url,
+                                          params={'afterEventId': video1_event_id})
+        result = video_response.json_body['Items']
+        assert_that(result, contains_inanyorder(video1, video2))
+        last_event_id = video_response.json_body['LastEventId']
+        assert_that(last_event_id, greater_than(video1_event_id))
+
+        # Otherwise, only the videos with events stored since the given
+        # event, whatever their timestamps
+        with fudge.patch('nti.app.analytics.progress.time') as mock_time:
+            mock_time.provides('time').returns(time.time() + 2 * 24 * 60 * 60)
+            video_response = self.testapp.get(progress_url,
+                                              params={'afterEventId': video1_event_id})
+            result = video_response.json_body['Items']
+            assert_that(result, has_length(1))
+            assert_that(result, contains(video2))
+            assert_that(result[video2], has_entry('HasProgress', True))
+            assert_that(video_response.json_body['LastEventId'],
+                        is_(last_event_id))
+
+            video_response = self.testapp.get(progress_url,
+                                              params={'afterEventId': last_event_id})
+            assert_that(video_response.json_body['Items'], has_length(0))
+            assert_that(video_response.json_body['LastEventId'],
+                        is_(last_event_id))
+
+        self.testapp.get(progress_url, params={'afterEventId': 'x'}, status=422)
+
         # Now a resource view
         with mock_dataserver.mock_db_trans(self.ds):
             user = User.get_user(user_id)
@@ -1515,6 +1652,40 @@ class TestUserAnalyticsWorkspace(ApplicationLayerTest):
         assert_that(resp.cache_control.max_age, greater_than(0))
         assert_that(resp.cache_control.must_revalidate, is_(False))
 
+    @WithSharedApplicationMockDS(testapp=True, users=True)
+    @fudge.patch('nti.app.analytics.views.get_stats_version')
+    def test_stats_conditional_get(self, mock_version):
+        # The site's version holds for a minute; have it hold throughout
+        mock_version.is_callable().returns((0, None))
+        workspace_href = '/dataserver2/analytics'
+        workspace = self.testapp.get(workspace_href)
+        workspace = workspace.json_body
+        self._check_conditional_gets(workspace)
+
+    def _check_conditional_gets(self, workspace):
+        for rel in (ACTIVITY_SUMMARY_BY_DATE, ACTIVE_TIMES_SUMMARY, ACTIVE_USERS):
+            href = self.require_link_href_with_rel(workspace, rel)
+            resp = self.testapp.get(href)
+            etag = resp.headers.get('ETag')
+            last_modified = resp.headers.get('Last-Modified')
+            assert_that(etag, not_none())
+            assert_that(last_modified, not_none())
+
+            self.testapp.get(href,
+                             headers={'If-None-Match': etag},
+                             status=304)
+            self.testapp.get(href,
+                             headers={'If-Modified-Since': last_modified},
+                             status=304)
+            # The ETag takes precedence
+            self.testapp.get(href,
+                             headers={'If-None-Match': '"other"',
+                                      'If-Modified-Since': last_modified},
+                             status=200)
+            # Other windows have their own
+            resp = self.testapp.get(href, params={'notAfter': '1000'})
+            assert_that(resp.headers.get('ETag'), is_not(etag))
+
 
 class TestBookViews(ApplicationLayerTest):
 
@@ -1927,6 +2098,124 @@ class VideoSegmentInfoTests(_AbstractTestViews):
                                      'NTIID', self.video_ntiid,
                                      'WatchedSegments', has_length(4)))
 
+    @time_monotonically_increases
+    @WithSharedApplicationMockDS(testapp=True, users=True)
+    def test_course_resume_info(self):
+        with mock_dataserver.mock_db_trans(self.ds):
+            user1 = self._create_user(username='user_analytics_stats1')
+            user2 = self._create_user(username='user_analytics_stats2')
+
+            sm = self.ds.root['++etc++hostsites']['platform.ou.edu'].getSiteManager()
+            course = sm.getUtility(ICourseCatalog)['Fall2015']['CS 1323']
+
+            em = ICourseEnrollmentManager(course)
+            em.enroll(user1)
+            em.enroll(user2)
+
+            course_ntiid = course.ntiid
+
+        self._store_video_data(course_ntiid, 'user_analytics_stats1')
+
+        user1_environ = self._make_extra_environ(user='user_analytics_stats1')
+        user2_environ = self._make_extra_environ(user='user_analytics_stats2')
+        inst_environ = self._make_extra_environ(user='tryt3968')
+
+        resume_url = '/dataserver2/++etc++hostsites/platform.ou.edu/++etc++site/Courses/Fall2015/CS 1323/@@VideoResumeInfo'
+
+        # The latest watch event of each video, as with resume_info
+        res = self.testapp.get(resume_url, extra_environ=user1_environ, status=200)
+        assert_that(res.json_body,
+                    has_entries('Username', 'user_analytics_stats1',
+                                'Course', course_ntiid,
+                                'Items', has_entry(self.video_ntiid,
+                                                   has_entries('ResumeSeconds', 35,
+                                                               'MaxDuration', 1000))))
+        assert_that(res.json_body['Items'], has_length(1))
+        assert_that(res.last_modified, not_none())
+
+        # Unchanged
+        self.testapp.get(resume_url,
+                         headers={'If-Modified-Since': serialize_date(res.last_modified)},
+                         extra_environ=user1_environ,
+                         status=304)
+
+        res = self.testapp.get(resume_url, extra_environ=user2_environ, status=200)
+        assert_that(res.json_body, has_entries('Username', 'user_analytics_stats2',
+                                               'Items', has_length(0)))
+
+        # Students can't fetch other students resume data
+        self.testapp.get('%s?username=user_analytics_stats1' % resume_url,
+                         extra_environ=user2_environ,
+                         status=403)
+
+        # Instructors can
+        res = self.testapp.get('%s?username=user_analytics_stats1' % resume_url,
+                               extra_environ=inst_environ,
+                               status=200)
+        assert_that(res.json_body['Items'], has_entry(self.video_ntiid,
+                                                      has_entry('ResumeSeconds', 35)))
+
+    @time_monotonically_increases
+    @WithSharedApplicationMockDS(testapp=True, users=True)
+    def test_retention(self):
+        invalidate_video_retention()
+        with mock_dataserver.mock_db_trans(self.ds):
+            user1 = self._create_user(username='user_analytics_stats1')
+            user2 = self._create_user(username='user_analytics_stats2')
+
+            sm = self.ds.root['++etc++hostsites']['platform.ou.edu'].getSiteManager()
+            course = sm.getUtility(ICourseCatalog)['Fall2015']['CS 1323']
+
+            em = ICourseEnrollmentManager(course)
+            em.enroll(user1)
+            em.enroll(user2)
+
+            course_ntiid = course.ntiid
+
+        self._store_video_data(course_ntiid, 'user_analytics_stats1')
+
+        user1_environ = self._make_extra_environ(user='user_analytics_stats1')
+        inst_environ = self._make_extra_environ(user='tryt3968')
+
+        base_url = '/dataserver2/++etc++hostsites/platform.ou.edu/++etc++site/Courses/Fall2015/CS 1323/assets/%s' % self.video_ntiid
+
+        retention_url = '%s/@@retention' % base_url
+
+        # Students cannot see course-wide retention
+        self.testapp.get(retention_url,
+                         extra_environ=user1_environ,
+                         status=403)
+
+        res = self.testapp.get(retention_url,
+                               extra_environ=inst_environ,
+                               status=200).json
+        assert_that(res, has_entries('Course', course_ntiid,
+                                     'NTIID', self.video_ntiid,
+                                     'BucketSeconds', 1,
+                                     'ViewCounts', has_length(1000)))
+        counts = res['ViewCounts']
+        assert_that(counts[20], is_(2))
+        assert_that(counts[40], is_(0))
+        assert_that(counts[999], is_(1))
+
+        res = self.testapp.get('%s?bucket_seconds=100' % retention_url,
+                               extra_environ=inst_environ,
+                               status=200).json
+        assert_that(res, has_entries('BucketSeconds', 100,
+                                     'ViewCounts', [2, 0, 0, 1, 1, 1, 1, 1, 1, 1]))
+
+        # New events are picked up once refreshed
+        self._store_video_data(course_ntiid, 'user_analytics_stats2')
+        invalidate_video_retention()
+        res = self.testapp.get('%s?bucket_seconds=100' % retention_url,
+                               extra_environ=inst_environ,
+                               status=200).json
+        assert_that(res, has_entries('ViewCounts', [4, 0, 0, 2, 2, 2, 2, 2, 2, 2]))
+
+        self.testapp.get('%s?bucket_seconds=0' % retention_url,
+                         extra_environ=inst_environ,
+                         status=422)
+
     @WithSharedApplicationMockDS(testapp=True, users=True)
     def test_links_decorated(self):
 
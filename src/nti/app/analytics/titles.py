@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Resolving the display titles of usage stat resources in bulk.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+from zope.component.hooks import getSite
+
+from nti.app.analytics.cache import LRUCache
+
+from nti.ntiids.ntiids import find_object_with_ntiid
+
+#: Resource NTIID (by site) to title, shared across requests. Cleared
+#: on content sync.
+_TITLES = LRUCache(maxsize=20000, ttl=60 * 60)
+
+#: Marker for uncached titles
+_MISSING = object()
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def _object_title(obj):
+    return getattr(obj, 'title', None) or getattr(obj, 'label', '')
+
+
+def _site_name():
+    return getattr(getSite(), '__name__', None)
+
+
+class TitleResolver(object):
+    """
+    Resolves the titles of resources, looking them up in the given asset
+    container (e.g. a course's :class:`IPresentationAssetContainer`)
+    before falling back to a (much more expensive) NTIID lookup. Titles
+    are remembered across requests.
+    """
+
+    def __init__(self, container=None):
+        self.container = container
+
+    def _find_object(self, ntiid):
+        result = None
+        if self.container is not None:
+            result = self.container.get(ntiid)
+        if result is None:
+            result = find_object_with_ntiid(ntiid)
+        return result
+
+    def _resolve(self, ntiid):
+        result = None
+        obj = self._find_object(ntiid)
+        if obj is not None:
+            result = _object_title(obj)
+            if not result:
+                try:
+                    # Content cards
+                    target_ntiid = obj.path[-1].ntiid
+                    obj = self._find_object(target_ntiid)
+                    result = _object_title(obj)
+                except (AttributeError, IndexError):
+                    pass
+        return result
+
+    def resolve(self, ntiids):
+        """
+        Return a map of each of the given NTIIDs to its title, or None if
+        it cannot be found.
+        """
+        site_name = _site_name()
+        result = {}
+        for ntiid in ntiids:
+            key = (site_name, ntiid)
+            title = _TITLES.get(key, _MISSING)
+            if title is _MISSING:
+                title = self._resolve(ntiid)
+                _TITLES.set(key, title)
+            result[ntiid] = title
+        return result
+
+    def get_title(self, ntiid):
+        return self.resolve((ntiid,))[ntiid]
+
+
+def invalidate_titles(ntiids=None):
+    """
+    Forget the cached titles of the given NTIIDs (in the current site),
+    or of everything.
+    """
+    if ntiids is None:
+        _TITLES.clear()
+        return
+    site_name = _site_name()
+    for ntiid in ntiids:
+        _TITLES.invalidate((site_name, ntiid))
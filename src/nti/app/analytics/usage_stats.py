@@ -15,17 +15,38 @@ from heapq import nlargest
 from collections import namedtuple
 from collections import defaultdict
 
+from array import array
+
 from datetime import datetime
 
+from sqlalchemy.exc import SQLAlchemyError
+
+import transaction
+
 from zope import interface
 
 from zope.cachedescriptors.property import Lazy
 
+from zope.component.hooks import getSite
+
 from nti.analytics.database.lti import get_launch_records_for_ntiid
 
 from nti.analytics.resource_views import get_video_views
 from nti.analytics.resource_views import get_resource_views
 
+from nti.app.analytics.cache import LRUCache
+
+from nti.app.analytics.columnar import ColumnarEventAccumulator
+
+from nti.app.analytics.dropoff import completed_count
+from nti.app.analytics.dropoff import drop_off_counts
+
+from nti.app.analytics.materialized import VIDEO_VIEWS
+from nti.app.analytics.materialized import RESOURCE_VIEWS
+from nti.app.analytics.materialized import get_course_aggregates
+
+from nti.app.analytics.titles import TitleResolver
+
 from nti.app.contentlibrary.interfaces import IResourceUsageStats as IBookResourceUsageStats
 
 from nti.app.products.courseware.interfaces import IVideoUsageStats
@@ -33,13 +54,17 @@ from nti.app.products.courseware.interfaces import IResourceUsageStats
 from nti.app.products.courseware.interfaces import IUserVideoUsageStats
 from nti.app.products.courseware.interfaces import IUserResourceUsageStats
 
+from nti.contenttypes.presentation.interfaces import IPresentationAssetContainer
+
+from nti.contenttypes.courses.utils import get_parent_course
+
 from nti.dataserver.authorization import is_admin_or_content_admin_or_site_admin
 
 from nti.dataserver.interfaces import IEnumerableEntityContainer
 
-from nti.ims.lti.interfaces import ILTIUserLaunchStats
+from nti.dataserver.users.users import User
 
-from nti.ntiids.ntiids import find_object_with_ntiid
+from nti.ims.lti.interfaces import ILTIUserLaunchStats
 
 from nti.property.property import alias
 
@@ -79,9 +104,37 @@ _AverageWatchTimes = namedtuple('_AverageWatchTimes',
 
 ALL_USERS = u'AllUsers'
 
+#: Seconds we hold a course's enrollment scopes. Enrollment changes only
+#: drop them in the process making the change; other processes may use
+#: the previous scopes for this long.
+ENROLLMENT_SCOPE_SECONDS = 2 * 60
+
+#: The most scope memberships (usernames, summed across the scopes of
+#: every course) we hold, bounding the memory of the cached scopes
+#: however large the courses.
+ENROLLMENT_SCOPE_MEMBERS = 200000
+
+#: Course NTIID to its (instructors, enrollment scope dict), shared
+#: across requests, weighed by membership.
+_ENROLLMENT_SCOPES = LRUCache(maxsize=ENROLLMENT_SCOPE_MEMBERS,
+                              ttl=ENROLLMENT_SCOPE_SECONDS)
+
+#: Username (by site) to whether the user is an admin, shared across
+#: requests.
+_ADMIN_USERNAMES = LRUCache(maxsize=10000, ttl=10 * 60)
+
 logger = __import__('logging').getLogger(__name__)
 
 
+def _is_admin(user):
+    key = (getattr(getSite(), '__name__', None), user.username.lower())
+    result = _ADMIN_USERNAMES.get(key)
+    if result is None:
+        result = bool(is_admin_or_content_admin_or_site_admin(user))
+        _ADMIN_USERNAMES.set(key, result)
+    return result
+
+
 def _get_enrollment_scope_dict(course, instructors=set()):
     """
     Build a dict of scope_name to usernames.
@@ -121,6 +174,118 @@ def _get_enrollment_scope_dict(course, instructors=set()):
     return results
 
 
+def get_enrollment_scope_dict(course, instructors=frozenset()):
+    """
+    Return a (cached, read-only) dict of scope_name to the frozenset of
+    usernames in it, as :func:`_get_enrollment_scope_dict` does. Courses
+    are cached across requests for `ENROLLMENT_SCOPE_SECONDS`, or in this
+    process until their enrollments change, up to
+    `ENROLLMENT_SCOPE_MEMBERS` memberships across courses.
+    """
+    ntiid = getattr(course, 'ntiid', None)
+    instructors = frozenset(instructors)
+    cached = _ENROLLMENT_SCOPES.get(ntiid) if ntiid else None
+    if cached is not None and cached[0] == instructors:
+        return cached[1]
+    result = _get_enrollment_scope_dict(course, instructors)
+    result = {k: frozenset(v) for k, v in result.items()}
+    if ntiid:
+        weight = sum(len(x) for x in result.values()) or 1
+        _ENROLLMENT_SCOPES.set(ntiid, (instructors, result), weight=weight)
+    return result
+
+
+def _invalidate_enrollment_scopes(unused_success, ntiids):
+    for ntiid in ntiids:
+        _ENROLLMENT_SCOPES.invalidate(ntiid)
+
+
+def invalidate_enrollment_scopes(course):
+    """
+    Drop the cached enrollment scopes of the course and its parent, now
+    and once the current transaction commits (so that a concurrent
+    request cannot cache the scopes as they were before).
+    """
+    ntiids = {getattr(x, 'ntiid', None)
+              for x in (course, get_parent_course(course))}
+    ntiids.discard(None)
+    _invalidate_enrollment_scopes(True, ntiids)
+    transaction.get().addAfterCommitHook(_invalidate_enrollment_scopes,
+                                         args=(ntiids,))
+
+
+def _get_watch_data(total_view_time, session_count, user_count):
+    average_watch_time = total_view_time / user_count
+    average_session_time = total_view_time / session_count
+
+    watch_data = _AverageWatchTimes('%s:%02d' % divmod(int(average_watch_time), 60),
+                                    '%s:%02d' % divmod(int(average_session_time), 60))
+    return watch_data
+
+
+def _get_drop_off_data(video_duration, session_count, session_end_times):
+    """
+    Bucket the furthest point watched in each session into quartiles of
+    the video's duration.
+    """
+    if not video_duration:
+        return EMPTY_VIDEO_DROP_OFF
+
+    drop25count, drop50count, drop75count, drop100count = \
+        drop_off_counts(video_duration, session_end_times, 4)
+
+    drop25percentage = round(drop25count / float(session_count) * 100)
+    drop50percentage = round(drop50count / float(session_count) * 100)
+    drop75percentage = round(drop75count / float(session_count) * 100)
+    drop100percentage = round(drop100count / float(session_count) * 100)
+
+    falloff_data = _VideoDropOffRate(drop25count, drop25percentage,
+                                     drop50count, drop50percentage,
+                                     drop75count, drop75percentage,
+                                     drop100count, drop100percentage)
+
+    return falloff_data
+
+
+def _build_video_info(title, ntiid, session_count, event_count,
+                      total_view_time, video_duration, user_view_times,
+                      user_end_times, session_end_times, student_count,
+                      completed_threshold):
+    """
+    Build the :class:`_VideoInfo` of a video, given the total view time
+    and max end time of each user, and the max end time of each session.
+    """
+    number_users_watched_completely = 0
+    str_video_duration = ''
+
+    if video_duration:
+        str_video_duration = '%s:%02d' % divmod(int(video_duration), 60)
+
+        # To completely watch a video, the user must accumulate up to a threshold and
+        # watch up to a certain threshold (not just watch beginning
+        # over and over).
+        number_users_watched_completely = completed_count(video_duration * completed_threshold,
+                                                          user_view_times,
+                                                          user_end_times)
+
+    perc_users_watched_completely = number_users_watched_completely / student_count
+    str_perc_watched_completely = '%d%%' % int(perc_users_watched_completely * 100)
+
+    watch_data = _get_watch_data(total_view_time, session_count, student_count)
+    drop_off_data = _get_drop_off_data(video_duration, session_count,
+                                       session_end_times)
+    data = _VideoInfo(title,
+                      ntiid,
+                      session_count,
+                      event_count,
+                      watch_data,
+                      str_video_duration,
+                      str_perc_watched_completely,
+                      number_users_watched_completely,
+                      drop_off_data)
+    return data
+
+
 class _AbstractUsageStats(object):
     """
     When fetching stats, we'll build or fetch the stats (run once). If
@@ -131,20 +296,50 @@ class _AbstractUsageStats(object):
 
     EXCLUDE_ADMINS = True
 
+    #: The user count of our accumulated events, once accumulated.
+    _user_count = None
+
     #: The number of top resources to return in get_top_stats, by default.
     DEFAULT_TOP_COUNT = 6
 
+    @property
+    def accumulator_factory(self):
+        """
+        The accumulator class events are run through.
+        """
+        return ResourceEventAccumulator
+
     def __init__(self, context):
         self.context = context
-        self.accum = ResourceEventAccumulator()
+        self.accum = self.accumulator_factory()
         self._stats = None
 
     def _get_included_users(self, *args, **kwargs):
         return None
 
-    def _exclude_user(self, user):
-        return  self.EXCLUDE_ADMINS \
-            and is_admin_or_content_admin_or_site_admin(user)
+    @Lazy
+    def _exclusions(self):
+        """
+        A map of (lower-cased) username to whether the user is excluded
+        from our stats.
+        """
+        return {}
+
+    def _is_excluded(self, user, unused_username):
+        return self.EXCLUDE_ADMINS and _is_admin(user)
+
+    def _exclude_user(self, user, username=None):
+        """
+        Whether the user is excluded from our stats, decided once per
+        user. Callers may pass the lower-cased username.
+        """
+        if username is None:
+            username = user.username.lower()
+        try:
+            return self._exclusions[username]
+        except KeyError:
+            result = self._exclusions[username] = self._is_excluded(user, username)
+            return result
 
     def _build_or_get_stats(self, *args, **kwargs):
         if self._stats == None:
@@ -158,53 +353,71 @@ class _AbstractUsageStats(object):
         """
         return self._build_or_get_stats(*args, **kwargs)
 
+    def _get_built_stats(self, *unused_args, **unused_kwargs):
+        """
+        Return our stats if already built, else None.
+        """
+        return self._stats
+
+    def _get_accumulated(self, *args, **kwargs):
+        """
+        Return a tuple of our accumulator and user count, without
+        building results.
+        """
+        included_users = self._get_included_users(*args, **kwargs)
+        return self.accum, self._accum_for_users(included_users)
+
     def get_top_stats(self, top_count=None, *args, **kwargs):
         """
         Return top usage stats for course users, optionally by scope.
+        Unless our stats are already built, only the top resources (by
+        session count) are built.
         """
-        stats = self._build_or_get_stats(*args, **kwargs)
         top_count = top_count or self.DEFAULT_TOP_COUNT
+        stats = self._get_built_stats(*args, **kwargs)
+        if stats is None:
+            accum, user_count = self._get_accumulated(*args, **kwargs)
+            return self.build_top_results(accum, user_count, top_count)
         # Safe as long as we're non-None.
         result = nlargest(top_count, stats, key=lambda vid: vid.session_count)
         return result
 
-    def __get_title(self, obj):
-        return getattr(obj, 'title', None) or getattr(obj, 'label', '')
+    def _get_asset_container(self):
+        """
+        Return a mapping of NTIID to the assets our resources may be
+        found in, or None.
+        """
+        return None
+
+    @Lazy
+    def title_resolver(self):
+        return TitleResolver(self._get_asset_container())
 
     def _get_title(self, ntiid):
-        result = None
-        obj = find_object_with_ntiid(ntiid)
-        if obj is not None:
-            result = self.__get_title(obj)
-            if not result:
-                try:
-                    # Content cards
-                    target_ntiid = obj.path[-1].ntiid
-                    obj = find_object_with_ntiid(target_ntiid)
-                    result = self.__get_title(obj)
-                except (AttributeError, IndexError):
-                    pass
-        return result
+        try:
+            return self._titles[ntiid]
+        except (AttributeError, KeyError):
+            return self.title_resolver.get_title(ntiid)
 
     def _get_watch_data(self, stats, user_count):
         """
         For the given stats and student count, return watch stats ready
         for display purposes.
         """
-        average_watch_time = stats.total_view_time / user_count
-        average_session_time = stats.total_view_time / stats.session_count
-
-        watch_data = _AverageWatchTimes('%s:%02d' % divmod(int(average_watch_time), 60),
-                                        '%s:%02d' % divmod(int(average_session_time), 60))
-        return watch_data
+        return _get_watch_data(stats.total_view_time,
+                               stats.session_count,
+                               user_count)
 
     def build_results(self, accum, user_count):
         """
         Post-accumulation, build our result object set.
         """
         results = []
+        stats_map = accum.ntiid_stats_map
+        # Resolve every title up front, in bulk
+        self._titles = self.title_resolver.resolve(stats_map)
 
-        for ntiid, stats in accum.ntiid_stats_map.items():
+        for ntiid, stats in stats_map.items():
             data = self._build_resource_stats(ntiid, stats, user_count)
             if data is not None:
                 results.append(data)
@@ -212,6 +425,33 @@ class _AbstractUsageStats(object):
         results.sort(key=lambda x: x.title)
         return results
 
+    def build_top_results(self, accum, user_count, top_count):
+        """
+        Build the results of only the `top_count` resources with the
+        most sessions, as `nlargest` over :meth:`build_results` would.
+        """
+        stats_map = accum.ntiid_stats_map
+        ranked = sorted(accum.session_counts().items(),
+                        key=lambda x: x[1],
+                        reverse=True)
+        self._titles = self.title_resolver.resolve(x[0] for x in ranked[:top_count])
+
+        results = []
+        min_session_count = None
+        for ntiid, session_count in ranked:
+            if      min_session_count is not None \
+                and session_count < min_session_count:
+                break
+            data = self._build_resource_stats(ntiid, stats_map[ntiid], user_count)
+            if data is not None:
+                results.append(data)
+                if len(results) == top_count:
+                    # Keep building ties, which are ordered by title
+                    min_session_count = session_count
+
+        results.sort(key=lambda x: x.title)
+        return nlargest(top_count, results, key=lambda x: x.session_count)
+
     def get_usernames_with_stats(self):
         self.get_stats()
         return tuple(self.accum.user_stats_map)
@@ -225,12 +465,24 @@ class _AbstractUsageStats(object):
         """
         For the given set of usernames, build stats based on events and return.
         """
+        user_count = self._accum_for_users(included_users)
+        result = self.build_results(self.accum, user_count)
+        return result
+
+    def _accum_for_users(self, included_users):
+        """
+        Run our events (once) through our accumulator, returning the
+        user count.
+        """
+        if self._user_count is not None:
+            return self._user_count
         for event in self.events:
-            if     event is None \
-                or event.user is None \
-                or self._exclude_user(event.user) \
+            if event is None or event.user is None:
+                continue
+            username = event.user.username.lower()
+            if     self._exclude_user(event.user, username) \
                 or (    included_users is not None \
-                    and event.user.username.lower() not in included_users):
+                    and username not in included_users):
                 continue
             self.accum.accum(event)
 
@@ -238,8 +490,8 @@ class _AbstractUsageStats(object):
             user_count = len(included_users)
         else:
             user_count = len(tuple(self.accum.user_stats_map))
-        result = self.build_results(self.accum, user_count)
-        return result
+        self._user_count = user_count
+        return user_count
 
 
 class _AbstractCourseUsageStats(_AbstractUsageStats):
@@ -247,27 +499,38 @@ class _AbstractCourseUsageStats(_AbstractUsageStats):
     #: A cache of scopes to result set stats.
     scope_result_set_map = None
 
+    #: A cache of scopes to their (accumulator, user count).
+    scope_accum_map = None
+
+    #: Whether to aggregate events in the analytics database, if we
+    #: can, instead of loading and accumulating each event.
+    AGGREGATE_IN_DB = True
+
     course = alias('context')
 
     def __init__(self, course):
         super(_AbstractCourseUsageStats, self).__init__(course)
         self.scope_result_set_map = {}
+        self.scope_accum_map = {}
 
     def _get_included_users(self, scope_name):
         return self._get_user_base(scope_name)
 
+    def _get_asset_container(self):
+        return IPresentationAssetContainer(self.course, None)
+
     @Lazy
     def instructor_usernames(self):
         return {x.id.lower() for x in self.course.instructors}
 
-    def _exclude_user(self, user):
-        return user.username.lower() in self.instructor_usernames \
-            or super(_AbstractCourseUsageStats, self)._exclude_user(user)
+    def _is_excluded(self, user, username):
+        return username in self.instructor_usernames \
+            or super(_AbstractCourseUsageStats, self)._is_excluded(user, username)
 
     @Lazy
     def enrollment_scope_dict(self):
-        return _get_enrollment_scope_dict(self.course,
-                                          self.instructor_usernames)
+        return get_enrollment_scope_dict(self.course,
+                                         self.instructor_usernames)
 
     def _get_scope(self, scope_name):
         result = ALL_USERS
@@ -281,15 +544,116 @@ class _AbstractCourseUsageStats(_AbstractUsageStats):
         user_base = self.enrollment_scope_dict[scope_name]
         return user_base
 
+    @Lazy
+    def username_scopes(self):
+        """
+        A map of (lower-cased) username to the scope names the user
+        belongs to.
+        """
+        result = defaultdict(list)
+        for scope_name, usernames in self.enrollment_scope_dict.items():
+            for username in usernames:
+                result[username].append(scope_name)
+        return result
+
+    def _get_aggregate_rows(self):
+        """
+        Return our events aggregated by resource, user and session, or
+        None if they cannot be aggregated in the database.
+        """
+        return None
+
+    def _accum_events(self, scope_accums):
+        username_scopes = self.username_scopes
+        for event in self.events:
+            if event is None or event.user is None:
+                continue
+            username = event.user.username.lower()
+            scope_names = username_scopes.get(username)
+            if not scope_names or self._exclude_user(event.user, username):
+                continue
+            for scope_name in scope_names:
+                scope_accums[scope_name].accum(event)
+
+    def _accum_aggregate_rows(self, rows, scope_accums):
+        username_scopes = self.username_scopes
+        users = {}
+        for row in rows:
+            if not row.username:
+                continue
+            username = row.username.lower()
+            scope_names = username_scopes.get(username)
+            if not scope_names:
+                continue
+            try:
+                user = users[row.username]
+            except KeyError:
+                user = users[row.username] = User.get_user(row.username)
+            if user is None or self._exclude_user(user, username):
+                continue
+            for scope_name in scope_names:
+                scope_accums[scope_name].accum_row(row, user.username)
+
+    def _get_scope_accumulators(self):
+        """
+        Return a map of scope name to an accumulator holding the stats
+        of the users in that scope, aggregated in the database if we
+        can, else in a single pass over our events.
+        """
+        scope_names = self.enrollment_scope_dict
+        rows = None
+        if self.AGGREGATE_IN_DB:
+            try:
+                rows = self._get_aggregate_rows()
+            except SQLAlchemyError:
+                logger.exception('Could not aggregate usage stats in database (%s)',
+                                 self.context)
+        scope_accums = self.accumulator_factory.for_scopes(scope_names)
+        if rows is None:
+            self._accum_events(scope_accums)
+        else:
+            self._accum_aggregate_rows(rows, scope_accums)
+        return scope_accums
+
+    def _get_scope_accum_map(self):
+        """
+        Accumulate (once) every scope at once, routing each event (or
+        aggregate) to the accumulator of every scope its user is in.
+        """
+        if not self.scope_accum_map:
+            scope_accums = self._get_scope_accumulators()
+            for scope_name, accum in scope_accums.items():
+                user_base = self._get_user_base(scope_name)
+                if user_base:
+                    user_count = len(user_base)
+                else:
+                    user_count = len(tuple(accum.user_stats_map))
+                self.scope_accum_map[scope_name] = (accum, user_count)
+            # Our per-user stats are across all users.
+            if ALL_USERS in scope_accums:
+                self.accum = scope_accums[ALL_USERS]
+        return self.scope_accum_map
+
+    def _build_data_for_scope(self, scope_name):
+        """
+        Build (only) the stats of the given scope, from the accumulators
+        of every scope.
+        """
+        accum, user_count = self._get_scope_accum_map()[scope_name]
+        self.scope_result_set_map[scope_name] = self.build_results(accum,
+                                                                   user_count)
+
     def _build_or_get_stats(self, scope=None):
         scope_name = self._get_scope(scope)
         if scope_name not in self.scope_result_set_map:
-            user_base = self._get_user_base(scope_name)
-            result = self._build_data_for_users(user_base)
-            self.scope_result_set_map[scope_name] = result
-        else:
-            result = self.scope_result_set_map.get(scope_name)
-        return result
+            self._build_data_for_scope(scope_name)
+        return self.scope_result_set_map[scope_name]
+
+    def _get_built_stats(self, scope=None):
+        return self.scope_result_set_map.get(self._get_scope(scope))
+
+    def _get_accumulated(self, scope=None):
+        return self._get_scope_accum_map()[self._get_scope(scope)]
 
 
 class BaseStats(object):
@@ -318,6 +682,16 @@ class BaseStats(object):
         elif event.timestamp and event.timestamp > self.last_view_time:
             self.last_view_time = event.timestamp
 
+    def incr_aggregate(self, row):
+        if row.total_view_time:
+            self.total_view_time += row.total_view_time
+        if row.max_end_time and row.max_end_time > self.max_end_time:
+            self.max_end_time = row.max_end_time
+        if self.last_view_time is None:
+            self.last_view_time = row.last_view_time
+        elif row.last_view_time and row.last_view_time > self.last_view_time:
+            self.last_view_time = row.last_view_time
+
 
 class ResourceStats(object):
     """
@@ -352,6 +726,22 @@ class ResourceStats(object):
         elif event.timestamp and event.timestamp > self.last_view_time:
             self.last_view_time = event.timestamp
 
+    def incr_aggregate(self, row, username):
+        """
+        Add the stats of a database aggregate row for the given user.
+        """
+        self.event_count += row.event_count
+        if row.total_view_time:
+            self.total_view_time += row.total_view_time
+        self.user_stats[username].incr_aggregate(row)
+        self.session_stats[row.session_id].incr_aggregate(row)
+        if self.max_duration is None:
+            self.max_duration = row.max_duration
+        if self.last_view_time is None:
+            self.last_view_time = row.last_view_time
+        elif row.last_view_time and row.last_view_time > self.last_view_time:
+            self.last_view_time = row.last_view_time
+
 
 class ResourceEventAccumulator(object):
     """
@@ -362,12 +752,36 @@ class ResourceEventAccumulator(object):
         self.ntiid_stats_map = defaultdict(ResourceStats)
         self.user_stats_map = defaultdict(ResourceStats)
 
+    @classmethod
+    def for_scopes(cls, scope_names):
+        """
+        Return a map of scope name to a new accumulator.
+        """
+        return {x: cls() for x in scope_names}
+
     def accum(self, event):
         resource_stats = self.ntiid_stats_map[event.ResourceId]
         resource_stats.incr(event)
         user_stats = self.user_stats_map[event.user.username]
         user_stats.incr(event)
 
+    def accum_row(self, row, username):
+        """
+        Accumulate the events of an
+        :class:`~nti.app.analytics.aggregation.AggregateRow` of the given
+        user, aggregated by the analytics database.
+        """
+        resource_stats = self.ntiid_stats_map[row.resource_id]
+        resource_stats.incr_aggregate(row, username)
+        user_stats = self.user_stats_map[username]
+        user_stats.incr_aggregate(row, username)
+
+    def session_counts(self):
+        """
+        Return a map of ntiid to its session count.
+        """
+        return {k: v.session_count for k, v in self.ntiid_stats_map.items()}
+
 
 @interface.implementer(IResourceUsageStats)
 class CourseResourceUsageStats(_AbstractCourseUsageStats):
@@ -380,6 +794,9 @@ class CourseResourceUsageStats(_AbstractCourseUsageStats):
     def events(self):
         return get_resource_views(root_context=self.course) or ()
 
+    def _get_aggregate_rows(self):
+        return get_course_aggregates(self.course, RESOURCE_VIEWS)
+
     def _build_resource_stats(self, ntiid, stats, student_count):
         title = self._get_title(ntiid)
         if title is None:
@@ -453,6 +870,9 @@ class UserCourseResourceUsageStats(CourseResourceUsageStats):
 
     EXCLUDE_ADMINS = False
 
+    #: Our events are only this user's.
+    AGGREGATE_IN_DB = False
+
     def __init__(self, course, user):
         super(UserCourseResourceUsageStats, self).__init__(course)
         self.user = user
@@ -476,83 +896,63 @@ class CourseVideoUsageStats(_AbstractCourseUsageStats):
     #: The threshold at which videos are said to be completely watched.
     VIDEO_COMPLETED_THRESHOLD = 0.9
 
+    #: Video views of large courses number in the hundreds of thousands;
+    #: store them column-wise rather than as stats objects.
+    accumulator_factory = ColumnarEventAccumulator
+
     @Lazy
     def events(self):
         return get_video_views(course=self.course) or ()
 
+    def _get_aggregate_rows(self):
+        return get_course_aggregates(self.course, VIDEO_VIEWS)
+
     def _build_drop_off_data(self, stats):
         """
         Using session stats, calculate where each user 'dropped' off while
         watching a video, bucketing into quartiles.
         """
-        video_duration = stats.max_duration
-        session_count = stats.session_count
-        if not video_duration:
-            return EMPTY_VIDEO_DROP_OFF
-
-        first_quartile = video_duration * 0.25
-        second_quartile = video_duration * 0.5
-        third_quartile = video_duration * 0.75
-
-        drop25count = drop50count = drop75count = drop100count = 0
-        for session_stat in stats.session_stats.values():
-            end_time = session_stat.max_end_time
-            if end_time <= first_quartile:
-                drop25count += 1
-            elif end_time <= second_quartile:
-                drop50count += 1
-            elif end_time <= third_quartile:
-                drop75count += 1
-            else:
-                drop100count += 1
-
-        drop25percentage = round(drop25count / float(session_count) * 100)
-        drop50percentage = round(drop50count / float(session_count) * 100)
-        drop75percentage = round(drop75count / float(session_count) * 100)
-        drop100percentage = round(drop100count / float(session_count) * 100)
-
-        falloff_data = _VideoDropOffRate(drop25count, drop25percentage,
-                                         drop50count, drop50percentage,
-                                         drop75count, drop75percentage,
-                                         drop100count, drop100percentage)
-
-        return falloff_data
+        return _get_drop_off_data(stats.max_duration,
+                                  stats.session_count,
+                                  array('d', (x.max_end_time for x in stats.session_stats.values())))
 
     def _build_resource_stats(self, ntiid, stats, student_count):
         title = self._get_title(ntiid)
         if title is None:
-            return
-
-        video_duration = stats.max_duration
-        number_users_watched_completely = 0
-        str_video_duration = ''
-
-        if video_duration:
-            str_video_duration = '%s:%02d' % divmod(int(video_duration), 60)
-
+            return None
+        # Only needed, as columns, if we know the video's duration
+        user_view_times = array('d')
+        user_end_times = array('d')
+        session_end_times = array('d')
+        if stats.max_duration:
             for user_stat in stats.user_stats.values():
-                # To completely watch a video, the user must accumulate up to a threshold and
-                # watch up to a certain threshold (not just watch beginning
-                # over and over).
-                if      user_stat.total_view_time >= video_duration * self.VIDEO_COMPLETED_THRESHOLD \
-                    and user_stat.max_end_time >= video_duration * self.VIDEO_COMPLETED_THRESHOLD:
-                    number_users_watched_completely += 1
-
-        perc_users_watched_completely = number_users_watched_completely / student_count
-        str_perc_watched_completely = '%d%%' % int(perc_users_watched_completely * 100)
-
-        watch_data = self._get_watch_data(stats, student_count)
-        drop_off_data = self._build_drop_off_data(stats)
-        data = _VideoInfo(title,
-                          ntiid,
-                          stats.session_count,
-                          stats.event_count,
-                          watch_data,
-                          str_video_duration,
-                          str_perc_watched_completely,
-                          number_users_watched_completely,
-                          drop_off_data)
-        return data
+                user_view_times.append(user_stat.total_view_time)
+                user_end_times.append(user_stat.max_end_time)
+            session_end_times.extend(x.max_end_time for x in stats.session_stats.values())
+        return _build_video_info(title, ntiid,
+                                 stats.session_count,
+                                 stats.event_count,
+                                 stats.total_view_time,
+                                 stats.max_duration,
+                                 user_view_times,
+                                 user_end_times,
+                                 session_end_times,
+                                 student_count,
+                                 self.VIDEO_COMPLETED_THRESHOLD)
+
+    def get_drop_off_curve(self, ntiid, bucket_count=20, scope=None):
+        """
+        Return the count of sessions whose furthest point watched falls
+        in each of `bucket_count` equal parts of the video (e.g. 5%
+        buckets by default), or None if we do not know its duration.
+        """
+        accum, unused_user_count = self._get_accumulated(scope)
+        stats = accum.ntiid_stats_map.get(ntiid)
+        if stats is None or not stats.max_duration:
+            return None
+        return drop_off_counts(stats.max_duration,
+                               array('d', (x.max_end_time for x in stats.session_stats.values())),
+                               bucket_count)
 
 
 @interface.implementer(IUserVideoUsageStats)
@@ -562,6 +962,9 @@ class UserCourseVideoUsageStats(CourseVideoUsageStats):
     view stats for a course and user.
     """
 
+    #: Our events are only this user's.
+    AGGREGATE_IN_DB = False
+
     def __init__(self, course, user):
         super(UserCourseVideoUsageStats, self).__init__(course)
         self.user = user
@@ -12,6 +12,7 @@ from __future__ import absolute_import
 
 import csv
 import time
+import hashlib
 import calendar
 import datetime
 
@@ -39,15 +40,12 @@ from zope.component.hooks import getSite
 
 from zope.event import notify
 
-from zope.schema.interfaces import ValidationError
-
 from nti.analytics.common import should_create_analytics
 
 from nti.analytics_database.sessions import Sessions
 
 from nti.analytics.interfaces import IAnalyticsSession
 from nti.analytics.interfaces import IBatchResourceEvents
-from nti.analytics.interfaces import IAnalyticsProgressEvent
 from nti.analytics.interfaces import UserProcessedEventsEvent
 
 from nti.analytics.locations import get_location_list
@@ -84,8 +82,47 @@ from nti.app.analytics import MessageFactory as _
 
 from nti.app.analytics.interfaces import IAnalyticsContext
 from nti.app.analytics.interfaces import IEventsCollection
+from nti.app.analytics.interfaces import IIngestRateLimiter
 from nti.app.analytics.interfaces import IAnalyticsWorkspace
 from nti.app.analytics.interfaces import ISessionsCollection
+from nti.app.analytics.interfaces import IStatsResultCache
+
+from nti.app.analytics.dedupe import BATCH_ID
+from nti.app.analytics.dedupe import BATCH_ID_PARAM
+from nti.app.analytics.dedupe import BATCH_ID_HEADER
+from nti.app.analytics.dedupe import BatchDeduplicator
+
+from nti.app.analytics.ingest import queue_stored_events
+from nti.app.analytics.ingest import BulkEventInternalizer
+from nti.app.analytics.ingest import dispatch_progress_updates
+
+from nti.app.analytics.progress import get_video_progress_after
+
+from nti.app.analytics.ratelimit import get_retry_after
+from nti.app.analytics.ratelimit import get_queue_retry_after
+
+from nti.app.analytics.resume import get_resume_seconds
+from nti.app.analytics.resume import get_video_resume_rows
+
+from nti.app.analytics.retention import get_video_retention
+
+from nti.app.analytics.rollup import get_active_times
+from nti.app.analytics.rollup import get_daily_activity
+
+from nti.app.analytics.stats_cache import HISTORICAL_SECONDS
+
+from nti.app.analytics.stats_cache import daily_expires
+from nti.app.analytics.stats_cache import stats_cache_key
+from nti.app.analytics.stats_cache import get_stats_version
+from nti.app.analytics.stats_cache import stats_cache_scope
+from nti.app.analytics.stats_cache import historical_expires
+from nti.app.analytics.stats_cache import get_daily_expiration
+
+from nti.app.analytics.streaming import DEFAULT_MAX_VALUE_SIZE
+
+from nti.app.analytics.streaming import MalformedJSONError
+from nti.app.analytics.streaming import StreamingJSONReader
+from nti.app.analytics.streaming import JSONValueTooLargeError
 
 from nti.app.analytics.utils import set_research_status
 from nti.app.analytics.utils import get_session_id_from_request
@@ -111,9 +148,6 @@ from nti.common.string import is_true
 
 from nti.contenttypes.presentation.interfaces import INTIVideo
 
-from nti.contenttypes.completion.interfaces import ICompletionContextProvider
-from nti.contenttypes.completion.interfaces import UserProgressUpdatedEvent
-
 from nti.contenttypes.courses.interfaces import ACT_VIEW_DETAILED_CONTENT_USAGE
 from nti.contenttypes.courses.interfaces import ICourseInstance
 from nti.contenttypes.courses.interfaces import ICourseCatalogEntry
@@ -128,15 +162,11 @@ from nti.dataserver.interfaces import IUser
 
 from nti.dataserver.users.users import User
 
-from nti.externalization import internalization
-
 from nti.externalization.externalization import to_external_object
 
 from nti.externalization.interfaces import LocatedExternalDict
 from nti.externalization.interfaces import StandardExternalFields
 
-from nti.ntiids.ntiids import find_object_with_ntiid
-
 from nti.traversal.traversal import find_interface
 
 from nti.securitypolicy.utils import is_impersonating
@@ -195,84 +225,55 @@ def notify_lastseen_event(user, request=None):
         notify(UserLastSeenEvent(user, time.time(), request))
 
 
-def _process_batch_events(events, remote_user, request=None):
+def _process_batch_events(events, remote_user, request=None, deduplicator=None):
     """
-    Process the events, returning a tuple of events queued and malformed events.
+    Process the (possibly streamed) events, returning a tuple of events
+    queued, malformed, invalid and total event counts. Nothing is
+    processed if the `deduplicator` finds the batch was resent.
+
+    Events are decoded and internalized one at a time, but the valid
+    events are then handed to `handle_events` as a single list, so
+    memory still grows with the batch: up to `MAX_BATCH_SIZE` events,
+    each decoded from at most `MAX_EVENT_SIZE` characters of the body.
     """
-    batch_events = []
     invalid_count = 0
-    malformed_count = 0
-    resource_to_root_context = ()
     remote_username = remote_user.username
 
-    # Lets hand-internalize these objects one-by-one so that we
-    # can exclude any malformed objects and process the proper events.
-    for event in events:
-        factory = internalization.find_factory_for(event)
-        if factory is None:
-            logger.warning(
-                'Malformed events received (mime_type=%s) (event=%s)',
-                event.get('MimeType'), event
-            )
-            malformed_count += 1
-            continue
-
-        new_event = factory()
-        resource_to_root_context = set()
-        try:
-            internalization.update_from_external_object(new_event, event)
-            if new_event.user != remote_username:
-                # This shouldn't happen.
-                logger.warning(
-                    'Analytics event username does not match remote user (event=%s) (%s)',
-                    new_event.user, remote_username
-                )
-                new_event.user = remote_username
-            duration = getattr(new_event, 'Duration', None)
-            if duration is not None and duration < 0:
-                logger.warn('Negative duration on event (%s) (%s)',
-                            duration, event)
-            batch_events.append(new_event)
-            if IAnalyticsProgressEvent.providedBy(new_event):
-                resource_to_root_context.add((new_event.ResourceId,
-                                              new_event.RootContextID))
-        except (ValidationError, ValueError) as e:
-            # The app may resend events if we err; so we should just log.
-            # String values in int fields throw ValueErrors instead of validation
-            # errors.
-            logger.warning('Malformed events received (event=%s) (%s)', event, e)
-            malformed_count += 1
+    # Internalize these objects in bulk so that we can exclude any
+    # malformed objects and process the proper events.
+    internalizer = BulkEventInternalizer(remote_username)
+    batch_events = internalizer(events)
+    total_count = internalizer.total_count
+    malformed_count = internalizer.malformed_count
+    resource_to_root_context = internalizer.resource_to_root_context
+
+    # The batch id is only known once the whole body has been read.
+    if deduplicator is not None and deduplicator.is_resent(total_count):
+        return 0, 0, 0, 0
 
     handled = []
-    event_count, invalid_exc_list = handle_events(batch_events, True, handled)
+    event_count, invalid_exc_list = 0, ()
+    if batch_events:
+        event_count, invalid_exc_list = handle_events(batch_events, True, handled)
 
     # if there are valid events notify last seen
     if handled:
         notify_lastseen_event(remote_user, request)
         notify(UserProcessedEventsEvent(remote_user, handled, request))
+        # The events are stored by the queue processor, which then
+        # changes the version of the stats they are part of.
+        queue_stored_events(remote_user, handled)
 
     # Now broadcast to interested parties that progress may have updated for
     # certain objects within certain contexts. This is probably not useful
-    # if our state is not updated in-line above.
-    for resource_ntiid, root_context_ntiid in resource_to_root_context:
-        resource_obj = find_object_with_ntiid(resource_ntiid)
-        root_context = find_object_with_ntiid(root_context_ntiid)
-        # This does not do anything for books (since they do not have completion).
-        context_provider = ICompletionContextProvider(root_context, None)
-        completion_context = context_provider() if context_provider else None
-        if      resource_obj is not None \
-            and completion_context is not None:
-            notify(UserProgressUpdatedEvent(resource_obj,
-                                            remote_user,
-                                            completion_context))
-        else:
-            logger.info("Could not find course from (%s) (%s)",
-                        resource_ntiid, root_context_ntiid)
+    # if our state is not updated in-line above. By default this happens
+    # in-line, but may be pushed onto the job queues.
+    dispatch_progress_updates(remote_user, resource_to_root_context)
 
     for invalid_exc in invalid_exc_list:
         logger.warning('Invalid events received (%s)', invalid_exc)
         invalid_count += 1
-    return event_count, malformed_count, invalid_count
+    return event_count, malformed_count, invalid_count, total_count
 
 
 class AnalyticsUpdateMixin(object):
@@ -280,11 +281,103 @@ class AnalyticsUpdateMixin(object):
     An analytics view mixin that decides when to process analytics updates.
     """
 
+    #: The maximum number of events accepted in a single batch. Larger
+    #: batches are rejected with a 413.
+    MAX_BATCH_SIZE = 5000
+
+    #: The maximum size (in characters of the body) of any one event,
+    #: or other value, of a batch. Larger events are rejected with a 400.
+    MAX_EVENT_SIZE = DEFAULT_MAX_VALUE_SIZE
+
+    def _check_batch_size(self, events):
+        for idx, event in enumerate(events):
+            if idx >= self.MAX_BATCH_SIZE:
+                raise_json_error(self.request,
+                                 hexc.HTTPRequestEntityTooLarge,
+                                 {
+                                     'message': _(u"Too many events in batch."),
+                                     'code': 'BatchTooLargeError',
+                                     'MaxBatchSize': self.MAX_BATCH_SIZE,
+                                 },
+                                 None)
+            yield event
+
+    def _stream_input(self):
+        """
+        Return a reader that streams the JSON body of this request.
+
+        The body is read through the seekable body file, so that it can
+        be read again if the transaction is retried. Webob copies the
+        body for this, in memory up to a small limit and to a temporary
+        file past it. The reader itself only buffers a chunk and the
+        value being decoded, which is at most `MAX_EVENT_SIZE`.
+        """
+        return StreamingJSONReader(self.request.body_file_seekable,
+                                   max_value_size=self.MAX_EVENT_SIZE)
+
+    def _iter_batch_events(self, reader, path):
+        """
+        Lazily iterate the externalized events found at `path` in our
+        streamed input, enforcing our maximum batch size.
+        """
+        try:
+            for event in self._check_batch_size(reader.iter_items(path)):
+                yield event
+        except JSONValueTooLargeError as e:
+            logger.warning('Oversized batch events input (%s)', e)
+            raise_json_error(self.request,
+                             hexc.HTTPBadRequest,
+                             {
+                                 'message': _(u"Event too large."),
+                                 'code': 'EventTooLargeError',
+                                 'MaxEventSize': reader.max_value_size,
+                             },
+                             None)
+        except MalformedJSONError as e:
+            logger.warning('Malformed batch events input (%s)', e)
+            raise_json_error(self.request,
+                             hexc.HTTPBadRequest,
+                             {
+                                 'message': _(u"Invalid JSON input."),
+                                 'code': 'MalformedJSONError',
+                             },
+                             None)
+
+    def _check_rate_limit(self):
+        """
+        Ask the client to back off, with a 429, if this user is sending
+        too quickly or the analytics queues are backed up.
+        """
+        username = getattr(self.remoteUser, 'username', None)
+        if username is None:
+            return
+        retry_after = get_retry_after(username)
+        if not retry_after:
+            return
+        logger.info('Throttling analytics (user=%s) (retry_after=%s)',
+                    username, retry_after)
+        statsd = statsd_client()
+        if statsd is not None:
+            statsd.incr('nti.analytics.events.throttled')
+        try:
+            raise_json_error(self.request,
+                             hexc.HTTPTooManyRequests,
+                             {
+                                 'message': _(u"Too many analytics requests."),
+                                 'code': 'TooManyRequestsError',
+                                 'RetryAfter': retry_after,
+                             },
+                             None)
+        except hexc.HTTPTooManyRequests as e:
+            e.headers['Retry-After'] = str(retry_after)
+            raise
+
     def _do_store_analytics(self):
         raise NotImplementedError()
 
     def store_analytics(self, request):
         if should_create_analytics(request):
+            self._check_rate_limit()
             return self._do_store_analytics()
         return hexc.HTTPForbidden(_('Cannot update analytics for this user.'))
 
@@ -300,30 +393,75 @@ class BatchEvents(AbstractAuthenticatedView,
     """
     A view that accepts a batch of analytics events.  The view
     will parse the input and process the events.
+
+    Clients may identify the batch with a 'BatchId' in the body, or with
+    the 'X-NTI-Batch-Id' header (or 'batchId' param), which lets us drop
+    a resent batch before reading its body.
     """
 
     content_predicate = IBatchResourceEvents.providedBy
 
-    def _do_store_analytics(self):
-        external_input = self.readInput()
-        events = external_input['events']
-        total_count = len(events)
+    def _request_batch_id(self):
+        """
+        The batch id sent with the request, rather than in the body.
+        """
+        return self.request.headers.get(BATCH_ID_HEADER) \
+            or self.request.GET.get(BATCH_ID_PARAM)
+
+    def _resent_result(self, batch_id):
+        logger.info('Dropping resent analytics batch before reading it (%s)',
+                    batch_id)
+        statsd = statsd_client()
+        if statsd is not None:
+            statsd.incr('nti.analytics.events.received.resent_batch')
+        result = LocatedExternalDict()
+        result['EventCount'] = 0
+        result['InvalidCount'] = 0
+        result['DuplicateCount'] = 0
+        result['MalformedEventCount'] = 0
+        result['DuplicateBatch'] = True
+        return result
 
-        event_count, malformed_count, invalid_count = \
-                    _process_batch_events(events, self.remoteUser, self.request)
-        if event_count > 10 or malformed_count or invalid_count:
-            logger.info("""Received batched analytic events (count=%s) (total_count=%s) (malformed=%s) (invalid=%s)""",
-                        event_count, total_count, malformed_count, invalid_count)
+    def _do_store_analytics(self):
+        # Drop events the client is resending (by batch or event id).
+        # A batch id sent with the request lets us drop a resent batch
+        # without reading its body.
+        batch_id = self._request_batch_id()
+        if batch_id:
+            deduplicator = BatchDeduplicator(self.remoteUser.username,
+                                             lambda: batch_id)
+            if deduplicator.batch_seen():
+                return self._resent_result(batch_id)
+        # Stream the events so we never decode the whole body at once.
+        reader = self._stream_input()
+        events = self._iter_batch_events(reader, ('events',))
+        if not batch_id:
+            deduplicator = BatchDeduplicator(self.remoteUser.username,
+                                             lambda: CaseInsensitiveDict(reader.values).get(BATCH_ID))
+        events = deduplicator.filter(events)
+        event_count, malformed_count, invalid_count, total_count = \
+                    _process_batch_events(events, self.remoteUser, self.request,
+                                          deduplicator)
+        duplicate_count = deduplicator.duplicate_count
+        deduplicator.mark_after_commit()
+        if event_count > 10 or malformed_count or invalid_count or duplicate_count:
+            logger.info("""Received batched analytic events (count=%s) (total_count=%s) (malformed=%s) (invalid=%s) (duplicate=%s)""",
+                        event_count, total_count, malformed_count, invalid_count,
+                        duplicate_count)
 
         statsd = statsd_client()
         if statsd is not None:
             statsd.incr('nti.analytics.events.received.malformed', malformed_count)
-            statsd.incr('nti.analytics.events.received.total', total_count)
+            statsd.incr('nti.analytics.events.received.duplicate', duplicate_count)
+            statsd.incr('nti.analytics.events.received.total',
+                        total_count + duplicate_count)
 
         result = LocatedExternalDict()
         result['EventCount'] = event_count
         result['InvalidCount'] = invalid_count
+        result['DuplicateCount'] = duplicate_count
         result['MalformedEventCount'] = malformed_count
+        result['DuplicateBatch'] = deduplicator.resent
         return result
 
     def _do_call(self):
@@ -338,9 +476,16 @@ class BatchEvents(AbstractAuthenticatedView,
 class BatchEventParams(AbstractAuthenticatedView):
 
     def __call__(self):
-        # Return our default analytic client params
+        # Return our default analytic client params, along with our rate
+        # limits and how long clients should currently hold off sending.
         client_params = AnalyticsClientParams()
-        return client_params
+        result = to_external_object(client_params)
+        limiter = component.queryUtility(IIngestRateLimiter)
+        if limiter is not None:
+            result['RateLimit'] = limiter.rate
+            result['RateLimitBurst'] = limiter.capacity
+        result['RetryAfter'] = get_queue_retry_after()
+        return result
 
 
 @event.listens_for(Sessions, "after_insert")
@@ -427,21 +572,20 @@ class EndAnalyticsSession(AbstractAuthenticatedView,
         request = self.request
         user = request.remote_user
 
-        values = CaseInsensitiveDict(self.readInput())
+        reader = self._stream_input()
+        events = self._iter_batch_events(reader, ('batch_events', 'events'))
+        event_count, malformed_count, invalid_count, total_count = \
+                        _process_batch_events(events, self.remoteUser, request)
+        if total_count:
+            logger.info("""Process batched analytic events on session close
+                        (count=%s) (total_count=%s) (malformed=%s)
+                        (invalid_count=%s)""",
+                        event_count, total_count, malformed_count,
+                        invalid_count)
+
+        # Only available once the stream is consumed.
+        values = CaseInsensitiveDict(reader.values)
         timestamp = values.get('timestamp')
-        batch_events = values.get('batch_events')
-
-        if batch_events:
-            events = batch_events.get('events')
-            if events:
-                total_count = len(events)
-                event_count, malformed_count, invalid_count = \
-                                _process_batch_events(events, self.remoteUser, request)
-                logger.info("""Process batched analytic events on session close
-                            (count=%s) (total_count=%s) (malformed=%s)
-                            (invalid_count=%s)""",
-                            event_count, total_count, malformed_count,
-                            invalid_count)
 
         session_id = get_session_id_from_request(request)
         handle_end_session(user, session_id, timestamp=timestamp)
@@ -456,6 +600,30 @@ class EndAnalyticsSession(AbstractAuthenticatedView,
         return self.store_analytics(self.request)
 
 
+class WindowedViewMixin(object):
+
+    def _time_param(self, pname):
+        timestamp = self.request.params.get(pname)
+        timestamp = float(timestamp) if timestamp is not None else None
+        return datetime.datetime.utcfromtimestamp(timestamp) if timestamp else None
+
+    @property
+    def not_before(self):
+        return self._time_param('notBefore')
+
+    @property
+    def not_after(self):
+        return self._time_param('notAfter')
+
+    def time_window(self):
+        not_after = self.not_after
+        not_before = self.not_before
+        if not_after is None and not_before is None:
+            not_after = datetime.datetime.utcnow()
+            not_before = not_after - datetime.timedelta(days=self.DEFAULT_WINDOW_DAYS)
+        return not_before, not_after
+
+
 @view_config(route_name='objects.generic.traversal',
              renderer='rest',
              context=ICourseInstance,
@@ -471,8 +639,27 @@ class UserCourseVideoProgress(AbstractAuthenticatedView,
     On return, the 'LastModified' header will be set, allowing
     the client to specify the 'If-Modified-Since' header for future requests.
     A HTTP-304 will be returned if the results have not changed.
+
+    Clients may instead pass an 'afterEventId' param (0 at first) to get
+    only the progress of the videos with events stored since that event,
+    however old their timestamps, or recent enough to still be updated.
+    Those results carry the 'LastEventId' to pass next time.
     """
 
+    def _after_event_id(self):
+        event_id = self.request.params.get('afterEventId')
+        if not event_id:
+            return None
+        try:
+            return int(event_id)
+        except ValueError:
+            raise_json_error(self.request,
+                             hexc.HTTPUnprocessableEntity,
+                             {
+                                 'message': _(u"Invalid event id."),
+                             },
+                             None)
+
     def __call__(self):
         user = self.getRemoteUser()
         course = self.context
@@ -482,7 +669,13 @@ class UserCourseVideoProgress(AbstractAuthenticatedView,
         result[StandardExternalFields.ITEMS] = item_dict = {}
         node_last_modified = None
 
-        video_progress_col = get_video_progress_for_course(user, course)
+        event_id = self._after_event_id()
+        if event_id is not None:
+            video_progress_col, event_id = get_video_progress_after(user, course,
+                                                                    event_id)
+            result['LastEventId'] = event_id
+        else:
+            video_progress_col = get_video_progress_for_course(user, course)
 
         for video_progress in video_progress_col:
             rid = video_progress.NTIID
@@ -667,39 +860,78 @@ class StatsSourceMixin(object):
     Something that looks up a stats source based context
     """
 
+    def _analytics_context(self):
+        return find_interface(self.context, IAnalyticsContext, strict=False)
+
     def _query_source(self, source_iface):
         """
         If we have a context we must use the context specific adapter,
         not the global utility (which queries all users)
         """
-        context = find_interface(self.context, IAnalyticsContext, strict=False)
+        context = self._analytics_context()
         if context:
             return component.queryAdapter(context, source_iface)
         return component.queryUtility(source_iface)
 
+    def _cached_stats(self, source_iface, window, compute, historical=False):
+        """
+        Return the (JSON-able) result of `compute` for the stats source
+        over the `window` parts, cached until the same boundary our
+        cache control gives clients, or until its version changes.
+        """
+        cache = component.queryUtility(IStatsResultCache)
+        if cache is None:
+            return compute()
+        if historical:
+            expires = historical_expires()
+        else:
+            # Results that update daily are good for today only
+            window = tuple(window) + (datetime.datetime.utcnow().date(),)
+            expires = daily_expires()
+        version, lapses = get_stats_version(self._analytics_context())
+        if lapses is not None:
+            expires = min(expires, lapses)
+        window = tuple(window) + (u'%.6f' % version,)
+        key = stats_cache_key(source_iface, *window)
+        return cache.get_or_compute(self._stats_scope(), key, compute, expires)
+
+    def _stats_scope(self):
+        return stats_cache_scope(getattr(getSite(), '__name__', None),
+                                 self._analytics_context())
+
+    def _check_not_modified(self):
+        """
+        Set the ETag and Last-Modified headers of our results, raising a
+        304 before computing them if the client's copy is current. Our
+        results change daily, and with the version of the stats of our
+        analytics context, which every process reads from the same
+        (persistent) marker, whatever the stats cache.
+        """
+        version, unused_lapses = get_stats_version(self._analytics_context())
+        today = datetime.datetime.utcnow().date()
+        validator = (self.request.view_name, self._stats_scope(),
+                     u'%.6f' % version, today.isoformat(),
+                     sorted(self.request.params.items()))
+        etag = hashlib.md5(repr(validator).encode('utf-8')).hexdigest()
+        last_modified = max(calendar.timegm(today.timetuple()), int(version))
 
-class WindowedViewMixin(object):
-
-    def _time_param(self, pname):
-        timestamp = self.request.params.get(pname)
-        timestamp = float(timestamp) if timestamp is not None else None
-        return datetime.datetime.utcfromtimestamp(timestamp) if timestamp else None
-
-    @property
-    def not_before(self):
-        return self._time_param('notBefore')
-
-    @property
-    def not_after(self):
-        return self._time_param('notAfter')
-
-    def time_window(self):
-        not_after = self.not_after
-        not_before = self.not_before
-        if not_after is None and not_before is None:
-            not_after = datetime.datetime.utcnow()
-            not_before = not_after - datetime.timedelta(days=self.DEFAULT_WINDOW_DAYS)
-        return not_before, not_after
+        response = self.request.response
+        response.etag = etag
+        response.last_modified = last_modified
+        # If-None-Match takes precedence over If-Modified-Since
+        if_modified_since = self.request.if_modified_since
+        if 'If-None-Match' in self.request.headers:
+            not_modified = etag in self.request.if_none_match
+        elif if_modified_since is not None:
+            if_modified_since = calendar.timegm(if_modified_since.utctimetuple())
+            not_modified = if_modified_since >= last_modified
+        else:
+            not_modified = False
+        if not_modified:
+            result = hexc.HTTPNotModified()
+            result.etag = etag
+            result.last_modified = last_modified
+            raise result
 
 
 class AbstractHistoricalAnalyticsView(AbstractUserLocationView,
@@ -869,10 +1101,14 @@ class AnalyticsTimeSummary(AbstractAuthenticatedView, StatsSourceMixin):
         source = self._query_source(IActiveTimesStatsSource)
         if source is None:
             raise hexc.HTTPNotFound()
+        self._check_not_modified()
 
         start, end = self.times_to_consider(weeks=weeks)
 
-        stats = source.active_times_for_window(start, end)
+        def _week_days():
+            stats = get_active_times(self._analytics_context(),
+                                     source, start, end)
+            return dict(zip(calendar.day_name, stats))
 
         result = LocatedExternalDict()
         result.__parent__ = self.request.context
@@ -880,12 +1116,9 @@ class AnalyticsTimeSummary(AbstractAuthenticatedView, StatsSourceMixin):
 
         result['StartTime'] = start
         result['EndTime'] = end
-
-        items = {}
-        for idx, day in enumerate(calendar.day_name):
-            items[day] = [stats[idx][hour].Count for hour in range(0, 24)]
-
-        result['WeekDays'] = items
+        result['WeekDays'] = self._cached_stats(IActiveTimesStatsSource,
+                                                (start, end),
+                                                _week_days)
 
         # These results will not update more frequently than daily
         interface.alsoProvides(result, _IDailyResults)
@@ -913,7 +1146,24 @@ class ActivitySummaryByDate(AbstractUserLocationView, StatsSourceMixin, Windowed
         source = self._query_source(IDailyActivityStatsSource)
         if source is None:
             raise hexc.HTTPNotFound()
-        stats = source.stats_for_window(not_before, not_after)
+        self._check_not_modified()
+        historical = bool(self.not_after and self.not_before)
+        if self.not_after is None and self.not_before is None:
+            # The default window moves with every request; cache it for
+            # the day
+            window = ('last', self.DEFAULT_WINDOW_DAYS)
+        else:
+            window = (not_before, not_after)
+
+        def _dates():
+            if not_before is None or not_after is None:
+                # Open ended windows are not rolled up
+                stats = {k: v.Count for k, v in
+                         source.stats_for_window(not_before, not_after).items()}
+            else:
+                stats = get_daily_activity(self._analytics_context(),
+                                           source, not_before, not_after)
+            return {k.strftime('%Y-%m-%d'): v for k, v in stats.items()}
 
         result = LocatedExternalDict()
         result.__parent__ = self.request.context
@@ -921,9 +1171,10 @@ class ActivitySummaryByDate(AbstractUserLocationView, StatsSourceMixin, Windowed
 
         result['StartTime'] = not_before
         result['EndTime'] = not_after
-        result['Dates'] = {
-            k.strftime('%Y-%m-%d'): v.Count for k, v in stats.items()
-        }
+        result['Dates'] = self._cached_stats(IDailyActivityStatsSource,
+                                             window,
+                                             _dates,
+                                             historical=historical)
 
         cache_hint = _IDailyResults
         if not_after and not_before:
@@ -950,13 +1201,7 @@ class DailyCacheControl(AbstractStatsCacheControl):
         resp = super(DailyCacheControl, self).__call__(context, system)
         resp.cache_control.must_revalidate = False
         now = datetime.datetime.utcnow()
-
-        # Go back to the beginning of today. It
-        # will be the *exclusive* end of the range
-        expires = datetime.datetime(now.year,
-                                    now.month,
-                                    now.day)
-        expires = (expires + datetime.timedelta(days=1))
+        expires = get_daily_expiration(now)
         resp.cache_control.max_age = int((expires - now).total_seconds())
         return resp
 
@@ -965,7 +1210,7 @@ class HistoricalCacheControl(AbstractStatsCacheControl):
 
     def __call__(self, context, system):
         resp = super(HistoricalCacheControl, self).__call__(context, system)
-        resp.cache_control.max_age = 24*60*60
+        resp.cache_control.max_age = HISTORICAL_SECONDS
         resp.cache_control.must_revalidate = False
         return resp
 
@@ -990,6 +1235,7 @@ class ActiveUsers(AbstractUserLocationView,
         users_source = self._query_source(IActiveUsersSource)
         if not users_source:
             raise hexc.HTTPNotFound()
+        self._check_not_modified()
 
         not_before, not_after = self.time_window()
 
@@ -1011,16 +1257,11 @@ class ActiveUsers(AbstractUserLocationView,
         interface.alsoProvides(result, cache_hint)
         return result
 
-@view_defaults(route_name='objects.generic.traversal',
-               renderer='rest',
-               context=INTIVideo,
-               request_method='GET',
-               permission=nauth.ACT_READ)
-class VideoResumeInfo(AbstractAuthenticatedView):
-
-    @Lazy
-    def course(self):
-        return ICourseInstance(self.request)
+class _UserCourseDetailsMixin(object):
+    """
+    For views of a user's (by default, the remote user's) details in a
+    `course`.
+    """
 
     @Lazy
     def user(self):
@@ -1029,15 +1270,6 @@ class VideoResumeInfo(AbstractAuthenticatedView):
             return User.get_user(username_param)
         return self.remoteUser
 
-    def make_result(self):
-        result = LocatedExternalDict()
-        result.__name__ = self.request.view_name
-        result.__parent__ = self.request.context
-        result['NTIID'] = self.context.ntiid
-        result['Course'] = self.course.ntiid
-        result['Username'] = self.user.username
-        return result
-
     def _do_check_permission(self, perm=ACT_VIEW_DETAILED_CONTENT_USAGE):
         """
         Our view callable predicate ensures read access to the
@@ -1070,6 +1302,76 @@ class VideoResumeInfo(AbstractAuthenticatedView):
         raise hexc.HTTPForbidden()
 
 
+@view_config(route_name='objects.generic.traversal',
+             name='VideoResumeInfo',
+             context=ICourseInstance,
+             renderer='rest',
+             request_method='GET',
+             permission=nauth.ACT_READ)
+class UserCourseVideoResumeInfo(AbstractAuthenticatedView,
+                                _UserCourseDetailsMixin):
+    """
+    For the given course instance, return the resume information
+    ('ResumeSeconds' and 'MaxDuration') we have for the user on each
+    video they have watched in the course.
+
+    As with VideoProgress, the 'LastModified' header will be set,
+    allowing the client to specify the 'If-Modified-Since' header for
+    future requests. A HTTP-304 will be returned if the results have
+    not changed.
+    """
+
+    @Lazy
+    def course(self):
+        return self.context
+
+    def __call__(self):
+        self._do_check_permission()
+        result = LocatedExternalDict()
+        result.__name__ = self.request.view_name
+        result.__parent__ = self.request.context
+        result[StandardExternalFields.CLASS] = 'CourseVideoResumeInfo'
+        result['Course'] = self.course.ntiid
+        result['Username'] = self.user.username
+        result[StandardExternalFields.ITEMS] = item_dict = {}
+        last_modified = None
+
+        for row in get_video_resume_rows(self.user, self.course) or ():
+            item_dict[row.resource_id] = {
+                'MaxDuration': row.max_duration,
+                'ResumeSeconds': get_resume_seconds(row.video_start_time,
+                                                    row.video_end_time,
+                                                    row.time_length)
+            }
+            if last_modified is None or row.timestamp > last_modified:
+                last_modified = row.timestamp
+
+        # Setting this will enable the renderer to return a 304, if needed.
+        self.request.response.last_modified = last_modified
+        return result
+
+
+@view_defaults(route_name='objects.generic.traversal',
+               renderer='rest',
+               context=INTIVideo,
+               request_method='GET',
+               permission=nauth.ACT_READ)
+class VideoResumeInfo(AbstractAuthenticatedView,
+                      _UserCourseDetailsMixin):
+
+    @Lazy
+    def course(self):
+        return ICourseInstance(self.request)
+
+    def make_result(self):
+        result = LocatedExternalDict()
+        result.__name__ = self.request.view_name
+        result.__parent__ = self.request.context
+        result['NTIID'] = self.context.ntiid
+        result['Course'] = self.course.ntiid
+        result['Username'] = self.user.username
+        return result
+
     @view_config(name='resume_info')
     def get_resume_info(self):
         self._do_check_permission()
@@ -1093,18 +1395,9 @@ class VideoResumeInfo(AbstractAuthenticatedView):
 
         if event:
             result['MaxDuration'] = event.MaxDuration
-            # When a user starts watching a video we get an initial watch
-            # event with a video_start_time, but no duration, and no video_end_time.
-            # if they close the window or we don't get any updates for that event
-            # the resume_info is that starting point.
-            #
-            # Then we start getting heartbeats. We still don't have an end_time
-            # but we do get a Duration (time_length) that is the offset from the start
-            # time to the playhead.
-            playhead = event.video_end_time
-            if not playhead:
-                playhead = event.video_start_time + (event.time_length or 0)
-            result['ResumeSeconds'] = playhead
+            result['ResumeSeconds'] = get_resume_seconds(event.video_start_time,
+                                                         event.video_end_time,
+                                                         event.time_length)
 
         return result
 
@@ -1128,4 +1421,53 @@ class VideoResumeInfo(AbstractAuthenticatedView):
 
         return result
 
+
+@view_config(route_name='objects.generic.traversal',
+             name='retention',
+             context=INTIVideo,
+             renderer='rest',
+             request_method='GET',
+             permission=nauth.ACT_READ)
+class VideoRetention(AbstractAuthenticatedView):
+    """
+    The audience retention curve of a video in a course: the count of
+    views covering each `bucket_seconds` (default one) long part of the
+    video, across all users.
+    """
+
+    @Lazy
+    def course(self):
+        return ICourseInstance(self.request)
+
+    @Lazy
+    def bucket_seconds(self):
+        bucket_seconds = self.request.params.get('bucket_seconds', 1)
+        try:
+            bucket_seconds = int(bucket_seconds)
+        except ValueError:
+            bucket_seconds = None
+        if not bucket_seconds or bucket_seconds < 1:
+            raise_json_error(self.request,
+                             hexc.HTTPUnprocessableEntity,
+                             {
+                                 'message': _(u"Bucket seconds must be a positive integer."),
+                             },
+                             None)
+        return bucket_seconds
+
+    def __call__(self):
+        if not has_permission(ACT_VIEW_DETAILED_CONTENT_USAGE, self.course):
+            raise hexc.HTTPForbidden()
+        counts = get_video_retention(self.course,
+                                     self.context,
+                                     self.bucket_seconds)
+        result = LocatedExternalDict()
+        result.__name__ = self.request.view_name
+        result.__parent__ = self.request.context
+        result['NTIID'] = self.context.ntiid
+        result['Course'] = self.course.ntiid
+        result['BucketSeconds'] = self.bucket_seconds
+        result['ViewCounts'] = counts or []
+        return result
+
         